@@ -0,0 +1,275 @@
+import sys
+import time
+import argparse
+from simp_daemon import (ErrorType, DatagramType, OperationType, RelayOperation, TRACE_MAGIC, TRACE_RECORD, TRACE_OUT, TRACE_CLIENT,
+                         KNOWN_OPERATIONS, MIN_HEADER_SIZE, MAX_HEADER_SIZE, MAX_USERNAME_SIZE, MAX_PAYLOAD_SIZE, RELAY_HEADER_SIZE, SEQ_SPACE)
+
+#NumPy is only needed for the analysis, the daemon runs without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CONTROL = DatagramType.CONTROL.to_bytes()[0]
+CHAT = DatagramType.CHAT.to_bytes()[0]
+RELAY = DatagramType.RELAY.to_bytes()[0]
+PERCENTILES = (50, 90, 99, 99.9)
+GATHER_PADDING = MAX_HEADER_SIZE + RELAY_HEADER_SIZE  # zeros after the trace, so the header fields of short datagrams can be gathered
+
+
+#one row per datagram of a trace. the header fields are the ones of the daemon protocol for the daemon socket and of the relay envelope
+#unwrapped, for the client socket type is the message type and username starts at the second byte. length is read like get_msg_length does
+def trace_dtype():
+    return np.dtype([
+        ('time', 'u8'),  # monotonic time, ns
+        ('out', '?'),
+        ('client', '?'),
+        ('ip', 'u4'),
+        ('port', 'u2'),
+        ('size', 'u4'),  # size of the datagram without the relay envelope
+        ('type', 'u1'),
+        ('operation', 'u1'),
+        ('seq', 'u1'),
+        ('username', f'S{MAX_USERNAME_SIZE}'),
+        ('length', 'u4'),
+        ('non_ascii', '?'),  # the username field can not be decoded as ascii
+    ])
+
+
+#function to gather a big-endian field of width bytes at every start, returns an array of unsigned integers
+def gather(data, starts, width):
+    columns = data[starts[:, None] + np.arange(width)].astype(np.uint64)
+    value = np.zeros(len(starts), dtype=np.uint64)
+    for i in range(width):
+        value = (value << np.uint64(8)) | columns[:, i]
+    return value
+
+
+#function to find where the records of a trace start, the only loop over the datagrams (the length of a record is in the record before)
+def record_offsets(raw, offset):
+    offsets = []
+    append = offsets.append
+    length_at = TRACE_RECORD.size - 2
+    end = len(raw) - TRACE_RECORD.size
+    while offset <= end:
+        size = int.from_bytes(raw[offset + length_at:offset + TRACE_RECORD.size], byteorder='big')
+        if offset + TRACE_RECORD.size + size > len(raw):
+            break  # cut off, the daemon was killed while writing
+        append(offset)
+        offset += TRACE_RECORD.size + size
+    return np.array(offsets, dtype=np.int64)
+
+
+#function to map a trace file into a structured array, returns the address of the daemon and the array
+def load_trace(path):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if not raw.startswith(TRACE_MAGIC):
+        raise ValueError(f"{path} is not a SIMP trace")
+    offset = len(TRACE_MAGIC)
+    length = int.from_bytes(raw[offset:offset + 2], byteorder='big')
+    address = str(raw[offset + 2:offset + 2 + length], 'ascii')
+    offsets = record_offsets(raw, offset + 2 + length)
+
+    data = np.frombuffer(raw + bytes(GATHER_PADDING), dtype=np.uint8)
+    trace = np.zeros(len(offsets), dtype=trace_dtype())
+    trace['time'] = gather(data, offsets, 8)
+    flags = data[offsets + 8]
+    trace['out'] = (flags & TRACE_OUT) != 0
+    trace['client'] = (flags & TRACE_CLIENT) != 0
+    trace['ip'] = gather(data, offsets + 9, 4)
+    trace['port'] = gather(data, offsets + 13, 2)
+    size = gather(data, offsets + 15, 2).astype(np.int64)
+    start = offsets + TRACE_RECORD.size
+
+    #datagrams forwarded by the relay hub are analyzed without their envelope
+    relayed = ~trace['client'] & (size >= RELAY_HEADER_SIZE) & (data[start] == RELAY) & (data[start + 1] == RelayOperation.FORWARD.value)
+    start = start + np.where(relayed, RELAY_HEADER_SIZE, 0)
+    size = size - np.where(relayed, RELAY_HEADER_SIZE, 0)
+    trace['size'] = size
+
+    client = trace['client']
+    trace['type'] = np.where(size > 0, data[start], 0)
+    trace['operation'] = np.where(client | (size < 2), 0, data[start + 1])
+    trace['seq'] = np.where(client | (size < 3), 0, data[start + 2])
+    username_start = np.where(client, start + 1, start + 3)
+    username = data[username_start[:, None] + np.arange(MAX_USERNAME_SIZE)]
+    #bytes after the end of a short datagram belong to the next record, they are not part of the username
+    username = np.where(np.arange(MAX_USERNAME_SIZE) < (size - (username_start - start))[:, None], username, 0)
+    trace['username'] = username.astype(np.uint8).view(f'S{MAX_USERNAME_SIZE}').ravel()
+    #get_username reads one byte more than the username field (msg[3:36])
+    trace['non_ascii'] = ~client & ((username >= 0x80).any(axis=1) | ((size > 35) & (data[start + 35] >= 0x80)))
+    #get_msg_length reads the last three bytes of the length field (msg[36:39]), a datagram shorter than that has fewer of them
+    length = np.zeros(len(offsets), dtype=np.uint64)
+    for i in range(36, 39):
+        present = size > i
+        length = np.where(present, (length << np.uint64(8)) | data[start + i].astype(np.uint64), length)
+    trace['length'] = length
+    return address, trace
+
+
+#function to load several traces (e.g. the files of the worker processes) into one array sorted by time
+def load_traces(paths):
+    traces = [load_trace(path)[1] for path in paths]
+    trace = np.concatenate(traces) if len(traces) > 1 else traces[0]
+    return trace[np.argsort(trace['time'], kind='stable')]
+
+
+#function to get a small integer per (ip, port) of the other side
+def peer_index(trace):
+    peers = (trace['ip'].astype(np.uint64) << np.uint64(16)) | trace['port']
+    _, index = np.unique(peers, return_inverse=True)
+    return index.ravel()
+
+
+#function to find the chat datagrams that were sent again. a datagram is a retransmission when the same seq was sent to the same
+#daemon less than SEQ_SPACE datagrams before, a new datagram can only reuse the seq after the sequence numbers wrapped around
+def retransmissions(trace):
+    sent = trace[trace['out'] & ~trace['client'] & (trace['type'] == CHAT)]
+    if len(sent) == 0:
+        return sent, np.zeros(0, dtype=bool)
+    peer = peer_index(sent)
+    order = np.lexsort((sent['time'], peer))
+    #position of every datagram among the datagrams sent to the same daemon
+    position = np.empty(len(sent), dtype=np.int64)
+    sorted_peer = peer[order]
+    group_start = np.r_[0, np.flatnonzero(np.diff(sorted_peer)) + 1]
+    counts = np.diff(np.r_[group_start, len(sent)])
+    position[order] = np.arange(len(sent)) - np.repeat(group_start, counts)
+
+    order = np.lexsort((sent['time'], sent['seq'], peer))
+    same = (peer[order][1:] == peer[order][:-1]) & (sent['seq'][order][1:] == sent['seq'][order][:-1])
+    recent = position[order][1:] - position[order][:-1] < SEQ_SPACE
+    retransmitted = np.zeros(len(sent), dtype=bool)
+    retransmitted[order[1:]] = same & recent
+    return sent, retransmitted
+
+
+#function to measure the round trip times: every ACK with a receive window is matched with the last chat datagram
+#sent to the same daemon with the same seq before it. the ACKs of retransmitted datagrams are left out (Karn's rule)
+def round_trip_times(trace):
+    sent, retransmitted = retransmissions(trace)
+    acks = trace[~trace['out'] & ~trace['client'] & (trace['type'] == CONTROL) & (trace['operation'] == OperationType.ACK.value)
+                 & (trace['size'] >= MAX_HEADER_SIZE + 2)]
+    if len(sent) == 0 or len(acks) == 0:
+        return np.zeros(0, dtype=np.int64)
+    both = np.concatenate([sent, acks])
+    peer = peer_index(both)
+    key = peer.astype(np.uint64) * np.uint64(SEQ_SPACE) + both['seq']
+    sent_key, ack_key = key[:len(sent)], key[len(sent):]
+
+    #the times are replaced by their rank, so (key, time) fits in one integer that can be searched. at the same time the datagram
+    #ranks before the ACK
+    times = np.concatenate([sent['time'], acks['time']])
+    rank = np.empty(len(times), dtype=np.uint64)
+    rank[np.argsort(times, kind='stable')] = np.arange(len(times), dtype=np.uint64)
+    scale = np.uint64(len(times))
+    sent_position = sent_key * scale + rank[:len(sent)]
+    ack_position = ack_key * scale + rank[len(sent):]
+    order = np.argsort(sent_position)
+    match = np.searchsorted(sent_position[order], ack_position, side='right') - 1
+    valid = match >= 0
+    match = order[np.maximum(match, 0)]
+    valid &= sent_key[match] == ack_key
+    #the ACK of a retransmitted datagram could belong to any of its copies (Karn's rule), a repeated ACK is counted once
+    valid &= ~retransmitted[match]
+    _, first = np.unique(match[valid], return_index=True)
+    ack_time = acks['time'][valid][first].astype(np.int64)
+    sent_time = sent['time'][match[valid][first]].astype(np.int64)
+    return ack_time - sent_time
+
+
+#function to sum the chat datagrams and payload bytes per username (the author of the message)
+def user_volumes(trace):
+    chat = trace[~trace['client'] & (trace['type'] == CHAT)]
+    if len(chat) == 0:
+        return []
+    names, index = np.unique(chat['username'], return_inverse=True)
+    index = index.ravel()
+    payload = chat['size'].astype(np.int64) - MAX_HEADER_SIZE
+    received = ~chat['out']
+    datagrams_in = np.bincount(index, weights=received, minlength=len(names))
+    datagrams_out = np.bincount(index, weights=~received, minlength=len(names))
+    bytes_in = np.bincount(index, weights=np.where(received, payload, 0), minlength=len(names))
+    bytes_out = np.bincount(index, weights=np.where(received, 0, payload), minlength=len(names))
+    volumes = [(str(name.rstrip(b'\x00'), 'ascii', errors='replace'), int(d_in), int(b_in), int(d_out), int(b_out))
+               for name, d_in, b_in, d_out, b_out in zip(names, datagrams_in, bytes_in, datagrams_out, bytes_out)]
+    return sorted(volumes, key=lambda volume: volume[2] + volume[4], reverse=True)
+
+
+#function to count the errors build_header finds in the datagrams the daemon received from other daemons, returns ErrorType -> count.
+#the checks are the ones of build_header and its get_* functions
+def error_breakdown(trace):
+    received = trace[~trace['out'] & ~trace['client']]
+    size = received['size'].astype(np.int64)
+    dtype = received['type']
+    operation = received['operation']
+    known_type = (size > 0) & ((dtype == CONTROL) | (dtype == CHAT))
+    known_operation = (dtype == CHAT) | ((dtype == CONTROL) & np.isin(operation, list(KNOWN_OPERATIONS)))
+    wrong_length = received['length'] > MAX_PAYLOAD_SIZE
+    payload = np.maximum(size - MAX_HEADER_SIZE, 0)
+    no_payload_expected = (payload > 0) & (dtype == CONTROL) & known_operation & (operation != OperationType.MESSAGE.value) \
+        & (operation != OperationType.ACK.value) & (operation != OperationType.SYN.value) \
+        & (operation != OperationType.SYN.value | OperationType.ACK.value)
+    errors = {
+        ErrorType.MSG_TOO_SHORT: size < MIN_HEADER_SIZE,
+        ErrorType.UKNOWN_DATAGRAM_TYPE: ~known_type,
+        ErrorType.UKNOWN_OPERATION_TYPE: ~known_operation,
+        ErrorType.WRONG_SEQUENCE_NUMBER: size < 3,
+        ErrorType.USERNAME_ERROR: received['non_ascii'],
+        ErrorType.WRONG_LENGTH_SIZE: wrong_length,
+        ErrorType.NO_PAYLOAD_EXPECTED: no_payload_expected,
+        ErrorType.WRONG_PAYLOAD_SIZE: ~no_payload_expected & (wrong_length | (payload != received['length'])),
+    }
+    counts = {error: int(np.count_nonzero(mask)) for error, mask in errors.items()}
+    counts['datagrams with errors'] = int(np.count_nonzero(np.logical_or.reduce(list(errors.values())))) if len(received) else 0
+    return counts
+
+
+def print_report(trace, top):
+    duration = (int(trace['time'][-1]) - int(trace['time'][0])) / 1e9 if len(trace) else 0
+    print(f"{len(trace)} datagrams over {duration:.1f} s, {np.count_nonzero(trace['client'])} of them on the client socket")
+
+    sent, retransmitted = retransmissions(trace)
+    count = np.count_nonzero(retransmitted)
+    print(f"\nChat datagrams sent: {len(sent)}, retransmitted {count} ({100 * count / max(len(sent), 1):.2f}%)")
+
+    rtt = round_trip_times(trace)
+    if len(rtt):
+        values = ', '.join(f"p{p:g} {v / 1e6:.2f} ms" for p, v in zip(PERCENTILES, np.percentile(rtt, PERCENTILES)))
+        print(f"RTT: {values}, max {rtt.max() / 1e6:.2f} ms ({len(rtt)} samples)")
+        edges = 2.0 ** np.arange(-4, 12)  # ms
+        histogram, _ = np.histogram(rtt / 1e6, bins=np.r_[0, edges, np.inf])
+        for low, high, samples in zip(np.r_[0, edges], np.r_[edges, np.inf], histogram):
+            if samples:
+                print(f"  {low:9.3f} - {high:<9.3f} ms {samples}")
+    else:
+        print("RTT: no acknowledged chat datagrams")
+
+    volumes = user_volumes(trace)
+    print(f"\nChat volume per user (top {top} of {len(volumes)}):")
+    for name, datagrams_in, bytes_in, datagrams_out, bytes_out in volumes[:top]:
+        print(f"  {name:32} received {datagrams_in:8} datagrams {bytes_in:10} bytes, sent {datagrams_out:8} datagrams {bytes_out:10} bytes")
+
+    print("\nErrors in the datagrams received from daemons:")
+    for error, count in error_breakdown(trace).items():
+        if count:
+            print(f"  {error.name if isinstance(error, ErrorType) else error}: {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP trace analysis (needs NumPy)")
+    parser.add_argument("traces", nargs="+", help="trace files recorded with simp_daemon.py --trace, e.g. the files of all workers")
+    parser.add_argument("--top", type=int, default=10, help="number of users listed")
+    args = parser.parse_args()
+    if np is None:
+        print("simp_analysis.py needs NumPy: pip install numpy")
+        sys.exit(1)
+    started = time.perf_counter()
+    try:
+        trace = load_traces(args.traces)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    print(f"Loaded {len(trace)} datagrams in {time.perf_counter() - started:.2f} s")
+    print_report(trace, args.top)
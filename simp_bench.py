@@ -0,0 +1,344 @@
+import os
+import sys
+import socket
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import tracemalloc
+import tempfile
+import itertools
+import contextlib
+from collections import deque
+import simp_daemon
+from simp_daemon import BufferPool, DatagramType, OperationType, encode_username, RECV_BUFFER_SIZE, RECV_RING_SIZE, MAX_HEADER_SIZE
+from simp_client import MessageType, SimpClient
+from simp_proxy import ImpairmentProxy, add_impairment_arguments, impairments_from_args
+from simp_loadgen import print_latency
+from simp_trace import Replayer, read_trace
+import simp_sim
+
+BENCH_ADDRESS = '127.0.0.1'
+RECV_TIMEOUT = 1  # a datagram that does not arrive in that time ends a batch
+BATCH_SIZE = 256  # datagrams sent before they are received, they have to fit in the receive buffer of the socket
+DEFAULT_COUNTS = {'recv': 100000, 'impaired': 1000, 'replay': 3, 'mac': 100000, 'sim': 200, 'search': 1000000}
+#daemon A and B of the impaired benchmark and the addresses the proxy stands for them on
+IMPAIRED_DAEMONS = ('127.0.5.1', '127.0.5.2')
+IMPAIRED_PROXIES = ('127.0.5.11', '127.0.5.12')
+DAEMON_STARTUP = 0.5
+STALL_TIMEOUT = 30  # the impaired benchmark stops waiting when nothing was delivered for that long
+MAC_PAYLOADS = (0, 64, 512, 2048)  # payload sizes of the MAC benchmark, 0 is an ACK-sized datagram
+SIM_MESSAGES = 100  # chat messages per run of the simulation benchmark
+SEARCH_VOCABULARY = 20000  # words of the messages of the search benchmark, drawn with a Zipf distribution
+SEARCH_WORDS = 10  # words per message
+SEARCH_USERS = 100
+SEARCH_REPEAT = 20  # times every query is run
+
+
+#function to build a chat datagram of another daemon with a payload of the given size
+def build_datagram(payload_size, seq=0):
+    payload = b'x' * payload_size
+    return b''.join([DatagramType.CHAT.to_bytes(), OperationType.MESSAGE.to_bytes(), seq.to_bytes(1, byteorder='big'),
+                     encode_username('bench'), len(payload).to_bytes(4, byteorder='big'), payload])
+
+
+#function to create the sender and receiver sockets of a benchmark, the receiver stays blocking if timeout is None
+def open_sockets(timeout=RECV_TIMEOUT):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind((BENCH_ADDRESS, 0))
+    receiver.settimeout(timeout)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return sender, receiver
+
+
+#the receive path of the daemon before the buffer pool: a new bytes object per datagram and per slice
+def recv_copy(sock):
+    return sock.recvfrom(RECV_BUFFER_SIZE)
+
+
+#the receive path of the daemon: the buffer pool waits for the timeout itself, the socket stays blocking
+def pool_recv():
+    pool = BufferPool()
+    return lambda sock: pool.recvfrom(sock, RECV_TIMEOUT)
+
+
+#function that parses a received datagram like the daemon does and builds the chat message for the client
+def handle(msg):
+    simp_daemon.get_datagram_type(msg)
+    simp_daemon.get_operation_type(msg)
+    simp_daemon.get_sequence_number(msg)
+    username = simp_daemon.get_username(msg)
+    simp_daemon.get_msg_length(msg)
+    payload = simp_daemon.get_msg_payload(msg)
+    return b''.join([MessageType.CHAT.to_bytes(), encode_username(username), payload])
+
+
+#function that sends the datagrams in batches and receives them with the given receive function, returns the receive time and
+#how many datagrams were received. backlog keeps the last datagrams referenced, like the drain queue of the daemon does
+def run_receive(recv, count, datagram, backlog, timeout=RECV_TIMEOUT):
+    sender, receiver = open_sockets(timeout)
+    address = receiver.getsockname()
+    kept = deque(maxlen=backlog)
+    received = 0
+    elapsed = 0
+    try:
+        while received < count:
+            batch = min(BATCH_SIZE, count - received)
+            for _ in range(batch):
+                sender.sendto(datagram, address)
+            start = time.perf_counter()
+            for _ in range(batch):
+                try:
+                    msg, _ = recv(receiver)
+                except socket.timeout:
+                    break
+                handle(msg)
+                kept.append(msg)
+                received += 1
+            elapsed += time.perf_counter() - start
+    finally:
+        sender.close()
+        receiver.close()
+    return elapsed, received
+
+
+#benchmark of the receive path, recvfrom with a new bytes object per datagram against the preallocated buffer pool
+def bench_recv(args):
+    datagram = build_datagram(args.payload)
+    backlog = RECV_RING_SIZE // 2
+    paths = [('recvfrom', lambda: recv_copy, RECV_TIMEOUT), ('buffer pool', pool_recv, None)]
+    print(f"Receiving {args.count} datagrams of {len(datagram)} bytes, {backlog} kept referenced")
+    for name, make_recv, timeout in paths:
+        elapsed, received = run_receive(make_recv(), args.count, datagram, backlog, timeout)
+
+        #the allocations are measured in a separate run, tracemalloc slows the receive path down
+        recv = make_recv()
+        tracemalloc.start()
+        run_receive(recv, min(args.count, 10000), datagram, backlog, timeout)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {name:12}: {received / elapsed:10.0f} datagrams/s, {received} received, peak traced memory {peak / 1024:.1f} KiB")
+    print(f"  (the buffer pool preallocates {RECV_RING_SIZE * RECV_BUFFER_SIZE // 1024} KiB once, outside of the traced run)")
+
+
+#function to start a daemon for a benchmark, its output is discarded
+def start_daemon(address):
+    daemon = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simp_daemon.py')
+    return subprocess.Popen([sys.executable, daemon, address], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+#benchmark of the reliability paths, two daemons chat through the impairment proxy. daemon A sends the messages at the given rate,
+#the goodput, the delivery latency and the recovery latency of the messages whose datagram the proxy dropped are measured at B's client
+def bench_impaired(args):
+    impairment_ab, impairment_ba = impairments_from_args(args)
+    daemons = [start_daemon(address) for address in IMPAIRED_DAEMONS]
+    proxy = ImpairmentProxy(*IMPAIRED_DAEMONS, *IMPAIRED_PROXIES, impairment_ab, impairment_ba)
+    proxy.start()
+    time.sleep(DAEMON_STARTUP)
+    print(f"Sending {args.count} messages of {args.payload} bytes at {args.rate:g}/s, loss {args.loss:g}, delay {args.delay:g} ms, "
+          f"jitter {args.jitter:g} ms, duplicate {args.duplicate:g}, reorder {args.reorder:g}, seed {args.seed}")
+    try:
+        asyncio.run(run_impaired(args, proxy))
+    finally:
+        proxy.stop()
+        for daemon in daemons:
+            daemon.kill()
+            daemon.wait()
+    print(f"  proxy a->b: {proxy.stats_ab}")
+    print(f"  proxy b->a: {proxy.stats_ba}")
+
+
+async def run_impaired(args, proxy):
+    delivered = {}  # message id -> delivery time
+    dropped = {}  # message id -> time its chat datagram was first dropped
+    send_times = {}
+
+    def on_message(username, text):
+        message_id = text.split(' ', 1)[0]
+        if message_id.isdigit() and int(message_id) not in delivered:
+            delivered[int(message_id)] = time.perf_counter()
+
+    #called by the proxy thread, only the chat datagrams of A are messages
+    def on_drop(datagram, direction):
+        if direction == 'a->b' and datagram[0] == 2:
+            message_id = datagram[MAX_HEADER_SIZE:].lstrip(b'\x00').split(b' ', 1)[0]
+            if message_id.isdigit():
+                dropped.setdefault(int(message_id), time.perf_counter())
+
+    proxy.on_drop = on_drop
+    sender = SimpClient(IMPAIRED_DAEMONS[0], 'sender')
+    receiver = SimpClient(IMPAIRED_DAEMONS[1], 'receiver', on_message=on_message)
+    await sender.open()
+    await receiver.open()
+    try:
+        await sender.connect()
+        await receiver.connect()
+        waiting = asyncio.ensure_future(receiver.wait())
+        await asyncio.sleep(0.1)
+        started = time.perf_counter()
+        request = asyncio.ensure_future(sender.request(IMPAIRED_PROXIES[1]))
+        await waiting
+        receiver.accept()
+        await request
+        print(f"  handshake: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+        started = time.perf_counter()
+        interval = 1 / args.rate
+        for message_id in range(args.count):
+            text = f'{message_id} '
+            send_times[message_id] = time.perf_counter()
+            sender.send(text + 'x' * max(args.payload - len(text), 0))
+            await asyncio.sleep(max(started + (message_id + 1) * interval - time.perf_counter(), 0))
+
+        last_count, last_change = 0, time.perf_counter()
+        while len(delivered) < args.count and time.perf_counter() - last_change < STALL_TIMEOUT:
+            await asyncio.sleep(0.1)
+            if len(delivered) != last_count:
+                last_count, last_change = len(delivered), time.perf_counter()
+        elapsed = max(delivered.values(), default=started) - started
+
+        count = len(delivered)
+        print(f"  delivered: {count} of {args.count}, goodput {count / elapsed:.1f} messages/s "
+              f"({count * args.payload / elapsed / 1024:.1f} KiB/s)")
+        print_latency('  delivery latency', [delivered[i] - send_times[i] for i in delivered])
+        recovered = [delivered[i] - dropped[i] for i in dropped if i in delivered]
+        print(f"  messages with a dropped datagram: {len(dropped)}, recovered {len(recovered)}")
+        print_latency('  recovery latency', recovered)
+
+        sender.disconnect()
+        await asyncio.sleep(0.5)
+        await sender.quit(2)
+        await receiver.quit(2)
+    finally:
+        sender.close()
+        receiver.close()
+
+
+#benchmark that replays the received datagrams of a trace (simp_daemon.py --trace) as fast as possible into a new daemon
+#on the address that recorded it, count is the number of runs
+def bench_replay(args):
+    if args.trace is None:
+        print("The replay benchmark needs a trace, e.g. --trace chat.trace")
+        return
+    address, records = read_trace(args.trace)
+    print(f"Replaying {args.trace} into a new daemon on {address} as fast as possible, {args.count} runs")
+    for run in range(args.count):
+        daemon = start_daemon(address)
+        time.sleep(DAEMON_STARTUP)
+        replayer = Replayer(address)
+        try:
+            sent, elapsed = replayer.replay(records)
+        finally:
+            replayer.close()
+            daemon.kill()
+            daemon.wait()
+        print(f"  run {run + 1}: {sent} datagrams in {elapsed * 1000:.1f} ms ({sent / max(elapsed, 1e-9):.0f} datagrams/s), "
+              f"{replayer.replies} answers")
+
+
+#function to time count calls of function, returns the time of one call in ns
+def time_calls(function, count):
+    start = time.perf_counter_ns()
+    for _ in range(count):
+        function()
+    return (time.perf_counter_ns() - start) / count
+
+
+#benchmark of the MAC of authenticated chats: adding the trailer, checking a valid one and dropping a forged datagram,
+#compared with the full parse of build_header that a forged datagram costs without MACs (its debug output is discarded)
+def bench_mac(args):
+    keys = (os.urandom(simp_daemon.MAC_KEY_SIZE), os.urandom(simp_daemon.MAC_KEY_SIZE))
+    print(f"MAC of {simp_daemon.MAC_SIZE} bytes (HMAC-SHA256), {args.count} datagrams per measurement")
+    with open(os.devnull, 'w') as devnull:
+        for payload in MAC_PAYLOADS:
+            datagram = build_datagram(payload)
+            signed = datagram + simp_daemon.hmac.digest(keys[0], datagram, 'sha256')[:simp_daemon.MAC_SIZE]
+            forged = datagram + bytes(simp_daemon.MAC_SIZE)
+            view, forged_view = memoryview(signed), memoryview(forged)
+            sign = time_calls(lambda: datagram + simp_daemon.hmac.digest(keys[0], datagram, 'sha256')[:simp_daemon.MAC_SIZE], args.count)
+            verify = time_calls(lambda: simp_daemon.verify_mac(view, keys[0]), args.count)
+            reject = time_calls(lambda: simp_daemon.verify_mac(forged_view, keys[0]), args.count)
+            with contextlib.redirect_stdout(devnull):
+                parse = time_calls(lambda: simp_daemon.build_header(view), max(args.count // 10, 1))
+            print(f"  {len(datagram):5} bytes: sign {sign / 1000:6.2f} us, verify {verify / 1000:6.2f} us, "
+                  f"drop forged {reject / 1000:6.2f} us, build_header {parse / 1000:6.2f} us")
+
+
+#benchmark of the protocol state machine without sockets and sleeps: count simulated chats (simp_sim.py) of SIM_MESSAGES messages
+#on a virtual clock, with the impairment arguments. the wall time is the CPU time of the daemons' code and the simulation
+def bench_sim(args):
+    sim_args = argparse.Namespace(**vars(args))
+    sim_args.runs = args.count
+    sim_args.messages = SIM_MESSAGES
+    sim_args.pacing = False
+    sim_args.verbose = False
+    if args.seed is None:
+        sim_args.seed = 0
+    if not args.delay:
+        sim_args.delay = simp_sim.SIM_DELAY
+    simp_sim.run_scenarios('chat', sim_args)
+
+
+#benchmark of the chat history: index count messages of random words (the frequent ones are in most messages, the rare ones in few),
+#then time keyword and username queries against the index and one of them against a scan of the whole file
+def bench_search(args):
+    rng = random.Random(0)
+    vocabulary = [f"word{i}" for i in range(SEARCH_VOCABULARY)]
+    weights = list(itertools.accumulate(1 / (i + 1) for i in range(SEARCH_VOCABULARY)))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'history')
+        history = simp_daemon.HistoryIndex(path)
+        start = time.perf_counter()
+        for first in range(0, args.count, 1000):
+            history.add([(time.time(), f"user{rng.randrange(SEARCH_USERS)}",
+                          ' '.join(rng.choices(vocabulary, cum_weights=weights, k=SEARCH_WORDS)).encode('ascii')) for _ in range(min(1000, args.count - first))])
+        elapsed = time.perf_counter() - start
+        stats = history.stats()
+        print(f"Indexed {stats['messages']} messages in {elapsed:.1f} s ({stats['messages'] / elapsed:.0f} messages/s), {stats['terms']} terms, "
+              f"index {history.memory() / (1 << 20):.1f} MB, file {stats['file_bytes'] / (1 << 20):.1f} MB")
+        queries = ['word0', 'word5000', 'word19999', 'word0 word1', 'word10 word100', 'word100 word5000', '@user7', '@user7 word0', '@user7 word5000']
+        for query in queries:
+            matches, more = history.search(query)
+            took = time_calls(lambda: history.search(query), SEARCH_REPEAT)
+            print(f"  {query!r:20} {len(matches):3}{'+' if more else ' '} matches in {took / 1e6:8.3f} ms")
+        #a search without the index reads every record
+        start = time.perf_counter()
+        found = 0
+        with open(path, 'rb') as f:
+            f.seek(len(simp_daemon.HISTORY_MAGIC))
+            while True:
+                head = f.read(simp_daemon.HISTORY_RECORD.size)
+                if not head:
+                    break
+                _, name_length, length = simp_daemon.HISTORY_RECORD.unpack(head)
+                body = f.read(name_length + length)
+                found += b'word5000' in simp_daemon.HISTORY_TERM.findall(body[name_length:])
+        print(f"  scan of the file for 'word5000': {found} matches in {(time.perf_counter() - start) * 1000:.0f} ms")
+        history.close()
+
+
+BENCHMARKS = {
+    'recv': bench_recv,
+    'impaired': bench_impaired,
+    'replay': bench_replay,
+    'mac': bench_mac,
+    'sim': bench_sim,
+    'search': bench_search,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP benchmarks")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS), help="benchmark to run")
+    parser.add_argument("--count", type=int,
+                        help="number of datagrams (recv: 100000, mac: 100000), messages (impaired: 1000, search: 1000000) or runs (replay: 3, sim: 200)")
+    parser.add_argument("--payload", type=int, default=512, help="payload size of the chat datagrams")
+    parser.add_argument("--rate", type=float, default=200, help="messages per second sent through the proxy (impaired)")
+    parser.add_argument("--trace", metavar="FILE", help="trace replayed by the replay benchmark")
+    add_impairment_arguments(parser)
+    args = parser.parse_args()
+    if args.count is None:
+        args.count = DEFAULT_COUNTS[args.benchmark]
+    BENCHMARKS[args.benchmark](args)
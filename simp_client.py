@@ -1,3 +1,6 @@
+import asyncio
+import os
+import random
 import socket
 import sys
 import threading
@@ -7,9 +10,12 @@ from enum import Enum
 
 USERNAME_LENGHT = 32
 MAX_HEADER_SIZE = 33
-client_name = None
-client_addr = None
-in_chat = False
+DAEMON_PORT = 7778
+REPLY_TIMEOUT = 60  # how long the daemon's answer to a request or a wait is waited for
+QUIT_TIMEOUT = 10
+SEARCH_END_SIZE = 4  # last answer to a search: type, number of matches (2 bytes), 1 if there are older ones (1 byte)
+SEARCH_GRACE = 0.2  # how long matches that arrive after the end of a search are waited for, a lost match is not waited for longer
+MAX_REDIRECTS = 3  # redirects followed by a connect, the daemons of a cluster can disagree for a moment while the ring changes
 
 
 #class to identify message types
@@ -23,6 +29,11 @@ class MessageType(Enum):
     ACCEPT = 6
     DECLINE = 7
     ERROR = 8
+    GROUP = 9
+    BACKPRESSURE = 10
+    RESUME = 11
+    REDIRECT = 12
+    SEARCH = 13
 
     def to_bytes(self):
         if self == MessageType.CHAT:
@@ -41,6 +52,16 @@ class MessageType(Enum):
             return int(6).to_bytes(1, byteorder='big')
         elif self == MessageType.DECLINE:
             return int(7).to_bytes(1, byteorder='big')
+        elif self == MessageType.GROUP:
+            return int(9).to_bytes(1, byteorder='big')
+        elif self == MessageType.BACKPRESSURE:
+            return int(10).to_bytes(1, byteorder='big')
+        elif self == MessageType.RESUME:
+            return int(11).to_bytes(1, byteorder='big')
+        elif self == MessageType.REDIRECT:
+            return int(12).to_bytes(1, byteorder='big')
+        elif self == MessageType.SEARCH:
+            return int(13).to_bytes(1, byteorder='big')
         else:
             return int(8).to_bytes(1,byteorder="big")
 
@@ -74,6 +95,16 @@ def get_message_type(msg):
         return MessageType.ACCEPT
     elif indicator == 7:
         return MessageType.DECLINE
+    elif indicator == 9:
+        return MessageType.GROUP
+    elif indicator == 10:
+        return MessageType.BACKPRESSURE
+    elif indicator == 11:
+        return MessageType.RESUME
+    elif indicator == 12:
+        return MessageType.REDIRECT
+    elif indicator == 13:
+        return MessageType.SEARCH
     return MessageType.ERROR
 
     
@@ -81,7 +112,7 @@ def get_message_type(msg):
 def extract_username(message):
     try:
         username = message[1:USERNAME_LENGHT+1]
-        return username.decode('ascii').rstrip('\x00')
+        return str(username, 'ascii').rstrip('\x00')  # str() decodes memoryviews of receive buffers as well
     except:
         return False
 
@@ -91,10 +122,10 @@ def get_payload(msg):
     try:
         header = build_header(msg)
         if header.type == MessageType.CHAT: 
-            payload = msg[USERNAME_LENGHT+2:].decode('ascii')
+            payload = str(msg[USERNAME_LENGHT+2:], 'ascii')
             return payload
         elif header.type == MessageType.ERROR:
-            payload = msg[1:].decode('ascii')
+            payload = str(msg[1:], 'ascii')
             return payload
     except:
         return False
@@ -114,343 +145,598 @@ def build_header(msg):
     return header
 
 
-#function to get username from input field
-def get_username():
-    global username
-    username = ""
-    while len(username) == 0:    
-        try:
-            username = input('Enter your name or q to quit: ')
-            if len(username) > USERNAME_LENGHT or len(username) == 0:
-                username = ""
-                print('username has to be between 1:32 characters long')
+#function to encode a username to the 32 bytes username field
+def encode_username(username):
+    return username.encode('ascii').ljust(USERNAME_LENGHT, b"\x00")
+
+
+#exception used to leave the client, e.g. when the daemon does not respond anymore
+class ClientClosed(Exception):
+    pass
+
+
+#exception raised by SimpClient when the daemon answers with an error or an unexpected message
+class SimpError(Exception):
+    pass
+
+
+#exception raised by SimpClient.request when the requested user declined, username is the user that declined
+class RequestDeclined(SimpError):
+    def __init__(self, username):
+        super().__init__(f"Connection was not accepted by {username}")
+        self.username = username
+
+
+#datagram protocol of the socket the client talks to its daemon on, every datagram is handed to the client right away
+class DaemonProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.handle_datagram(data, addr)
+
+    #ICMP port unreachable (ConnectionResetError on Windows) means the daemon is gone
+    def error_received(self, exc):
+        self.client.handle_error(exc)
+
+
+#headless client of a daemon, used by the interactive client, bots and load tests. it wraps the client-daemon message types:
+#connect (CONNECTION), request (REQUEST/GROUP), wait (WAIT), accept/decline (ACCEPT/DECLINE), send (CHAT), disconnect (DISCONNECT_REQUEST)
+#search (SEARCH) and quit (DISCONNECTION). chat messages go to on_message(username, text) or, without a callback, to receive().
+#on_chat_end(reason, text) is called when the chat ends ('left', 'confirmed' or 'error').
+#while the daemon's queue is full (BACKPRESSURE) sent messages are held back and they are sent in order on RESUME
+class SimpClient:
+    def __init__(self, daemon_ip, username, local_address=None, on_message=None, on_chat_end=None):
+        self.daemon_address = (daemon_ip, DAEMON_PORT)
+        self.username = username
+        self.local_address = local_address
+        self.on_message = on_message
+        self.on_chat_end = on_chat_end
+        self.transport = None
+        self.replies = asyncio.Queue()  # answers of the daemon outside of a chat, None when the daemon is gone
+        self.messages = asyncio.Queue()  # chat messages (username, text) if there is no on_message callback
+        self.in_chat = False
+        self.chat_ended = asyncio.Event()
+        self.resume = asyncio.Event()  # cleared while the daemon asks the client to stop sending
+        self.resume.set()
+        self.rejected = []  # messages returned by the daemon, sent again on RESUME
+        self.held = []  # messages sent while paused, sent after the rejected ones
+        self.error = None
+        self.redirect = None  # address of the daemon of a cluster that owns the user, the client moves there with its next command
+        self.left = set()  # daemons the client was redirected away from, their late answers are dropped
+        self.sent = 0
+        self.received = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    #function to create the socket, on the given local address or on a random loopback address
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        sock = client_socket(self.local_address)
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: DaemonProtocol(self), sock=sock)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    @property
+    def paused(self):
+        return not self.resume.is_set()
+
+    def send_raw(self, msg):
+        self.transport.sendto(msg, self.daemon_address)
+
+    #function that handles a datagram of the daemon
+    def handle_datagram(self, msg, addr=None):
+        if addr is not None and addr[0] in self.left:
+            return
+        header = build_header(msg)
+        if header.type == MessageType.REDIRECT:
+            self.redirect = str(msg[1:], 'ascii')
+        if not self.in_chat:
+            self.replies.put_nowait(msg)
+            return
+
+        if header.type == MessageType.CHAT:
+            self.received += 1
+            if self.on_message is not None:
+                self.on_message(header.username, get_payload(msg))
+            else:
+                self.messages.put_nowait((header.username, get_payload(msg)))
+
+        elif header.type == MessageType.BACKPRESSURE:
+            self.resume.clear()
+            self.rejected.append(msg[1:])
+
+        elif header.type == MessageType.RESUME:
+            waiting, self.rejected, self.held = self.rejected + self.held, [], []
+            for payload in waiting:
+                self.send_raw(b''.join([MessageType.CHAT.to_bytes(), payload]))
+            self.resume.set()
+
+        elif header.type == MessageType.DISCONNECT_REQUEST:
+            self.end_chat('left')
+        elif header.type == MessageType.DISCONNECTION:
+            self.end_chat('confirmed')
+        elif header.type == MessageType.ERROR:
+            self.end_chat('error', get_payload(msg))
+
+    def handle_error(self, exc):
+        self.error = exc
+        self.replies.put_nowait(None)
+        if self.in_chat:
+            self.end_chat('error', str(exc))
+
+    def end_chat(self, reason, text=None):
+        self.in_chat = False
+        self.resume.set()
+        self.chat_ended.set()
+        if self.on_chat_end is not None:
+            self.on_chat_end(reason, text)
+
+    def start_chat(self):
+        self.in_chat = True
+        self.chat_ended.clear()
+        self.resume.set()
+        self.rejected = []
+        self.held = []
+
+    #function to wait for the next answer of the daemon, raises asyncio.TimeoutError
+    async def reply(self, timeout=REPLY_TIMEOUT):
+        msg = await asyncio.wait_for(self.replies.get(), timeout)
+        if msg is None:
+            raise ClientClosed("Lost connection with daemon. Please restart an app")
+        return msg
+
+    #function to drop the answers nobody waited for, e.g. a late answer to an expired request
+    def drop_replies(self):
+        while not self.replies.empty():
+            if self.replies.get_nowait() is None:
+                raise ClientClosed("Lost connection with daemon. Please restart an app")
+
+    #function to connect to the daemon, returns MessageType.WAIT if the daemon has a pending request (see next_request)
+    #and MessageType.CONNECTION otherwise. a daemon of a cluster that does not own the user redirects the client to the one that does
+    async def connect(self, timeout=REPLY_TIMEOUT):
+        for _ in range(MAX_REDIRECTS + 1):
+            self.send_raw(b"".join([MessageType.CONNECTION.to_bytes(), encode_username(self.username)]))
+            header = build_header(await self.reply(timeout))
+            #the confirmation of the daemon the client moved away from
+            while header.type == MessageType.DISCONNECTION:
+                header = build_header(await self.reply(timeout))
+            if header.type == MessageType.REDIRECT:
+                #the daemon may have taken the client just before its ring changed, it is left like after a move
+                self.switch_daemon()
                 continue
-            elif username.lower() == "q":
-                print("Quitting. Bye...")
-                sys.exit(0)
+            if header.type in (MessageType.CONNECTION, MessageType.WAIT):
+                return header.type
+            if header.type == MessageType.ERROR:
+                raise SimpError("Daemon is already occupied, try another one")
+            raise SimpError('Wrong daemon IP, try another one')
+        raise SimpError("The daemons of the cluster keep redirecting, try again later")
+
+    #function to leave the daemon and to switch to the one the client was redirected to
+    def switch_daemon(self):
+        self.send_raw(MessageType.DISCONNECTION.to_bytes())
+        self.left.add(self.daemon_address[0])
+        self.left.discard(self.redirect)
+        self.daemon_address = (self.redirect, DAEMON_PORT)
+        self.redirect = None
+        self.drop_replies()
+
+    #function to move to the daemon of the cluster that owns the user after the ring changed
+    async def move(self, timeout=REPLY_TIMEOUT):
+        self.switch_daemon()
+        return await self.connect(timeout)
+
+    #function to wait for a request of another user, returns its username or None if no request came in time
+    async def wait(self, timeout=REPLY_TIMEOUT):
+        if self.redirect is not None:
+            await self.move()
+        self.drop_replies()
+        self.send_raw(MessageType.WAIT.to_bytes())
+        try:
+            header = build_header(await self.reply(timeout))
+        except asyncio.TimeoutError:
+            return None
+        #the user belongs to another daemon of the cluster now, the wait starts again there
+        if header.type == MessageType.REDIRECT:
+            return await self.wait(timeout)
+        if header.type != MessageType.REQUEST:
+            raise SimpError('got unexpcted message type')
+        return header.username
+
+    #function to get the username of the next request the daemon passes on, None if no request came in time
+    async def next_request(self, timeout=REPLY_TIMEOUT):
+        try:
+            header = build_header(await self.reply(timeout))
+        except asyncio.TimeoutError:
+            return None
+        if header.type != MessageType.REQUEST:
+            raise SimpError('got unexpcted message type')
+        return header.username
+
+    #function to accept the request, the chat starts
+    def accept(self):
+        self.send_raw(MessageType.ACCEPT.to_bytes())
+        self.start_chat()
+
+    def decline(self):
+        self.send_raw(MessageType.DECLINE.to_bytes())
+
+    #function to request a chat with one or several IPs (the first one to accept gets the chat) or a group chat with all of them,
+    #returns the usernames of the companions. raises RequestDeclined, SimpError if they are busy and asyncio.TimeoutError
+    async def request(self, *ips, group=False, timeout=REPLY_TIMEOUT):
+        if self.redirect is not None:
+            await self.move()
+        self.drop_replies()
+        msg_type = MessageType.GROUP.to_bytes() if group else MessageType.REQUEST.to_bytes()
+        self.send_raw(b''.join([msg_type, ','.join(ips).encode('ascii')]))
+        header = build_header(await self.reply(timeout))
+        #the user belongs to another daemon of the cluster now, the request is sent again from there
+        if header.type == MessageType.REDIRECT:
+            return await self.request(*ips, group=group, timeout=timeout)
+        if header.type == MessageType.ACCEPT:
+            self.start_chat()
+            return header.username.split(', ')
+        elif header.type == MessageType.DECLINE:
+            raise RequestDeclined(header.username)
+        elif header.type == MessageType.ERROR:
+            raise SimpError("User is busy in other chat")
+        raise SimpError('got unexpcted message type')
+
+    #function to send a chat message, it is held back while the daemon's queue is full
+    def send(self, message):
+        if not self.in_chat:
+            raise SimpError("Not in a chat")
+        payload = message.encode('ascii') if isinstance(message, str) else bytes(message)
+        self.sent += 1
+        if self.paused:
+            self.held.append(payload)
+            return
+        self.send_raw(b''.join([MessageType.CHAT.to_bytes(), payload]))
+
+    #function to send many chat messages, it waits while the daemon's queue is full instead of holding them back.
+    #the loop runs after every message, so a BACKPRESSURE stops the batch before more messages are rejected.
+    #returns how many were sent before the chat ended
+    async def send_batch(self, messages):
+        count = 0
+        for message in messages:
+            await asyncio.sleep(0)
+            if self.paused:
+                await self.resume.wait()
+            if not self.in_chat:
+                break
+            self.send(message)
+            count += 1
+        return count
+
+    #function to get the next chat message (username, text), used when there is no on_message callback
+    async def receive(self, timeout=None):
+        return await asyncio.wait_for(self.messages.get(), timeout)
+
+    #function to leave the chat
+    def disconnect(self):
+        self.send_raw(MessageType.DISCONNECT_REQUEST.to_bytes())
+        self.in_chat = False
+        self.resume.set()
+
+    #function to search the chat history of the daemon, a message matches if it has every word of the query and @name matches the messages
+    #of that user. returns the newest matches as (time, username, text), newest first, and True if there are older ones
+    async def search(self, query, timeout=REPLY_TIMEOUT):
+        self.drop_replies()
+        self.send_raw(b''.join([MessageType.SEARCH.to_bytes(), query.encode('ascii')]))
+        matches = []
+        count = None
+        more = False
+        #the matches may arrive after the end of the answer, they are waited for SEARCH_GRACE seconds, the lost ones are left out
+        while count is None or len(matches) < count:
+            try:
+                msg = await self.reply(timeout if count is None else SEARCH_GRACE)
+            except asyncio.TimeoutError:
+                if count is None:
+                    raise
                 break
-            return username.encode('ascii').ljust(USERNAME_LENGHT,b"\x00")
-        except Exception as e:
-            print('Username username has to be between 1:32 latin characters long', e)
-            username = ""
-            continue
-
-
-#function that builds connection with a daemon
-def connect(host) -> str:
-    global server_socket
-    server_socket.settimeout(60)
-    username = get_username()
-    msg_type = MessageType.CONNECTION.to_bytes()
-    msg = b"".join([msg_type,username])
-    print(f"requesting connection to {host}")
+            header = build_header(msg)
+            if header.type == MessageType.REDIRECT:
+                continue
+            if header.type == MessageType.ERROR:
+                raise SimpError(get_payload(msg))
+            if header.type != MessageType.SEARCH:
+                raise SimpError('got unexpcted message type')
+            if len(msg) == SEARCH_END_SIZE:
+                count = int.from_bytes(msg[1:3], byteorder='big')
+                more = bool(msg[3])
+            else:
+                timestamp = int.from_bytes(msg[USERNAME_LENGHT + 1:USERNAME_LENGHT + 9], byteorder='big') / 1000
+                matches.append((timestamp, extract_username(msg), str(msg[USERNAME_LENGHT + 9:], 'ascii')))
+        matches.sort(key=lambda match: match[0], reverse=True)
+        return matches, more
+
+    #function to disconnect from the daemon, returns True when the daemon confirmed it
+    async def quit(self, timeout=QUIT_TIMEOUT):
+        self.drop_replies()
+        self.send_raw(MessageType.DISCONNECTION.to_bytes())
+        while True:
+            try:
+                msg = await self.reply(timeout)
+            except asyncio.TimeoutError:
+                return False
+            header = build_header(msg)
+            if header.type == MessageType.DISCONNECTION:
+                return True
+            elif header.type == MessageType.ERROR:
+                self.send_raw(MessageType.DISCONNECTION.to_bytes())
 
+
+#function that reads stdin line by line into a queue, as a stream where the platform supports it (pipes and terminals on Linux and macOS)
+#and with a blocking reader thread otherwise (Windows console, files). None is queued at the end of the input
+async def read_stdin(lines):
+    loop = asyncio.get_running_loop()
     try:
-        server_socket.sendto(msg, (host, 7778))
-        # server_socket.settimeout(3)
-
-        reply, _ = server_socket.recvfrom(1024)
-        header = build_header(reply)
-        #if message type is CONNECTION, proceed to menu
-        if header.type == MessageType.CONNECTION:
-            print("Connected to the daemon, entering the menu...")
-            menu()
-        #if message type is WAIT,decide on accepting or declining connection
-        elif header.type == MessageType.WAIT:
-            print("Connected to the daemon")
-            pending(host)
-            menu()
-        #if message type is ERROR then the daemon is already occupied
-        elif header.type == MessageType.ERROR:
-            print("Daemon is already occupied, try another one")
-            sys.exit(0)
-        else:
-            print('Wrong daemon IP, try another one')
-            sys.exit(0)
-    except socket.timeout:
-        print('no reply from daemon,try another one')
-        sys.exit(0)
-   
-
-#functon that handles decision to accept or decline connection
-def pending(host):
-    global server_socket, t2,in_chat
-    try:
-        print("For next 60 seconds will be opened for connections")
-        server_socket.settimeout(60)
-        reply, addr = server_socket.recvfrom(1024)
-        header = build_header(reply)
-        #if message type is REQUEST, make desicion and send to the daemon
-        if header.type == MessageType.REQUEST:
-            username = header.username
-            decision = ""
-            print(f"Connection request from {username}")
-            while decision not in ('y', 'yes', 'ye', 'n', 'no', 'nein'):
-                decision = input("Accept Connection Y/N: ").lower()
-                #if the decision is yes send ACCEPT message
-                if decision == 'y' or decision == 'yes' or decision == 'ye':
-                    msg_type = MessageType.ACCEPT.to_bytes()
-                    server_socket.sendto(msg_type, addr)
-                    print(f'Connection with {username} established')
-                    in_chat = True
-                    t2 = threading.Thread(target=receive_messages)
-                    t2.start()
-                    
-                    send_messages(host)
-                    
-                    return
-                # if the decision is no send DECLINE message
-                elif decision in ('n', 'no', 'nein'):
-                    msg_type = MessageType.DECLINE.to_bytes()
-                    server_socket.sendto(msg_type, addr)
-                    print('Conncection declined, going back to main menu')
-                    return
-                
-    except socket.timeout:
-        print("No requests came, going back to menu")
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except (NotImplementedError, ValueError, OSError):
+        threading.Thread(target=read_stdin_blocking, args=(loop, lines), daemon=True).start()
         return
-    
-    except ConnectionResetError:
-        print("Lost connection with daemon. Please restart an app")
-        sys.exit(0)
+    while True:
+        line = await reader.readline()
+        if not line:
+            await lines.put(None)
+            return
+        await lines.put(line.decode('ascii', errors='replace').rstrip('\r\n'))
 
 
-#function that waits for the connection
-def wait_for_connection(host):
-    global server_socket, t2, in_chat
-    try:
-        print("For next 60 seconds will be opened for connections")
-        server_socket.settimeout(60)
-        #send WAIT message to daemon
-        msg_type=MessageType.WAIT.to_bytes()
-        server_socket.sendto(msg_type,(host,7778))
-        reply,addr = server_socket.recvfrom(1024)
-        header = build_header(reply)
-
-        # if message type is REQUEST, make desicion and send to the daemon
-        if header.type == MessageType.REQUEST:
-            username = header.username
-            decision = ""
-            print(f"Connection request from {username}")
-            while decision not in ('y','yes','ye','n','no','nein'):
-                decision = input("Accept Connection Y/N: ").lower()
-                # if the decision is yes send ACCEPT message
-                if decision == 'y' or decision == 'yes' or decision == 'ye':
-                    msg_type = MessageType.ACCEPT.to_bytes()
-                    server_socket.sendto(msg_type,addr)
-                    print(f'Connection with {username} established')
-                    in_chat = True
-                    t2 = threading.Thread(target=receive_messages)
-                    t2.start()
-                    
-                    send_messages(host)
-                    
-                    return
-                # if the decision is no send DECLINE message
-                elif decision in ('n','no','nein'):
-                    msg_type= MessageType.DECLINE.to_bytes()
-                    server_socket.sendto(msg_type,addr)
-                    print('Conncection declined, going back to main menu')
-                    return
-        else: 
-            print('got unexpcted message type, going back to menu')
-            return
-    except socket.timeout:
-        print("No requests came, going back to menu")
-        return
-    except ConnectionResetError:
-        print("Lost connection with daemon. Please restart an app")
-        sys.exit(0)
-        
+#function of the reader thread, the lines are passed to the loop of the client
+def read_stdin_blocking(loop, lines):
+    for line in sys.stdin:
+        loop.call_soon_threadsafe(lines.put_nowait, line.rstrip('\r\n'))
+    loop.call_soon_threadsafe(lines.put_nowait, None)
 
-#function that asks to choose option
-def menu():
-    
-    while True:
-        print("\nYou can:")
-        print("1. Start a new chat")
-        print("2. Wait for requests")
-        print("q. Quit")
-        option = input("\nChoose an option:").strip()
 
-        if option == "1":
-            request_chat(daemon_ip)
+#interactive chat client, the user interface on top of SimpClient. the user input comes from a queue of lines,
+#chat messages are printed as soon as they arrive
+class ChatClient:
+    def __init__(self, daemon_ip, lines):
+        self.daemon_ip = daemon_ip
+        self.lines = lines
+        self.client = SimpClient(daemon_ip, None, on_message=self.show_message, on_chat_end=self.show_chat_end)
 
-        elif option == "2":
-            wait_for_connection(daemon_ip)
+    def show_message(self, username, text):
+        print(username, ">", text)
 
-        elif option.lower() == "q":
-            quit_daemon(daemon_ip)
+    def show_chat_end(self, reason, text):
+        if reason == 'left':
+            print("companion left the chat, returning to menu")
+        elif reason == 'confirmed':
+            print("received confirmation")
         else:
-            print("Invalid option. Please try again.")
-            continue
+            print('got an error message from the server')
+            print(text)
+
+    #function to read a line of user input, the end of the input quits the client
+    async def input(self, prompt=''):
+        if prompt:
+            print(prompt, end='', flush=True)
+        line = await self.lines.get()
+        if line is None:
+            raise ClientClosed("End of input. Bye...")
+        return line
+
+    #function to get username from input field
+    async def get_username(self):
+        while True:
+            username = await self.input('Enter your name or q to quit: ')
+            if username.lower() == "q":
+                raise ClientClosed("Quitting. Bye...")
+            try:
+                if 0 < len(username.encode('ascii')) <= USERNAME_LENGHT:
+                    return username
+            except UnicodeEncodeError:
+                pass
+            print('username has to be between 1:32 latin characters long')
+
+    #function that builds connection with a daemon and runs the menu
+    async def connect(self):
+        await self.client.open()
+        try:
+            self.client.username = await self.get_username()
+            print(f"requesting connection to {self.daemon_ip}")
+            try:
+                state = await self.client.connect()
+            except asyncio.TimeoutError:
+                raise ClientClosed('no reply from daemon,try another one')
+            except SimpError as e:
+                raise ClientClosed(str(e))
+            if self.client.daemon_address[0] != self.daemon_ip:
+                print(f"{self.client.username} is served by the daemon {self.client.daemon_address[0]} of the cluster")
+            #if message type is WAIT,decide on accepting or declining connection
+            if state == MessageType.WAIT:
+                print("Connected to the daemon")
+                await self.pending()
+            else:
+                print("Connected to the daemon, entering the menu...")
+            await self.menu()
+        finally:
+            self.client.close()
+
+    #function that asks to choose option
+    async def menu(self):
+        while True:
+            print("\nYou can:")
+            print("1. Start a new chat")
+            print("2. Wait for requests")
+            print("3. Start a group chat")
+            print("4. Search the chat history")
+            print("q. Quit")
+            option = (await self.input("\nChoose an option:")).strip()
+
+            if option == "1":
+                await self.request_chat()
+            elif option == "2":
+                await self.wait_for_connection()
+            elif option == "3":
+                await self.request_chat(group=True)
+            elif option == "4":
+                await self.search_history()
+            elif option.lower() == "q":
+                await self.quit_daemon()
+                return
+            else:
+                print("Invalid option. Please try again.")
 
+    #functon that handles decision to accept or decline connection, when the daemon has a pending request
+    async def pending(self):
+        print("For next 60 seconds will be opened for connections")
+        await self.decide(self.client.next_request())
 
-#function to request the chat
-def request_chat(host):
-    global server_socket,t2,in_chat
-    while True:
-        ip = input("Provide IP for chat request: ").encode()
+    #function that waits for the connection
+    async def wait_for_connection(self):
+        print("For next 60 seconds will be opened for connections")
+        await self.decide(self.client.wait())
+
+    #function to let the user accept or decline the request the daemon passes on
+    async def decide(self, request):
         try:
-            #send REQUEST message to daemon
-            msg_type = MessageType.REQUEST.to_bytes()
-            msg = b''.join([msg_type,ip])
-            server_socket.sendto(msg,(host, 7778))
-            server_socket.settimeout(60)
-            print(f'Connection request to {ip.decode()} was send. Waiting for 60 seconds to reply')
-            reply,_ = server_socket.recvfrom(1024)
-            header = build_header(reply)
-            #if receive message is ACCEPT start receiving messages and send message with host and username
-            if header.type == MessageType.ACCEPT:
-                print(f'successfully connected to {header.username}')
-                in_chat = True
-                t2 = threading.Thread(target=receive_messages)
-                t2.start()
-                
-                send_messages(host)
-                
+            username = await request
+        except SimpError as e:
+            print(f'{e}, going back to menu')
+            return
+        if username is None:
+            print("No requests came, going back to menu")
+            return
+        print(f"Connection request from {username}")
+        while True:
+            decision = (await self.input("Accept Connection Y/N: ")).lower()
+            # if the decision is yes send ACCEPT message
+            if decision in ('y', 'yes', 'ye'):
+                self.client.accept()
+                print(f'Connection with {username} established')
+                await self.chat()
                 return
-            #if received message is DECLINE proceed to menu
-            elif header.type == MessageType.DECLINE:
-                print(f"Connection was not accepted by {header.username}")
-                print("try again later")
-                return 
-            
-            elif header.type == MessageType.ERROR:
-                print(f"User is busy in other chat")
+            # if the decision is no send DECLINE message
+            elif decision in ('n', 'no', 'nein'):
+                self.client.decline()
+                print('Conncection declined, going back to main menu')
                 return
-            else: raise ValueError
-            
-        except socket.timeout:
-            print(f"Timeout expired, no reply from {ip}, try again later")
-            return
-        
-        except ConnectionResetError:
-            print("Lost connection with daemon. Please restart an app")
-            sys.exit(0)
-
 
-#function to send messages to the daemon
-def send_messages(host):
-    global server_socket, username,in_chat
-    
-    while in_chat:
-        
+    #function to request the chat, for a group chat every requested user that accepts joins the chat
+    async def request_chat(self, group=False):
+        #several IPs separated by commas are requested at once, the first one to accept gets the chat
+        ip = await self.input("Provide IP for chat request (several IPs separated by commas): ")
+        print(f'Connection request to {ip} was send. Waiting for 60 seconds to reply')
         try:
-            #if client is the one who is going to send the message, he is the one if he was the one requesting the chat,but not waiting
-
-            msg = input()
-            #if message is q send DISCONNECT_REQUEST to daemon and stop sending messages
-            if msg.lower() == "q":
-                msg_type = MessageType.DISCONNECT_REQUEST.to_bytes()     
-                server_socket.sendto(msg_type,(host,7778))
-                print("Disconnect request sent...")
-                in_chat = False
-
-                return
-            msg = msg.encode('ascii')
-                
-            msg_type = MessageType.CHAT.to_bytes()
-            msg = b''.join([msg_type,msg])
-            server_socket.sendto(msg,(host,7778))
-            continue
+            usernames = await self.client.request(ip, group=group)
         except UnicodeEncodeError:
             print("only latin characters")
-            continue
-        except ConnectionResetError:
-            print("Lost connection with daemon. Please restart an app")
-            sys.exit(0)
-    else:
-        return
-    
+            return
+        except asyncio.TimeoutError:
+            print(f"Timeout expired, no reply from {ip}, try again later")
+            return
+        except RequestDeclined as e:
+            print(e)
+            print("try again later")
+            return
+        except SimpError as e:
+            print(e)
+            return
+        print(f'successfully connected to {", ".join(usernames)}')
+        await self.chat()
 
-#function to receive a message
-def receive_messages():
-    global server_socket, username, in_chat
-    server_socket.settimeout(1)
-    
-    while True:
-        if in_chat:
-            try:
-                msg,_ = server_socket.recvfrom(1024)
-                header = build_header(msg)
-                #if message type is CHAT print message
-                if header.type == MessageType.CHAT:
-                    print(header.username,">",get_payload(msg))
-                    continue
-
-                #if message type is DISCONNECT_REQUEST proceed to menu and stop receiving mesages
-                elif header.type == MessageType.DISCONNECT_REQUEST:
-                    print("companion left the chat, returning to menu")
-                    print("type anything to be able to choose an option")
-                    in_chat = False
-                    return
-                    menu()
+    #function to chat: the lines of the user are sent to the daemon until the user types q or the chat ends on the other side
+    async def chat(self):
+        ended = asyncio.ensure_future(self.client.chat_ended.wait())
+        try:
+            while self.client.in_chat:
+                line = asyncio.ensure_future(self.input())
+                await asyncio.wait([line, ended], return_when=asyncio.FIRST_COMPLETED)
+                if not line.done():
+                    line.cancel()
                     break
-                #if message type is DISCONNECTION proceed to menu and stop receiving mesages
-                elif header.type == MessageType.DISCONNECTION:
-                    print("received confirmation")
-                    in_chat = False
-                    return
-                #if message type is ERROR disconnect person from chat
-                elif header.type == MessageType.ERROR:
-                    print('got an error message from the server')
-                    print(get_payload(msg))
-                    in_chat = False
-                    return
-
-            except socket.timeout:
-                continue
-
-            except ConnectionResetError:
-                print("Daemon does not respond, forcibly quitting... an application")
-                sys.exit(0)
-        else:
+                msg = line.result()
+                #if message is q send DISCONNECT_REQUEST to daemon and stop sending messages
+                if msg.lower() == "q":
+                    self.client.disconnect()
+                    print("Disconnect request sent...")
+                    break
+                #the daemon's outbound queue is full, the message is sent when it resumes
+                if self.client.paused:
+                    print("Daemon is busy, the message is sent when it resumes")
+                try:
+                    self.client.send(msg)
+                except UnicodeEncodeError:
+                    print("only latin characters")
+                except SimpError:
+                    break
+        finally:
+            ended.cancel()
+        if self.client.error is not None:
+            raise ClientClosed("Daemon does not respond, forcibly quitting... an application")
+
+    #function to search the chat history of the daemon and to print the newest matches
+    async def search_history(self):
+        query = await self.input("Words to search for (@name for the messages of a user): ")
+        try:
+            matches, more = await self.client.search(query)
+        except UnicodeEncodeError:
+            print("only latin characters")
+            return
+        except asyncio.TimeoutError:
+            print("No reply from the daemon, try again later")
             return
+        except SimpError as e:
+            print(e)
+            return
+        if not matches:
+            print("No messages found")
+        for timestamp, username, text in matches:
+            print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))} {username}: {text}")
+        if more:
+            print("There are older messages, add words to narrow the search")
+
+    #function to quite the daemon
+    async def quit_daemon(self):
+        if await self.client.quit():
+            print("Daemon notified.Disconnecting from daemon.")
+        else:
+            print("Timeout expired, forcibly clossing the connection with daemon.")
 
 
-#function to quite the daemon
-def quit_daemon(host) -> None:
-    global server_socket,daemon_ip
-    #send DISCONNECTION message to the daemon
-    msg_type = MessageType.DISCONNECTION.to_bytes()
-    server_socket.sendto(msg_type,(host,7778))
-    server_socket.settimeout(10)
-    while True:
-        try:
-            msg, addr = server_socket.recvfrom(1024)
-            header = build_header(msg)
-            print('received confirmation from daemon',msg)
-            #if mesage type is DISCONNECTION quit the daemon
-            if header.type == MessageType.DISCONNECTION:
-                print("Daemon notified.Disconnecting from daemon.")
-                sys.exit(0)
-            elif header.type == MessageType.ERROR:
-                payload = get_payload(msg)
-                print(f"Error occured: {payload},trying again")
-                server_socket.sendto(msg_type,host)
-                continue
-                
-        except socket.timeout:
-            print("Timeout expired, forcibly clossing the connection with daemon.")
-            sys.exit(0)
-        
-        except ConnectionResetError:
-            print("Daemon does not respond, forcibly quitting...")
-            sys.exit(0)
+#function to create the socket of a client, every client on this machine gets its own loopback address on port 7778 unless one is given
+def client_socket(local_address=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if local_address is None:
+        local_address = ('127.0.'+str(random.randint(1,192))+'.'+str(time.time_ns())[random.randint(10,15)], DAEMON_PORT) #generate random ip
+    sock.bind(local_address)
+    return sock
 
 
+#function that runs the interactive client until the user quits
+async def run(daemon_ip):
+    lines = asyncio.Queue()
+    client = ChatClient(daemon_ip, lines)
+    stdin_task = asyncio.ensure_future(read_stdin(lines))
+    try:
+        await client.connect()
+    except ClientClosed as e:
+        print(e)
+    finally:
+        stdin_task.cancel()
+        #the stdin stream made the terminal non-blocking, it is shared with the shell
+        if hasattr(os, 'set_blocking') and not sys.stdin.closed:
+            os.set_blocking(sys.stdin.fileno(), True)
+
 
 if __name__ == "__main__":
-    import random
-    global server_socket,daemon_ip
-    
     if len(sys.argv) != 2:
         print("Usage: python client.py <daemon_ip>")
         sys.exit(1)
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(('127.0.'+str(random.randint(1,192))+'.'+str(time.time_ns())[random.randint(10,15)], 7778)) #generate random ip
-    daemon_ip = sys.argv[1]
-
-    connect(daemon_ip)
+    try:
+        asyncio.run(run(sys.argv[1]))
+    except KeyboardInterrupt:
+        pass
@@ -1,8 +1,26 @@
+import os
+import re
 import sys
+import atexit
 import socket
+import struct
+import select
+import signal
+import zlib
+import hmac
+import bisect
+import hashlib
+import json
+import base64
+import argparse
+import ipaddress
+import multiprocessing
+from multiprocessing import shared_memory
 from enum import Enum
 import time
 import threading
+from array import array
+from collections import deque
 from simp_client import build_header as build_client_header
 from simp_client import MessageType
 
@@ -14,12 +32,151 @@ SEQUENCE = 1
 MAX_USERNAME_SIZE = 32
 LENGTH_FIELD_SIZE = 4
 MAX_PAYLOAD_SIZE = 2048
+SYN_TIMEOUT = 30  # overall deadline of a connection request
+SYN_RETRANSMIT_INITIAL = 0.5  # first SYN retransmission timeout, doubled after every retransmission
+SYN_RETRANSMIT_MAX = 8
+UNREACHABLE_TTL = 60  # how long a daemon that did not answer stays in the negative cache
+MAX_UNREACHABLE = 1024  # hosts in the negative cache, the least recently used are evicted
+MAX_PENDING_REQUESTS = 32  # requests of other daemons kept until a client decides, the oldest are evicted
+MAX_REQUEST_HOSTS = 1024  # hosts a client can request at once, address ranges included
+SOURCE_RATE = 100  # datagrams per second an unknown source address can send to a port of the daemon
+SOURCE_BURST = 200
+MAX_SOURCES = 4096  # token buckets of source addresses per port, the least recently seen are evicted
+SOURCE_ENTRY_SIZE = 300  # estimated bytes of the token bucket of a source
+ERROR_REPLY_RATE = 1  # error replies per second to one source address
+ERROR_REPLY_BURST = 5
+ERROR_REPLY_LIMIT = 50  # error replies per second to all sources
+REFUSED_TTL = 10  # how long a daemon that declined or was busy stays in the negative cache
+CLUSTER_PORT = 7779  # port the daemons of a cluster announce themselves to each other on
+CLUSTER_VNODES = 64  # points of a daemon on the hash ring of the cluster, more points spread the users more evenly
+CLUSTER_ANNOUNCE_INTERVAL = 2  # how often a daemon announces itself to the other daemons of the cluster
+CLUSTER_TIMEOUT = 3 * CLUSTER_ANNOUNCE_INTERVAL  # a daemon that did not announce itself for that long is taken off the ring
+MAX_CLUSTER_PROBES = 64  # daemons named in JOINs that are probed at once, the others are probed once these are answered or expired
+RELAY_HEADER_SIZE = 34  # 1 byte - datagram type, 1 byte - relay operation, 32 bytes - username
+RELAY_REGISTER_INTERVAL = 10  # how often a daemon renews its route at the hub
+RELAY_REPORT_INTERVAL = 10  # how often the hub reports the route throughput
+PEER_TABLE_SIZE = 4096  # entries of the shared peer address -> worker table of the worker processes
+PEER_TABLE_TOMBSTONES = PEER_TABLE_SIZE // 8  # deleted entries of the peer table above which it is rebuilt without them
+RECV_BUFFER_SIZE = 4096  # receive buffer of the pool, the largest datagram (header + payload + relay envelope) has to fit
+RECV_RING_SIZE = 64  # buffers of a receive pool, at most half of them are filled by one drain
+SEQ_SPACE = 256  # chat datagrams of a session are numbered modulo 256
+MAX_WINDOW = 64  # largest congestion window (datagrams in flight), less than half of the sequence space
+INITIAL_WINDOW = 2
+MIN_WINDOW = 1
+RECV_WINDOW = 64  # datagrams a daemon buffers per companion to deliver them in order
+INITIAL_RTO = 1.0  # retransmission timeout before the first RTT sample
+MIN_RTO = 0.2
+MAX_RTO = 5
+MAX_RETRANSMISSIONS = 5  # a datagram is given up after that many retransmissions
+FAST_LOSS_THRESHOLD = 3  # a datagram is lost when that many datagrams sent after it were acknowledged
+REORDER_TIMEOUT = 20  # how long a gap in the received sequence is waited for before the later datagrams are delivered
+PACING_GAIN = 1.25  # pacing rate = gain * congestion window / smoothed RTT
+PACING_BURST = 4  # datagrams that can be sent at once with pacing
+OUTBOUND_QUEUE_SIZE = 128  # chat messages queued per companion before the client gets BACKPRESSURE
+RESUME_LEVEL = 32  # a paused client gets RESUME when every queue is down to that many messages
+FLUSH_TIMEOUT = 10  # how long the queued messages are sent before a FIN ends the chat
+FIN_TIMEOUT = 20  # how long the FIN is retransmitted without a FIN+ACK, and a repeated FIN of a companion that left is answered
+LINGER_INTERVAL = 0.1  # how often the receive thread checks if the main thread needs the daemon socket while it lingers after a chat
+INTERACTIVE_SIZE = 256  # chat messages up to that many bytes are interactive, longer ones are bulk and wait for them
+SEND_QUANTUM = MAX_PAYLOAD_SIZE  # bytes a session of weight 1 can send per round of the sender thread (deficit round robin)
+HANDOFF_MAGIC = b'SIMPHOF1'  # start of a handoff, followed by the length of the snapshot (4 bytes), the sockets are passed with it
+HANDOFF_TIMEOUT = 5  # how long the old daemon waits for the new one to confirm a handoff
+CHECKPOINT_MAGIC = b'SIMPCKP1'  # start of a checkpoint file, followed by records
+CHECKPOINT_RECORD = struct.Struct('!BII')  # record type, length and crc32 of the record that follows
+CHECKPOINT_SESSION = struct.Struct('!BddHdddI5IHH')  # next seq, cwnd, ssthresh, rwnd, srtt, rttvar, rto, sends, 5 counters, in flight, queued
+CHECKPOINT_IN_FLIGHT = struct.Struct('!BddBBIH')  # seq, age of the first and the last send, retransmissions, later acks, send order, length
+CHECKPOINT_WINDOW = struct.Struct('!BH')  # expected seq, buffered datagrams
+CHECKPOINT_BUFFERED = struct.Struct('!BdH')  # seq, age, length of the payload
+CHECKPOINT_CLIENTS = 1  # record of the client and the companions
+CHECKPOINT_SESSION_STATE = 2  # record of the send window of a companion
+CHECKPOINT_SESSION_GONE = 3
+CHECKPOINT_WINDOW_STATE = 4  # record of the receive window of a companion
+CHECKPOINT_WINDOW_GONE = 5
+CHECKPOINT_INTERVAL = 0.5  # how often the changed sessions are written, one fsync for all of them
+CHECKPOINT_COMPACT_SIZE = 1 << 20  # the checkpoint file is rewritten with the current state only when it gets bigger
+MAC_SIZE = 16  # MAC trailer of the datagrams of an authenticated chat, truncated HMAC-SHA256
+MAC_KEY_SIZE = 32  # session keys are HMAC-SHA256 digests
+MAC_NONCE_SIZE = 16  # random payload of the SYN and the SYN+ACK, the session keys are derived from both
+ERROR_CODE_SIZE = 2  # payload of a binary error reply, the error mask of the header (one bit per ErrorType)
+TRACE_MAGIC = b'SIMPTRC1'  # start of a trace file, followed by the length (2 bytes) and the address of the daemon
+TRACE_RECORD = struct.Struct('!QB4sHH')  # monotonic time (ns), flags, ip, port, length of the datagram that follows
+TRACE_OUT = 1  # flag of a sent datagram, received otherwise
+TRACE_CLIENT = 2  # flag of a datagram of the client socket, the daemon socket otherwise
+TRACE_FLUSH_INTERVAL = 1  # the trace file is flushed at most that often
+SPAN_BUCKETS = 40  # power of two buckets of the span histograms, the last one counts everything from 2^39 ns (9 minutes)
+SPAN_EXPORT_INTERVAL = 5  # how often the span histograms are written to the file
+PROFILE_INTERVAL = 0.005  # how often the sampling profiler samples the stacks of the threads
+PROFILE_TOP = 10  # functions printed when the sampling profiler stops
+MEMORY_BUDGET = 64  # default memory budget of the tables, buffers, caches and queues of the daemon in MB
+MEMORY_CHECK_INTERVAL = 1  # how often the structures are measured against the budget
+MEMORY_HIGH = 0.9  # share of the budget above which the queues and receive windows stop growing (memory pressure)
+MEMORY_LOW = 0.75  # share of the budget below which the memory pressure ends
+ENTRY_OVERHEAD = 100  # estimated bytes of a table entry besides its payload (key, tuple, slot of the dict)
+HISTORY_MAGIC = b'SIMPHIS1'  # start of a history file, followed by records
+HISTORY_RECORD = struct.Struct('!QBH')  # time (ms), length of the username and of the message that follow
+HISTORY_TERM = re.compile(rb'[a-z0-9]+')  # words of the lowercased messages the history is indexed by
+SEARCH_LIMIT = 20  # matching messages a search sends to the client, the newest ones
 
 clients = []
 messages = []
-pending_requests = []
-ack_received = {}
+pending_requests = []  # (header, address, received at) of the SYNs that wait for a client, oldest first
+sessions = {}  # daemon address -> congestion control of the chat datagrams sent to it
+receive_windows = {}  # daemon address -> receive window of the chat datagrams received from it
+unreachable = {}  # host -> (expiry, reason), negative reachability cache in least recently used order
 ack_lock = threading.Lock()
+flow_changed = threading.Condition(ack_lock)  # notified when messages are queued or acknowledgements and losses open a window
+client_paused = False  # the client got BACKPRESSURE and waits for RESUME
+deferred_client_message = None  # command of the client that arrived when the chat had already ended, handled by the next receive
+pacing = False  # pace the chat datagrams over the RTT with a token bucket
+metrics_interval = None  # print the metrics every that many seconds
+trace_path = None  # file every datagram of the daemon is recorded in
+trace_writer = None
+mac_secret = None  # secret shared by the daemons, the chats get a MAC on every datagram if it is set
+session_keys = {}  # daemon address -> (send key, receive key) of the MAC of the chat with it
+handshake_keys = {}  # daemon address -> keys derived in a handshake, used once the chat starts
+pending_syns = {}  # daemon address -> SYN of a pending request, its nonce is needed when it is accepted
+closed_chats = {}  # daemon address -> (expiry, FIN+ACK, MAC keys) of a companion that sent a FIN, a repeated FIN gets the FIN+ACK again
+t1 = None  # thread receiving the datagrams of the companions during a chat
+lingering = False  # the receive thread goes on answering repeated FINs after the chat, until the main thread receives from the daemon socket
+linger_stopped = False  # the main thread needs the daemon socket, the receive thread stops lingering
+lingered = deque()  # other datagrams the lingering receive thread got, the main thread receives them first
+mac_rejected = 0  # datagrams of companions dropped because of a missing or wrong MAC
+debug = False  # print the header fields of every datagram
+daemon_admission = None  # token buckets of the sources of the daemon port, created by start_server
+client_admission = None  # token buckets of the sources of the client port
+error_replies = None  # token buckets of the error replies per source, with the limit of all error replies
+checkpoint_path = None  # file the sessions are checkpointed to, restored after a crash
+checkpoint_interval = CHECKPOINT_INTERVAL
+checkpointer = None
+peer_weights = {}  # peer name (ip or @username) -> share of the sender thread the session with it gets, 1 by default
+memory_limit = MEMORY_BUDGET << 20  # memory budget in bytes
+memory_budget = None  # measures the structures and trims the caches, created by start_server
+send_class_waits = None  # per send class histograms of the time a datagram waited until it was sent, created by start_server
+handoff_path = None  # unix socket a new daemon process takes the sockets and the sessions over from
+span_path = None  # file the per-stage latency histograms are written to
+daemon_timeout = None  # timeout of the receives of the daemon socket, set with set_daemon_timeout
+history_path = None  # file the delivered chat messages are appended to, the client searches them with SEARCH
+history = None  # inverted index of the history file, created by start_history
+history_queue = deque()  # (time, username, message) of the delivered messages the history thread has not written yet
+history_ready = None  # condition the history thread waits on for history_queue, created by start_history
+history_thread = None  # thread that writes history_queue to the file, created by start_history
+history_stopped = False  # set to stop the history thread before a handoff, the queue is then written by flush_history
+spans = None  # per-stage latency histograms, recorded if span_path is set
+profile_path = None  # file the sampling profiler writes the collapsed stacks to, SIGUSR2 starts and stops it
+multicast_group = None
+daemon_pool = None  # receive buffer pools of the sockets, created by start_server and join_multicast
+client_pool = None
+multicast_pool = None
+hub_address = None  # address of the relay hub, if the daemon reaches other daemons through it
+cluster_seeds = None  # daemons of the cluster given on the command line, the ring is formed by announcing to them
+cluster = None  # hash ring of the usernames over the daemons of the cluster, created by start_cluster
+cluster_targets = set()  # seeds of the cluster, they get the JOINs until they join
+cluster_probes = {}  # daemon named in the JOIN of a member -> when it was probed with a JOIN, it is probed again after CLUSTER_TIMEOUT
+control_plane = None  # shared state of the worker processes, if the daemon runs several of them
+worker_id = None
+waiting_for_peer = False
+handshake_peers = set()  # daemons a handshake is in progress with
+claimed_peers = set()  # daemons this worker is registered for in the control plane
 disconnected = True
 
 
@@ -28,12 +185,36 @@ class DatagramType(Enum):
     CONTROL = 0
     CHAT = 1
     UNKNOWN = 2
+    RELAY = 3
 
     def to_bytes(self):
         if self == DatagramType.CONTROL:
             return int(1).to_bytes(1, byteorder='big')
         elif self == DatagramType.CHAT:
             return int(2).to_bytes(1, byteorder='big')
+        elif self == DatagramType.RELAY:
+            return int(3).to_bytes(1, byteorder='big')
+
+
+# relay operation class used to identify the operation of a relay envelope (\x03 datagram type) exchanged with the hub,
+# the envelope is followed by the username of the destination (daemon -> hub) or of the source (hub -> daemon) and the original datagram
+class RelayOperation(Enum):
+    FORWARD = 1
+    REGISTER = 2
+    UNREGISTER = 8
+
+    def to_bytes(self):
+        return int(self.value).to_bytes(1, byteorder='big')
+
+
+# cluster operation class used to identify the announcements the daemons of a cluster exchange on CLUSTER_PORT,
+# a JOIN is followed by the addresses of the daemons the sender knows separated by commas
+class ClusterOperation(Enum):
+    JOIN = 1
+    LEAVE = 2
+
+    def to_bytes(self):
+        return int(self.value).to_bytes(1, byteorder='big')
 
 
 # operation type class used to identify the operation of the control datagram type,
@@ -58,6 +239,11 @@ class OperationType(Enum):
             return int(9).to_bytes(1, byteorder="big")
 
 
+# operation bytes a control datagram can carry, the handshake and the end of a chat combine two operations (SYN | ACK, FIN | ACK)
+KNOWN_OPERATIONS = frozenset([operation.value for operation in OperationType if operation != OperationType.UNKNOWN]
+                             + [OperationType.SYN.value | OperationType.ACK.value, OperationType.FIN.value | OperationType.ACK.value])
+
+
 # error type used to identify errors found in datagrams
 class ErrorType(Enum):
     WRONG_PAYLOAD_SIZE = 0  # payload_size field in header does not match the actual payload size
@@ -72,24 +258,962 @@ class ErrorType(Enum):
     WRONG_SEQUENCE_NUMBER = 9  # SEQUENCE NUMBER IS NOT IN ("\x00,\x01")
     WRONG_PAYLOAD = 10  # payload couldn't be extracted
 
+    # bit of the error in the error mask of a header and in the binary error code on the wire
+    @property
+    def bit(self):
+        return 1 << self.value
+
+
+# send class enum, the order the daemon sends its datagrams in. control datagrams (ACK, FIN+ACK, error replies) are never queued,
+# the thread that builds them sends them at once. the queued chat messages are interactive up to INTERACTIVE_SIZE bytes and bulk otherwise,
+# a session sends its bulk messages only when no interactive message is waiting
+class SendClass(Enum):
+    CONTROL = 0
+    INTERACTIVE = 1
+    BULK = 2
+
+    @staticmethod
+    def of(message):
+        return SendClass.INTERACTIVE if len(message) <= INTERACTIVE_SIZE else SendClass.BULK
+
+
+# control plane class, shared memory used by the worker processes to find the worker that owns a client or a companion daemon.
+# every worker has a slot with its state and the address of its client, the peer table maps addresses of other daemons
+# to the worker that is in a chat (or a handshake) with them. entries are [worker + 1 (0 - empty, 255 - deleted), port, ip].
+# the numbers of used and deleted entries follow the table. a new entry reuses a deleted one, and the table is rebuilt without
+# the deleted entries when there are more than PEER_TABLE_TOMBSTONES of them, so a miss stops at an empty entry after a few probes
+class ControlPlane:
+    IDLE = 0
+    CONNECTED = 1
+    WAITING = 2
+    CHAT = 3
+    ENTRY = struct.Struct('!BxH4s')
+    COUNTS = struct.Struct('!II')  # used and deleted entries of the peer table
+    DELETED = 255
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.counts_offset = (workers + PEER_TABLE_SIZE) * self.ENTRY.size
+        self.memory = shared_memory.SharedMemory(create=True, size=self.counts_offset + self.COUNTS.size)
+        self.memory.buf[:] = bytes(len(self.memory.buf))
+        self.lock = multiprocessing.Lock()
+        self.published = {}
+
+    # function to publish the state and the client address of a worker, only the worker itself writes its slot
+    def publish(self, worker, state, address=None):
+        if self.published.get(worker) == (state, address):
+            return
+        self.published[worker] = (state, address)
+        ip, port = (socket.inet_aton(address[0]), address[1]) if address else (bytes(4), 0)
+        self.ENTRY.pack_into(self.memory.buf, worker * self.ENTRY.size, state, port, ip)
+
+    def slot(self, worker):
+        state, port, ip = self.ENTRY.unpack_from(self.memory.buf, worker * self.ENTRY.size)
+        return state, (socket.inet_ntoa(ip), port)
+
+    # function to find the worker that serves a client
+    def find_client(self, address):
+        for worker in range(self.workers):
+            state, client = self.slot(worker)
+            if state != self.IDLE and client == address:
+                return worker
+        return None
+
+    # function to find a worker in the given state, the search starts at the worker the address hashes to,
+    # so the same address always gets the same worker as long as the states do not change
+    def find_state(self, address, state):
+        start = zlib.crc32(self.key(address)) % self.workers
+        for i in range(self.workers):
+            worker = (start + i) % self.workers
+            if self.slot(worker)[0] == state:
+                return worker
+        return None
+
+    def key(self, address):
+        return socket.inet_aton(address[0]) + address[1].to_bytes(2, byteorder='big')
+
+    # function to find the index of the entry of an address in the peer table, or of the entry it can be stored in
+    def find_entry(self, address):
+        key = self.key(address)
+        start = zlib.crc32(key) % PEER_TABLE_SIZE
+        free = None
+        for i in range(PEER_TABLE_SIZE):
+            index = (start + i) % PEER_TABLE_SIZE
+            worker, port, ip = self.entry(index)
+            if worker == 0:
+                return index if free is None else free, None
+            if worker == self.DELETED:
+                if free is None:
+                    free = index
+            elif ip + port.to_bytes(2, byteorder='big') == key:
+                return index, worker - 1
+        return free, None
+
+    def entry(self, index):
+        return self.ENTRY.unpack_from(self.memory.buf, (self.workers + index) * self.ENTRY.size)
+
+    def set_entry(self, index, worker, port=0, ip=bytes(4)):
+        self.ENTRY.pack_into(self.memory.buf, (self.workers + index) * self.ENTRY.size, worker, port, ip)
+
+    def counts(self):
+        return self.COUNTS.unpack_from(self.memory.buf, self.counts_offset)
+
+    def set_counts(self, used, deleted):
+        self.COUNTS.pack_into(self.memory.buf, self.counts_offset, used, deleted)
+
+    # function to find the worker that is in a chat with a daemon
+    def lookup(self, address):
+        with self.lock:
+            return self.find_entry(address)[1]
+
+    # function to register a worker for a daemon. one entry is always left empty, it ends the probes of a miss
+    def claim(self, address, worker):
+        with self.lock:
+            index, owner = self.find_entry(address)
+            used, deleted = self.counts()
+            if owner is None:
+                if used + deleted >= PEER_TABLE_SIZE - 1 and self.entry(index)[0] != self.DELETED:
+                    self.rebuild()
+                    index, _ = self.find_entry(address)
+                    used, deleted = self.counts()
+                if used >= PEER_TABLE_SIZE - 1:
+                    print("Control plane peer table is full")
+                    return
+                if self.entry(index)[0] == self.DELETED:
+                    deleted -= 1
+                self.set_counts(used + 1, deleted)
+            self.set_entry(index, worker + 1, address[1], socket.inet_aton(address[0]))
+
+    # function to remove the registration of a worker for a daemon
+    def release(self, address, worker):
+        with self.lock:
+            index, owner = self.find_entry(address)
+            if owner != worker:
+                return
+            self.set_entry(index, self.DELETED)
+            used, deleted = self.counts()
+            self.set_counts(used - 1, deleted + 1)
+            if deleted + 1 > PEER_TABLE_TOMBSTONES:
+                self.rebuild()
+
+    # function to rebuild the peer table in place without the deleted entries, called with the lock held
+    def rebuild(self):
+        entries = []
+        for index in range(PEER_TABLE_SIZE):
+            worker, port, ip = self.entry(index)
+            if worker not in (0, self.DELETED):
+                entries.append((worker, port, ip))
+            self.set_entry(index, 0)
+        for worker, port, ip in entries:
+            index, _ = self.find_entry((socket.inet_ntoa(ip), port))
+            self.set_entry(index, worker, port, ip)
+        self.set_counts(len(entries), 0)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+# receive buffer pool class, a ring of preallocated buffers filled with recvfrom_into. the datagrams are handed out as memoryviews of
+# the buffers, they stay valid until the ring comes around again and have to be copied by anyone keeping them longer.
+# after every wakeup the socket is drained without blocking, the datagrams are queued and handed out first
+class BufferPool:
+    def __init__(self, size=RECV_RING_SIZE, buffer_size=RECV_BUFFER_SIZE):
+        self.views = [memoryview(bytearray(buffer_size)) for _ in range(size)]
+        self.index = 0
+        self.queue = deque()
+        self.lock = threading.Lock()
+
+    def next_view(self):
+        view = self.views[self.index]
+        self.index = (self.index + 1) % len(self.views)
+        return view
+
+    # function to receive a datagram from a socket, waiting at most timeout seconds (raises socket.timeout), returns (memoryview, address).
+    # the sockets stay in blocking mode and the timeout is waited for with select: MSG_DONTWAIT would wait for the timeout of a socket
+    # that has one, and in a worker the dispatcher thread shares the sockets with the protocol threads
+    def recvfrom(self, sock, timeout=None):
+        try:
+            return self.queue.popleft()
+        except IndexError:
+            pass
+        with self.lock:
+            view = self.next_view()
+        if timeout is None:
+            size, address = sock.recvfrom_into(view)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                if not select.select([sock], [], [], max(deadline - time.monotonic(), 0))[0]:
+                    raise socket.timeout("timed out")
+                try:
+                    size, address = self.recv_nowait(sock, view)
+                    break
+                except BlockingIOError:
+                    continue
+        with self.lock:
+            self.drain(sock)
+        return view[:size], address
+
+    # function to receive a datagram that is already waiting on the socket into view, raises BlockingIOError if there is none.
+    # where there is no MSG_DONTWAIT (Windows) the socket is checked with select first
+    @staticmethod
+    def recv_nowait(sock, view):
+        if hasattr(socket, 'MSG_DONTWAIT'):
+            return sock.recvfrom_into(view, 0, socket.MSG_DONTWAIT)
+        if not select.select([sock], [], [], 0)[0]:
+            raise BlockingIOError("no datagram waiting")
+        return sock.recvfrom_into(view)
+
+    # function to queue the datagrams that are already waiting on the socket, at most half of the ring so queued views are not overwritten
+    def drain(self, sock):
+        for _ in range(len(self.views) // 2 - len(self.queue)):
+            view = self.views[self.index]
+            try:
+                size, address = self.recv_nowait(sock, view)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionResetError:
+                continue
+            self.next_view()
+            self.queue.append((view[:size], address))
+
+
+# trace writer class, records datagrams in a binary trace file: the TRACE_MAGIC header with the address of the daemon and then
+# a TRACE_RECORD per datagram followed by the datagram itself. the sockets of several threads write to it, the writes are locked
+class TraceWriter:
+    def __init__(self, path, address):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic_ns()
+        encoded = address.encode('ascii')
+        self.file.write(b''.join([TRACE_MAGIC, len(encoded).to_bytes(2, byteorder='big'), encoded]))
+
+    def record(self, flags, address, data):
+        now = time.monotonic_ns()
+        try:
+            ip = socket.inet_aton(address[0])
+        except OSError:
+            ip = bytes(4)  # not an IPv4 address
+        with self.lock:
+            if self.file.closed:
+                return  # the daemon is exiting
+            self.file.write(TRACE_RECORD.pack(now, flags, ip, address[1], len(data)))
+            self.file.write(data)
+            if now - self.last_flush >= TRACE_FLUSH_INTERVAL * 1e9:
+                self.file.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# socket wrapper that records every datagram sent and received with it in the trace, everything else is passed to the socket
+class TracedSocket:
+    def __init__(self, sock, trace, flags):
+        self.sock = sock
+        self.trace = trace
+        self.flags = flags
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendto(self, data, address):
+        sent = self.sock.sendto(data, address)
+        self.trace.record(self.flags | TRACE_OUT, address, data)
+        return sent
+
+    def recvfrom(self, size):
+        data, address = self.sock.recvfrom(size)
+        self.trace.record(self.flags, address, data)
+        return data, address
+
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        size, address = self.sock.recvfrom_into(buffer, nbytes, flags)
+        self.trace.record(self.flags, address, buffer[:size])
+        return size, address
+
+
+# latency histogram class of one stage, the spans are counted in power of two buckets of nanoseconds
+class StageHistogram:
+    def __init__(self):
+        self.buckets = [0] * SPAN_BUCKETS  # bucket i counts the spans from 2^i to 2^(i+1) ns
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns):
+        self.buckets[min(max(ns, 1).bit_length() - 1, SPAN_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += ns
+        self.max = max(self.max, ns)
+
+    # function to get an upper bound of the percentile p, the end of the bucket it falls in
+    def percentile(self, p):
+        rank = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** (i + 1), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'mean_us': round(self.total / max(self.count, 1) / 1000, 1),
+                'p50_us': round(self.percentile(50) / 1000, 1), 'p99_us': round(self.percentile(99) / 1000, 1),
+                'max_us': round(self.max / 1000, 1)}
+
+
+# span recorder class, the per-stage histograms of the way of a message through the daemon:
+# client_recv - the client datagram is received until it is queued, queue_wait - queued until it is sent to the companion,
+# parse - header of a datagram of a companion, ack / ack_retransmitted - first sent until the ACK (with retransmissions in between),
+# deliver - chat datagram of a companion received until it is sent to the client and queued for the group
+class SpanRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    # function to record the span of a stage that started at start (perf_counter_ns) and ends now
+    def record(self, stage, start):
+        self.add(stage, time.perf_counter_ns() - start)
+
+    def add(self, stage, ns):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = StageHistogram()
+            histogram.add(ns)
+
+    def summaries(self):
+        with self.lock:
+            return {stage: histogram.summary() for stage, histogram in self.stages.items()}
+
+    # function to write the histograms as JSON, the buckets as [lower bound in ns, count] pairs of the non empty buckets
+    def export(self, path):
+        with self.lock:
+            stages = {stage: {'count': histogram.count, 'total_ns': histogram.total, 'max_ns': histogram.max,
+                              'buckets': [[2 ** i, count] for i, count in enumerate(histogram.buckets) if count]}
+                      for stage, histogram in self.stages.items()}
+        with open(path, 'w') as f:
+            json.dump({'daemon': server_name, 'time': time.time(), 'stages': stages}, f, indent=1)
+
+
+# sampling profiler class, toggled at runtime with SIGUSR2. while it runs the stacks of all other threads are sampled
+# every interval and counted as collapsed stacks (outermost function first, separated by ;), the input of flame graph tools
+class SamplingProfiler:
+    def __init__(self, path, interval=PROFILE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def toggle(self):
+        if self.thread is None:
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        self.stacks = {}
+        self.samples = 0
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print(f"{server_name}: Sampling profiler started")
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    # function to stop sampling, the stacks are written to the file and the functions seen most often on top are printed
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        with open(self.path, 'w') as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+        leaves = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        print(f"{server_name}: Sampling profiler stopped, {self.samples} samples written to {self.path}")
+        for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:PROFILE_TOP]:
+            print(f"{server_name}:   {count:8} {leaf}")
+
+
+# memory budget class, the limit of the tables, buffers, caches and queues of the daemon. every structure is registered with a function
+# that estimates its bytes, the caches also with a function that evicts entries (oldest or least recently used first) to free bytes.
+# the structures are measured every MEMORY_CHECK_INTERVAL. above MEMORY_HIGH of the budget the caches are trimmed, so a large cache
+# (e.g. the history index) does not cause memory pressure. when that is not enough the memory pressure stops the queues and
+# the receive windows from growing. they are not trimmed, their messages were accepted or acknowledged
+class MemoryBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.structures = {}  # name -> (usage function, trim function or None), trimmed in this order
+        self.usage = {}
+        self.evicted = {}
+        self.pressure = False
+
+    def register(self, name, usage, trim=None):
+        self.structures[name] = (usage, trim)
+
+    # function to measure the structures and trim the caches that are above MEMORY_HIGH of the budget, trim(bytes) frees at least bytes (or all it can)
+    # and returns the number of evicted entries. returns True if the memory pressure started or ended
+    def check(self):
+        self.usage = {name: usage() for name, (usage, _) in self.structures.items()}
+        used = sum(self.usage.values())
+        high = self.limit * MEMORY_HIGH
+        for name, (usage, trim) in self.structures.items():
+            if used <= high:
+                break
+            if trim is None:
+                continue
+            evicted = trim(int(used - high))
+            if evicted:
+                self.evicted[name] = self.evicted.get(name, 0) + evicted
+                freed = self.usage[name] - usage()
+                self.usage[name] -= freed
+                used -= freed
+        pressure = used > self.limit * (MEMORY_LOW if self.pressure else MEMORY_HIGH)
+        changed = pressure != self.pressure
+        self.pressure = pressure
+        return changed
+
+    def stats(self):
+        return {'limit_mb': round(self.limit / (1 << 20), 1), 'used_mb': round(sum(self.usage.values()) / (1 << 20), 2),
+                'pressure': self.pressure, 'threads': threading.active_count(),
+                'structures': {name: {'bytes': used, 'evicted': self.evicted.get(name, 0)} for name, used in self.usage.items()}}
+
+
+# token bucket class, tokens are refilled at rate per second up to burst. used to pace the datagrams of a session
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    # function to take tokens from the bucket, returns False if there are not enough of them
+    def consume(self, amount=1, now=None):
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    # function to get the time until the bucket has enough tokens
+    def delay(self, amount=1, now=None):
+        self.refill(time.monotonic() if now is None else now)
+        if self.tokens >= amount or self.rate <= 0:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+
+# admission control class, one token bucket per source address of a port of the daemon. the datagrams of a source that sends faster
+# than rate are dropped before they are parsed. the buckets of the least recently seen sources are evicted beyond MAX_SOURCES.
+# with overall, every admitted datagram also takes a token from it (the limit of all sources)
+class SourceLimiter:
+    def __init__(self, rate, burst, overall=None):
+        self.rate = rate
+        self.burst = burst
+        self.overall = overall
+        self.buckets = {}  # source ip -> TokenBucket, least recently seen first
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.throttled = 0
+        self.rejected = 0  # dropped by the checks before the parse
+        self.evicted = 0
+
+    # function to take a token of the source, returns False if the datagram is dropped
+    def admit(self, source):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.pop(source, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[source] = bucket
+            if len(self.buckets) > MAX_SOURCES:
+                self.evicted += evict_entries(self.buckets, len(self.buckets) - MAX_SOURCES)
+            if bucket.consume(now=now) and (self.overall is None or self.overall.consume(now=now)):
+                self.admitted += 1
+                return True
+            self.throttled += 1
+            return False
+
+    def memory(self):
+        return len(self.buckets) * SOURCE_ENTRY_SIZE
+
+    # function to evict the buckets of the least recently seen sources until bytes are freed, returns the number of evicted buckets
+    def trim(self, excess):
+        with self.lock:
+            evicted = evict_entries(self.buckets, -(-excess // SOURCE_ENTRY_SIZE))
+            self.evicted += evicted
+        return evicted
+
+    def stats(self):
+        return {'sources': len(self.buckets), 'admitted': self.admitted, 'throttled': self.throttled,
+                'rejected': self.rejected, 'evicted': self.evicted}
+
+
+# consistent hash ring class of a cluster. every daemon gets CLUSTER_VNODES points on the ring and a username belongs to the daemon
+# of the first point at or after its hash, so a daemon that joins or leaves only takes over or hands on the users next to its points.
+# the points are replaced at once when the members change, owner() is called by every thread without the lock
+class HashRing:
+    def __init__(self, address, vnodes=CLUSTER_VNODES):
+        self.address = address  # the own daemon, it is always on the ring
+        self.vnodes = vnodes
+        self.seen = {}  # other member -> when it last announced itself
+        self.points = ([], [])  # sorted hashes of the points and the members they belong to
+        self.lock = threading.Lock()
+        self.rebuild()
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), byteorder='big')
+
+    def members(self):
+        return sorted(set(self.seen) | {self.address})
+
+    def rebuild(self):
+        points = sorted((self.hash(f'{member}#{i}'), member) for member in self.members() for i in range(self.vnodes))
+        self.points = ([point for point, _ in points], [member for _, member in points])
+
+    # function to record the announcement of a member, returns True if it is new on the ring
+    def join(self, member, now):
+        if member == self.address:
+            return False
+        with self.lock:
+            new = member not in self.seen
+            self.seen[member] = now
+            if new:
+                self.rebuild()
+            return new
+
+    # function to take a member off the ring, returns False if it was not on it
+    def leave(self, member):
+        with self.lock:
+            if self.seen.pop(member, None) is None:
+                return False
+            self.rebuild()
+            return True
 
-# HEADER class, used to create headers from messages, errors list will contain all the errors found in header, is_ok indicates if the header contains errors.
+    # function to take the members off the ring that did not announce themselves since before, returns them
+    def expire(self, before):
+        with self.lock:
+            gone = [member for member, seen in self.seen.items() if seen < before]
+            for member in gone:
+                del self.seen[member]
+            if gone:
+                self.rebuild()
+            return gone
+
+    def owner(self, username):
+        points, members = self.points
+        return members[bisect.bisect_left(points, self.hash(username)) % len(points)]
+
+
+# chat history class, an append-only file of the delivered chat messages with an inverted index over it. every message gets a number,
+# offsets maps it to its record in the file and postings maps every word and the @username of the sender to the numbers of the
+# messages with it, in ascending order. the numbers are kept in arrays of 4 byte ints, appending a message only appends to them.
+# a search walks the shortest posting list of the query from the newest message and reads only the records of the matches.
+# when the memory budget trims it, the oldest messages are dropped from the index, they stay in the file
+class HistoryIndex:
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array('Q')  # message number - first -> offset of its record in the file
+        self.postings = {}  # term -> array of message numbers
+        self.first = 0  # number of the oldest indexed message, the older ones were trimmed
+        self.end = len(HISTORY_MAGIC)  # offset of the next record
+        self.size = 0  # estimated bytes of the index
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        self.file.seek(0)
+        magic = self.file.read(len(HISTORY_MAGIC))
+        if not magic:
+            self.file.write(HISTORY_MAGIC)
+            self.file.flush()
+        elif magic != HISTORY_MAGIC:
+            self.file.close()
+            raise ValueError(f"{path} is not a SIMP history")
+        self.reader = open(path, 'rb')
+
+    #function to index the messages already in the file, a record cut off at the end (the daemon was killed) is cut off the file
+    #and a record with a username that is not ascii is skipped (it stays in the file). returns the number of indexed messages
+    def load(self):
+        count = 0
+        self.reader.seek(self.end)
+        while True:
+            head = self.reader.read(HISTORY_RECORD.size)
+            if len(head) < HISTORY_RECORD.size:
+                break
+            _, name_length, length = HISTORY_RECORD.unpack(head)
+            body = self.reader.read(name_length + length)
+            if len(body) < name_length + length:
+                break
+            with self.lock:
+                try:
+                    self.index(self.end, str(body[:name_length], 'ascii'), body[name_length:])
+                    count += 1
+                except UnicodeDecodeError:
+                    pass
+                self.end += HISTORY_RECORD.size + len(body)
+        with self.lock:
+            self.file.truncate(self.end)
+        return count
+
+    #function to add a message to the index, called with the lock held
+    def index(self, offset, username, message):
+        number = self.first + len(self.offsets)
+        self.offsets.append(offset)
+        self.size += self.offsets.itemsize
+        terms = set(HISTORY_TERM.findall(message.lower()))
+        terms.add(b'@' + username.lower().encode('ascii'))
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array('I')
+                self.size += 2 * ENTRY_OVERHEAD + len(term)  # the slot of the dict and the array
+            postings.append(number)
+            self.size += postings.itemsize
+
+    #function to append delivered messages (time, username, message) to the file and to index them
+    def add(self, records):
+        with self.lock:
+            for timestamp, username, message in records:
+                name = username.encode('ascii')
+                self.file.write(b''.join([HISTORY_RECORD.pack(int(timestamp * 1000), len(name), len(message)), name, message]))
+                self.index(self.end, username, message)
+                self.end += HISTORY_RECORD.size + len(name) + len(message)
+            self.file.flush()
+
+    #function to read the record of a message, returns (time in ms, username, message)
+    def read(self, number):
+        self.reader.seek(self.offsets[number - self.first])
+        timestamp, name_length, length = HISTORY_RECORD.unpack(self.reader.read(HISTORY_RECORD.size))
+        body = self.reader.read(name_length + length)
+        return timestamp, str(body[:name_length], 'ascii'), body[name_length:]
+
+    #function to find the messages with every term of the query, returns the newest limit of them (newest first)
+    #and True if there are older ones
+    def search(self, query, limit=SEARCH_LIMIT):
+        terms = query_terms(query)
+        if not terms:
+            return [], False
+        with self.lock:
+            shortest, *others = sorted((self.postings.get(term, ()) for term in terms), key=len)
+            matches = []
+            for i in range(len(shortest) - 1, -1, -1):
+                number = shortest[i]
+                if all(contains(postings, number) for postings in others):
+                    if len(matches) == limit:
+                        return [self.read(number) for number in matches], True
+                    matches.append(number)
+            return [self.read(number) for number in matches], False
+
+    def memory(self):
+        return self.size
+
+    #function to drop the oldest messages from the index until at least excess bytes are freed, returns the number of dropped messages.
+    #the messages to drop are estimated from the average size of a message, the terms that lose all their messages free more
+    def trim(self, excess):
+        with self.lock:
+            target = self.size - excess
+            dropped = 0
+            while self.offsets and self.size > target:
+                count = min(len(self.offsets), -(-(self.size - target) * len(self.offsets) // self.size))
+                self.drop(count)
+                dropped += count
+            return dropped
+
+    #function to drop the count oldest messages from the index, called with the lock held
+    def drop(self, count):
+        self.first += count
+        del self.offsets[:count]
+        self.size = len(self.offsets) * self.offsets.itemsize
+        for term, postings in list(self.postings.items()):
+            cut = bisect.bisect_left(postings, self.first)
+            if cut == len(postings):
+                del self.postings[term]
+                continue
+            del postings[:cut]
+            self.size += 2 * ENTRY_OVERHEAD + len(term) + len(postings) * postings.itemsize
+
+    def stats(self):
+        return {'messages': len(self.offsets), 'terms': len(self.postings), 'trimmed': self.first, 'file_bytes': self.end}
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.reader.close()
+
+
+# congestion control class, one per companion daemon. the congestion window grows by one datagram per acknowledgement in slow start
+# and by one datagram per window after that (additive increase), it is halved when a datagram is lost (multiplicative decrease)
+# and falls back to one datagram on a retransmission timeout. the receiver advertises in every ACK how many datagrams it can buffer,
+# at most min(congestion window, advertised window) datagrams are in flight. with pacing they are spread over the smoothed RTT.
+# the messages waiting for the window are queued per send class, the sender thread serves the sessions by deficit round robin
+class CongestionControl:
+    def __init__(self, paced=False, weight=1):
+        self.next_seq = 0
+        self.cwnd = INITIAL_WINDOW
+        self.ssthresh = MAX_WINDOW
+        self.rwnd = RECV_WINDOW
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.in_flight = {}  # seq -> [datagram, first sent, last sent, retransmissions, later acks, send order]
+        self.sends = 0  # send order of the last (re)transmission
+        self.last_decrease = 0
+        self.bucket = TokenBucket(0, PACING_BURST) if paced else None
+        #send class -> (message, username, queued at in perf_counter_ns) waiting for the window, at most OUTBOUND_QUEUE_SIZE in all
+        self.queues = {SendClass.INTERACTIVE: deque(), SendClass.BULK: deque()}
+        self.weight = weight
+        self.deficit = 0  # bytes the session can still send in this round of the sender thread
+        self.dropped = 0
+        self.sent = 0
+        self.retransmitted = 0
+        self.lost = 0
+        self.acked = 0
+
+    def queued(self):
+        return len(self.queues[SendClass.INTERACTIVE]) + len(self.queues[SendClass.BULK])
+
+    # function to get the queued messages in the order they are sent, the interactive ones first
+    def queued_messages(self):
+        return list(self.queues[SendClass.INTERACTIVE]) + list(self.queues[SendClass.BULK])
+
+    def enqueue(self, item):
+        self.queues[SendClass.of(item[0])].append(item)
+
+    # function to get the message that is sent next, None if nothing is queued
+    def head(self):
+        for queue in self.queues.values():
+            if queue:
+                return queue[0]
+        return None
+
+    # function to estimate the bytes of the queued messages and the datagrams in flight
+    def memory(self):
+        queued = sum(len(message) + ENTRY_OVERHEAD for queue in self.queues.values() for message, _, _ in queue)
+        return queued + sum(len(entry[0]) + ENTRY_OVERHEAD for entry in list(self.in_flight.values()))
+
+    def window(self):
+        return max(min(int(self.cwnd), self.rwnd), MIN_WINDOW if not self.in_flight else 0)
+
+    # function to get the time until the next datagram can be sent, None if the window is full
+    def send_delay(self, now):
+        if len(self.in_flight) >= self.window():
+            return None
+        if self.bucket is not None and self.srtt is not None:
+            return self.bucket.delay(now=now)
+        return 0
+
+    def on_send(self, datagram, now):
+        seq = self.next_seq
+        self.next_seq = (seq + 1) % SEQ_SPACE
+        self.sends += 1
+        self.in_flight[seq] = [datagram, now, now, 0, 0, self.sends]
+        if self.bucket is not None and self.srtt is not None:
+            self.bucket.consume(now=now)
+        self.sent += 1
+        return seq
+
+    # function to process an acknowledgement, returns the datagrams that are lost because later ones were acknowledged
+    def on_ack(self, seq, rwnd, now):
+        if rwnd is not None:
+            self.rwnd = rwnd
+        entry = self.in_flight.pop(seq, None)
+        if entry is None:
+            return []  # duplicate acknowledgement
+        self.acked += 1
+        if entry[3] == 0:
+            self.sample_rtt(now - entry[1])  # only datagrams that were not retransmitted give RTT samples (Karn)
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+        else:
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_WINDOW)
+
+        lost = []
+        for earlier, other in self.in_flight.items():
+            if other[5] < entry[5]:  # sent before the acknowledged datagram
+                other[4] += 1
+                if other[4] == FAST_LOSS_THRESHOLD:
+                    lost.append(earlier)
+        if lost:
+            self.on_loss(now)
+        return lost
+
+    def sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        if self.bucket is not None:
+            self.bucket.rate = PACING_GAIN * self.cwnd / max(self.srtt, 0.001)
+
+    # function to shrink the window after a loss, once per RTT. after a timeout only one datagram is sent until acknowledgements come back
+    def on_loss(self, now, timeout=False):
+        if now - self.last_decrease < (self.srtt or self.rto):
+            return
+        self.last_decrease = now
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = MIN_WINDOW if timeout else self.ssthresh
+        if timeout:
+            self.rto = min(self.rto * 2, MAX_RTO)
+
+    # function to get the datagrams whose retransmission timeout expired
+    def expired(self, now):
+        return [seq for seq, entry in self.in_flight.items() if now - entry[2] >= self.rto]
+
+    # function to get the time until the next retransmission timeout expires
+    def next_timeout(self, now):
+        if not self.in_flight:
+            return None
+        return max(min(entry[2] for entry in self.in_flight.values()) + self.rto - now, 0)
+
+    # function to get the state of the session for a new daemon process, the times are kept as ages
+    def snapshot(self, now):
+        return {'next_seq': self.next_seq, 'cwnd': self.cwnd, 'ssthresh': self.ssthresh, 'rwnd': self.rwnd,
+                'srtt': self.srtt, 'rttvar': self.rttvar, 'rto': self.rto, 'sends': self.sends,
+                'counters': [self.dropped, self.sent, self.retransmitted, self.lost, self.acked],
+                'in_flight': [[seq, encode_bytes(entry[0]), now - entry[1], now - entry[2]] + entry[3:]
+                              for seq, entry in self.in_flight.items()],
+                'queue': [[encode_bytes(message), username] for message, username, _ in self.queued_messages()]}
+
+    def restore(self, state, now):
+        self.next_seq = state['next_seq']
+        self.cwnd = state['cwnd']
+        self.ssthresh = state['ssthresh']
+        self.rwnd = state['rwnd']
+        self.srtt = state['srtt']
+        self.rttvar = state['rttvar']
+        self.rto = state['rto']
+        self.sends = state['sends']
+        self.dropped, self.sent, self.retransmitted, self.lost, self.acked = state['counters']
+        self.in_flight = {seq: [decode_bytes(datagram), now - first, now - last] + rest
+                          for seq, datagram, first, last, *rest in state['in_flight']}
+        queued = time.perf_counter_ns()
+        for message, username in state['queue']:
+            self.enqueue((decode_bytes(message), username, queued))
+
+    def metrics(self):
+        return {'cwnd': round(self.cwnd, 2), 'ssthresh': round(self.ssthresh, 2), 'rwnd': self.rwnd, 'in_flight': len(self.in_flight),
+                'srtt': None if self.srtt is None else round(self.srtt, 4), 'rto': round(self.rto, 3),
+                'pacing_rate': None if self.bucket is None else round(self.bucket.rate, 1),
+                'queued': len(self.queues[SendClass.INTERACTIVE]), 'queued_bulk': len(self.queues[SendClass.BULK]), 'dropped': self.dropped,
+                'sent': self.sent, 'acked': self.acked, 'retransmitted': self.retransmitted, 'lost': self.lost}
+
+
+# receive window class, one per companion daemon. chat datagrams are delivered to the client in sequence order,
+# datagrams that arrive early are buffered and duplicates are only acknowledged again
+class ReceiveWindow:
+    def __init__(self):
+        self.expected = 0
+        self.buffer = {}  # seq -> (username, payload, arrival)
+
+    # function to take a datagram in, returns the (username, payload) messages that can be delivered now,
+    # or None if the datagram is outside of the window and is not acknowledged
+    def receive(self, seq, username, payload, now):
+        distance = (seq - self.expected) % SEQ_SPACE
+        if distance >= SEQ_SPACE // 2:
+            return []  # already delivered
+        if distance >= RECV_WINDOW:
+            return None
+        if distance == 0:
+            self.expected = (seq + 1) % SEQ_SPACE
+            return [(username, payload)] + self.deliverable()
+        if seq not in self.buffer:
+            self.buffer[seq] = (username, bytes(payload), now)  # kept longer than the receive buffer, it is copied
+        return []
+
+    def deliverable(self):
+        messages = []
+        while self.expected in self.buffer:
+            username, payload, _ = self.buffer.pop(self.expected)
+            messages.append((username, payload))
+            self.expected = (self.expected + 1) % SEQ_SPACE
+        return messages
+
+    # function to give up on a gap that was not filled in time, the buffered datagrams after it are delivered
+    def expire(self, now):
+        if not self.buffer or now - min(arrival for _, _, arrival in self.buffer.values()) < REORDER_TIMEOUT:
+            return []
+        self.expected = min(self.buffer, key=lambda seq: (seq - self.expected) % SEQ_SPACE)
+        return self.deliverable()
+
+    # function to get the datagrams the sender can send, under memory pressure the buffer does not grow beyond the gap being filled
+    def advertised(self):
+        if memory_budget is not None and memory_budget.pressure:
+            return max(MIN_WINDOW - len(self.buffer), 0)
+        return RECV_WINDOW - len(self.buffer)
+
+    def memory(self):
+        return sum(len(payload) + ENTRY_OVERHEAD for _, payload, _ in list(self.buffer.values()))
+
+    # function to get the state of the window for a new daemon process, the arrival times are kept as ages
+    def snapshot(self, now):
+        return {'expected': self.expected,
+                'buffer': [[seq, username, encode_bytes(payload), now - arrival] for seq, (username, payload, arrival) in self.buffer.items()]}
+
+    def restore(self, state, now):
+        self.expected = state['expected']
+        self.buffer = {seq: (username, decode_bytes(payload), now - age) for seq, username, payload, age in state['buffer']}
+
+
+# HEADER class, used to create headers from messages. the errors found in the header are the bits of error_mask, the list of
+# ErrorType and the error text are only built when they are asked for. is_ok indicates if the header contains no errors.
+# one is built for every datagram, the slots keep it small
 class HeaderInfo:
-    is_ok = False
+    __slots__ = ('type', 'operation', 'seq', 'payload_size', 'username', 'error_mask')
     type: DatagramType
     operation: OperationType
-    seq = None
-    payload_size = None
-    username = None
 
     def __init__(self):
-        self.is_ok = False
         self.type = DatagramType.UNKNOWN
         self.operation = OperationType.UNKNOWN
         self.seq = None
         self.payload_size = None
         self.username = None
-        self.errors = []
+        self.error_mask = 0
+
+    def add_error(self, error):
+        self.error_mask |= error.bit
+
+    @property
+    def is_ok(self):
+        return self.error_mask == 0
+
+    @property
+    def errors(self):
+        return errors_from_mask(self.error_mask)
+
+
+#function to get the ErrorType members of an error mask
+def errors_from_mask(mask):
+    return [error for error in ErrorType if mask & error.bit]
 
 
 #function to retrieve a datagram type from header
@@ -133,12 +1257,11 @@ def get_operation_type(msg):
 
 # get the sequence number from a message
 def get_sequence_number(msg):
-    # if the seq number is '\x01' -> lost datagram and needs to be retransmitted.
-    seq = msg[2]
-
-    if seq not in (0, 1):
+    # chat datagrams are numbered modulo 256 (SEQ_SPACE) per session, control datagrams carry the seq they answer
+    try:
+        return msg[2]
+    except IndexError:
         return ErrorType.WRONG_SEQUENCE_NUMBER
-    return seq
 
 
 # function to encode any username to a 32 bytearray
@@ -155,7 +1278,7 @@ def encode_username(username: str) -> bytes:
 def get_username(msg):
     try:
         username = msg[3:MAX_USERNAME_SIZE + 4]
-        return username.decode('ascii').rstrip('\x00')  # cuts the additional zeros from right
+        return str(username, 'ascii').rstrip('\x00')  # str() decodes memoryviews of the receive buffers as well, rstrip cuts the additional zeros from the right
     except:
         return ErrorType.USERNAME_ERROR
 
@@ -186,13 +1309,13 @@ def get_msg_payload(msg):
 def build_header(msg):
     header = HeaderInfo()
     if len(msg) < MIN_HEADER_SIZE:  # HEADER CAN'T BE LESS THAN 35 BYTES [1 byte - datagram type, 1 byte - op.type, 1 byte - seq. number, 32bytes - username]
-        header.errors.append(ErrorType.MSG_TOO_SHORT)
+        header.add_error(ErrorType.MSG_TOO_SHORT)
 
     # datagram type of the message
     dtype = get_datagram_type(msg)
     # if datagram type is now known append an error to the header object
     if dtype == DatagramType.UNKNOWN:
-        header.errors.append(ErrorType.UKNOWN_DATAGRAM_TYPE)
+        header.add_error(ErrorType.UKNOWN_DATAGRAM_TYPE)
     else:
         header.type = dtype
 
@@ -200,7 +1323,7 @@ def build_header(msg):
     operation = get_operation_type(msg)
     # if operation type is not known -> append an error to the header object
     if operation == OperationType.UNKNOWN:
-        header.errors.append(ErrorType.UKNOWN_OPERATION_TYPE)
+        header.add_error(ErrorType.UKNOWN_OPERATION_TYPE)
     else:
         header.operation = operation
 
@@ -208,7 +1331,7 @@ def build_header(msg):
     seq = get_sequence_number(msg)
     # if not in (0,1) -> append an error to a header
     if seq == ErrorType.WRONG_SEQUENCE_NUMBER:
-        header.errors.append(ErrorType.WRONG_SEQUENCE_NUMBER)
+        header.add_error(ErrorType.WRONG_SEQUENCE_NUMBER)
     else:
         header.seq = seq
 
@@ -216,7 +1339,7 @@ def build_header(msg):
     username = get_username(msg)
     # if any problems with the username -> append an error to the header object
     if username == ErrorType.USERNAME_ERROR:
-        header.errors.append(ErrorType.USERNAME_ERROR)
+        header.add_error(ErrorType.USERNAME_ERROR)
     else:
         header.username = username
 
@@ -224,7 +1347,7 @@ def build_header(msg):
     payload_size = get_msg_length(msg)
     # if any error with the payload size -> append an error
     if payload_size == ErrorType.WRONG_LENGTH_SIZE:
-        header.errors.append(ErrorType.WRONG_LENGTH_SIZE)
+        header.add_error(ErrorType.WRONG_LENGTH_SIZE)
     else:
         header.payload_size = payload_size
 
@@ -232,34 +1355,32 @@ def build_header(msg):
     payload = get_msg_payload(msg)
     # if any problems with getting a payload -> append an error
     if payload == ErrorType.WRONG_PAYLOAD:
-        header.errors.append(ErrorType.WRONG_PAYLOAD)
+        header.add_error(ErrorType.WRONG_PAYLOAD)
 
-        # if payload should be there, but it is -> append an error
-    elif payload and header.type == DatagramType.CONTROL and header.operation != OperationType.MESSAGE:
-        header.errors.append(ErrorType.NO_PAYLOAD_EXPECTED)
+        # if payload should be there, but it is -> append an error (ACKs carry the advertised receive window, SYN and SYN+ACK the MAC nonce)
+    elif payload and header.type == DatagramType.CONTROL and header.operation not in (
+            OperationType.MESSAGE, OperationType.ACK, OperationType.SYN, OperationType.SYN.value | OperationType.ACK.value):
+        header.add_error(ErrorType.NO_PAYLOAD_EXPECTED)
 
     # if payload size does not match the actual payload -> append an error
     else:
         if len(payload) != payload_size:
-            header.errors.append(ErrorType.WRONG_PAYLOAD_SIZE)
-
-            # if no errors found -> header is correct
-    if len(header.errors) == 0:
-        header.is_ok = True
-
-    # debug statements
-    print(f"Length of message: {len(msg)}")
-    print(f"DatagramType: {header.type}")
-    print(f"OperationType: {header.operation}")
-    print(f"Sequence: {header.seq}")
-    print(f"Username: {header.username}")
-    print(f"Payload_size: {header.payload_size}")
-    print(f"Errors: {header.errors}")
-    print(f"Payload: {payload}")
+            header.add_error(ErrorType.WRONG_PAYLOAD_SIZE)
+
+    # debug statements, only with --debug
+    if debug:
+        print(f"Length of message: {len(msg)}")
+        print(f"DatagramType: {header.type}")
+        print(f"OperationType: {header.operation}")
+        print(f"Sequence: {header.seq}")
+        print(f"Username: {header.username}")
+        print(f"Payload_size: {header.payload_size}")
+        print(f"Errors: {header.errors if header.error_mask else []}")
+        print(f"Payload: {bytes(payload) if isinstance(payload, memoryview) else payload}")
     return header
 
 
-# function to generate the error messages
+# function to generate the error messages, the text is only rendered for the debug output
 def build_error_message(header):
     error_msg = ''
     # iterate through all the errors in header object. for different error types generate corresponding answer
@@ -271,11 +1392,11 @@ def build_error_message(header):
         elif error == ErrorType.UKNOWN_OPERATION_TYPE:
             error_msg += "ERROR: UNKNOWN OPERATION TYPE IN HEADER (01 - ERROR, 02 - SYN, 04 - ACK, 08 - FIN)\n"
         elif error == ErrorType.WRONG_SEQUENCE_NUMBER:
-            error_msg += "ERROR: WRORG SEQUENCE NUMBER IN HEADER (00 - NO LOSS, 01 - LOST DATAGRAMS)\n"
+            error_msg += "ERROR: WRORG SEQUENCE NUMBER IN HEADER (1 byte, 00 - FF)\n"
         elif error == ErrorType.USERNAME_ERROR:
             error_msg += "ERROR: USERNAME ERROR IN HEADER (should be 1-32 bytes ascii decoded string)\n"
         elif error == ErrorType.WRONG_LENGTH_SIZE:
-            error_msg == "ERROR: LENGTH HEADER FIELD SHOULD BE 4 BYTES LONG INDICATING PAYLOAD SIZE\n"
+            error_msg += "ERROR: LENGTH HEADER FIELD SHOULD BE 4 BYTES LONG INDICATING PAYLOAD SIZE\n"
         elif error == ErrorType.NO_PAYLOAD_EXPECTED:
             error_msg += "ERROR: NO PAYLOAD EXPECTED\n"
         elif error == ErrorType.WRONG_PAYLOAD_SIZE:
@@ -287,152 +1408,694 @@ def build_error_message(header):
 
 
 # function to build a reply for the message
-# it takes the message, extracts the header from it, if any errors found -> it will generate a reply containing the errors found in the header.
+# it takes the message, extracts the header from it, if any errors found -> it will generate a reply containing the errors found in the header:
+# the error mask as a binary error code (ERROR_CODE_SIZE bytes).
 # if no errors are found -> just generate the message with acknowledgement
 def build_reply(msg, host=None, port=None):
-    global clients
-    client_name = clients[0][0]
     header = build_header(msg)
-    dtype = None
-    operation = None
 
     # if errors in header, build error message and send
     if not header.is_ok:
         dtype = DatagramType.CONTROL.to_bytes()
         operation = OperationType.MESSAGE.to_bytes()
-        error_msg = build_error_message(header).encode(encoding='ascii')
+        error_msg = header.error_mask.to_bytes(ERROR_CODE_SIZE, byteorder='big')
         seq = int(0).to_bytes(1, byteorder='big')
-        username = client_name
+        username = encode_username(clients[0][0])
         length = len(error_msg).to_bytes(4, byteorder='big')
-        reply = b''.join([dtype, operation, seq, username, length, error_msg])
-    else:
-        dtype = DatagramType.CONTROL.to_bytes()
-        operation = OperationType.ACK.to_bytes()
-        seq = int(0).to_bytes(1, byteorder='big')
-        username = client_name
-        reply = b''.join([dtype, operation, seq, username])
-    return reply
+        return b''.join([dtype, operation, seq, username, length, error_msg])
+    return build_ack_message(0)
 
 
-#function to build a chat message
-def build_chat_message(payload, seq):
+#function to read the payload of an error reply, returns the list of ErrorType of a binary error code or the error text
+#(daemons that predate the binary codes send the text)
+def parse_error_reply(payload):
+    if len(payload) == ERROR_CODE_SIZE:
+        return errors_from_mask(int.from_bytes(payload, byteorder='big'))
+    return str(payload, 'ascii', errors='replace')
+
+
+#function to build a chat message, username is the author of the message (the own client if not given)
+def build_chat_message(payload, seq, username=None):
     global clients
     dtype = DatagramType.CHAT.to_bytes()
     operation = OperationType.MESSAGE.to_bytes()
     seq_byte = seq.to_bytes(1, byteorder='big')
-    username = encode_username(clients[0][0])
+    username = encode_username(clients[0][0] if username is None else username)
     msg = payload
     payload_size = len(msg).to_bytes(length=4, byteorder='big')
     datagram = b''.join([dtype, operation, seq_byte, username, payload_size, msg])
     return datagram
 
 
-#function to build a fin message
-def build_fin_message(seq):
+#function to build a control datagram without payload, operation is the value of the operation (e.g. SYN | ACK),
+#username is the sender (the own client if not given)
+def build_control_message(operation, seq, username=None):
     global clients
     dtype = DatagramType.CONTROL.to_bytes()
-    operation = OperationType.FIN.to_bytes()
-    seq_byte = seq.to_bytes(1, byteorder="big")
-    username = encode_username(clients[0][0])
-    datagram = b''.join([dtype, operation, seq_byte, username])
+    operation_byte = operation.to_bytes(1, byteorder='big')
+    seq_byte = seq.to_bytes(1, byteorder='big')
+    username = encode_username(clients[0][0] if username is None else username)
+    datagram = b''.join([dtype, operation_byte, seq_byte, username])
     return datagram
 
 
-def build_ack_message(seq):
+#function to build a fin message
+def build_fin_message(seq, username=None):
+    return build_control_message(OperationType.FIN.value, seq, username)
+
+
+def build_ack_message(seq, username=None):
+    return build_control_message(OperationType.ACK.value, seq, username)
+
+
+#function to build the ACK of a chat datagram, the payload is the receive window the receiver advertises (2 bytes)
+def build_window_ack(seq, username, window):
     dtype = DatagramType.CONTROL.to_bytes()
     operation = OperationType.ACK.to_bytes()
     seq_byte = seq.to_bytes(1, byteorder='big')
-    username = encode_username(clients[0][0])
-    datagram = b''.join([dtype, operation, seq_byte, username])
-    return datagram
+    payload = max(window, 0).to_bytes(2, byteorder='big')
+    return b''.join([dtype, operation, seq_byte, encode_username(username), len(payload).to_bytes(4, byteorder='big'), payload])
+
+
+#function to build the payload of a SYN or SYN+ACK, a random nonce (with its length field) if the chats are authenticated
+def handshake_payload():
+    if mac_secret is None:
+        return b''
+    return MAC_NONCE_SIZE.to_bytes(4, byteorder='big') + os.urandom(MAC_NONCE_SIZE)
+
+
+#function to derive the MAC keys of a chat from the nonces of its SYN and SYN+ACK, one key per direction,
+#so a datagram sent back to the daemon it came from does not pass. they are used once the chat starts (reset_flow).
+#returns False if the daemon uses MACs and the other daemon does not, the handshake has to be refused then
+def remember_handshake(address, syn, synack, requester):
+    if mac_secret is None:
+        return True
+    syn_nonce = bytes(syn[MAX_HEADER_SIZE:MAX_HEADER_SIZE + MAC_NONCE_SIZE])
+    synack_nonce = bytes(synack[MAX_HEADER_SIZE:MAX_HEADER_SIZE + MAC_NONCE_SIZE])
+    if len(syn_nonce) < MAC_NONCE_SIZE or len(synack_nonce) < MAC_NONCE_SIZE:
+        print(f"{server_name}: {peer_name(address)} does not use MACs, refusing the handshake")
+        handshake_keys.pop(address, None)
+        return False
+    master = hmac.digest(mac_secret, b''.join([b'SIMP MAC', syn_nonce, synack_nonce]), 'sha256')
+    requester_key = hmac.digest(master, b'requester', 'sha256')
+    acceptor_key = hmac.digest(master, b'acceptor', 'sha256')
+    handshake_keys[address] = (requester_key, acceptor_key) if requester else (acceptor_key, requester_key)
+    return True
+
+
+#function to refuse a handshake without MACs, the other daemon gets an error reply with the reason as text
+def refuse_handshake(address):
+    error_msg = "ERROR: MESSAGE AUTHENTICATION CODES ARE REQUIRED\n".encode(encoding='ascii')
+    length = len(error_msg).to_bytes(4, byteorder='big')
+    send_to_daemon(b''.join([build_control_message(OperationType.MESSAGE.value, 0), length, error_msg]), address)
+
+
+#function to check and strip the MAC trailer of a datagram, returns the datagram without it or None if the MAC is missing or wrong
+def verify_mac(msg, key):
+    if len(msg) < MAC_SIZE:
+        return None
+    body = msg[:-MAC_SIZE]
+    if not hmac.compare_digest(hmac.digest(key, body, 'sha256')[:MAC_SIZE], msg[-MAC_SIZE:]):
+        return None
+    return body
+
+
+#function to send a datagram to another daemon, daemons behind the relay hub are addressed as (hub ip, hub port, username)
+#and the datagram is wrapped in a relay envelope for them. keys are the MAC keys of the chat (those of the chat with address if not given)
+def send_to_daemon(datagram, address, keys=None):
+    #the answers of a daemon this worker sends to have to come back to this worker
+    if control_plane is not None and address not in claimed_peers:
+        control_plane.claim(address, worker_id)
+        claimed_peers.add(address)
+    if keys is None:
+        keys = session_keys.get(address)
+    if keys:
+        datagram = datagram + hmac.digest(keys[0], datagram, 'sha256')[:MAC_SIZE]
+    if len(address) == 3:
+        envelope = b''.join([DatagramType.RELAY.to_bytes(), RelayOperation.FORWARD.to_bytes(), encode_username(address[2])])
+        daemon_socket.sendto(envelope + datagram, address[:2])
+    else:
+        daemon_socket.sendto(datagram, address)
+
+
+#function to receive a datagram from another daemon, datagrams relayed by the hub are unwrapped
+#and their address is the (hub ip, hub port, username) of the daemon that sent them
+#the datagrams the admission control drops are skipped, a flood of them does not keep the caller waiting beyond the timeout of the socket.
+#a repeated FIN of a companion that already left the chat is answered here, whatever the daemon is doing
+def recv_from_daemon():
+    timeout = daemon_timeout
+    deadline = None if timeout is None else time.monotonic() + timeout
+    if lingered and linger_stopped:
+        return lingered.popleft()
+    while True:
+        if control_plane is not None:
+            msg, address = worker_recv(daemon_channel, daemon_pool, timeout)
+        else:
+            msg, address = daemon_pool.recvfrom(daemon_socket, timeout)
+        if address == hub_address and len(msg) >= RELAY_HEADER_SIZE and msg[0] == 3 and msg[1] == RelayOperation.FORWARD.value:
+            username = str(msg[2:RELAY_HEADER_SIZE], 'ascii').rstrip('\x00')
+            msg, address = msg[RELAY_HEADER_SIZE:], (address[0], address[1], username)
+        if admit_daemon_datagram(msg, address):
+            if not (msg[0] == 1 and msg[1] == OperationType.FIN.value and answer_closed_chat(address)):
+                return msg, address
+        if deadline is not None and time.monotonic() >= deadline:
+            raise socket.timeout("timed out")
+
+
+#function to set the timeout of the next receives of the daemon socket (or of the channel of a worker). it is kept in daemon_timeout,
+#the socket itself stays blocking
+def set_daemon_timeout(timeout):
+    global daemon_timeout
+    daemon_timeout = timeout
+
+
+#function for the admission control of a datagram of another daemon. the checks of the datagram and operation types are done first,
+#a datagram that fails them is dropped without being parsed or answered. then the source takes a token of its bucket, the client,
+#the companions, the daemons in a handshake and the hub are not limited. returns False if the datagram is dropped
+def admit_daemon_datagram(msg, address):
+    if daemon_admission is None:
+        return True
+    if len(msg) < MIN_HEADER_SIZE or msg[0] not in (1, 2) or (msg[0] == 1 and msg[1] not in KNOWN_OPERATIONS):
+        daemon_admission.rejected += 1
+        return False
+    if address in handshake_peers or address[:2] == hub_address or any(address == member for _, member in clients[1:]):
+        return True
+    return daemon_admission.admit(address[0])
+
+
+#function for the admission control of a client datagram, the message type is checked and the sources that are not the client are limited
+def admit_client_datagram(msg, address):
+    if client_admission is None:
+        return True
+    if not msg or msg[0] > MessageType.SEARCH.value:
+        client_admission.rejected += 1
+        return False
+    if clients and address == clients[0][1]:
+        return True
+    return client_admission.admit(address[0])
+
+
+#function to check if an error reply can be sent to address, at most ERROR_REPLY_RATE per source and ERROR_REPLY_LIMIT in all,
+#so the daemon does not reflect a flood to a spoofed source address
+def error_reply_allowed(address):
+    return error_replies is None or error_replies.admit(address[0])
+
+
+#function to receive a message from the client
+def recv_from_client():
+    global deferred_client_message
+    if deferred_client_message is not None:
+        msg, deferred_client_message = deferred_client_message, None
+        return msg
+    #the client is waited for without a timeout
+    while True:
+        if control_plane is not None:
+            msg, address = worker_recv(client_channel, client_pool, None)
+        else:
+            msg, address = client_pool.recvfrom(client_socket)
+        if admit_client_datagram(msg, address):
+            return msg, address
+
+
+#function to update the state of this worker and the daemons it is registered for in the control plane
+def sync_control_plane():
+    global claimed_peers
+    if not clients:
+        control_plane.publish(worker_id, ControlPlane.IDLE)
+    elif len(clients) > 1:
+        control_plane.publish(worker_id, ControlPlane.CHAT, clients[0][1])
+    elif waiting_for_peer:
+        control_plane.publish(worker_id, ControlPlane.WAITING, clients[0][1])
+    else:
+        control_plane.publish(worker_id, ControlPlane.CONNECTED, clients[0][1])
+
+    wanted = set(peer_addresses()) | handshake_peers
+    for address in claimed_peers - wanted:
+        control_plane.release(address, worker_id)
+    for address in wanted - claimed_peers:
+        control_plane.claim(address, worker_id)
+    claimed_peers = wanted
+
+
+#function to find the worker a datagram of another daemon belongs to, SYNs of unknown daemons go to a worker whose client waits for requests
+def route_daemon_datagram(msg, address):
+    owner = control_plane.lookup(address)
+    if owner is None and msg[:2] == b'\x01\x02':
+        owner = control_plane.find_state(address, ControlPlane.WAITING)
+    return owner
+
+
+#function to find the worker a client message belongs to, a connecting client gets a worker without a client
+def route_client_datagram(msg, address):
+    owner = control_plane.find_client(address)
+    if owner is None and msg[:1] == MessageType.CONNECTION.to_bytes():
+        owner = control_plane.find_state(address, ControlPlane.IDLE)
+    return owner
+
+
+#function that reads the sockets of a worker all the time and passes every datagram on to the channel of the worker that owns it,
+#a worker that is busy with a handshake or a chat would otherwise hold back the datagrams the kernel hashed to its sockets
+def dispatch_datagrams():
+    routes = {daemon_socket: (route_daemon_datagram, 0, BufferPool()), client_socket: (route_client_datagram, 1, BufferPool())}
+    while True:
+        ready, _, _ = select.select(list(routes), [], [])
+        for sock in ready:
+            route, kind, pool = routes[sock]
+            try:
+                msg, address = pool.recvfrom(sock)
+            except OSError:
+                continue
+            #the datagrams drained from the socket are passed on as well, they would not wake up select again
+            while True:
+                owner = route(msg, address)
+                if owner is None:
+                    owner = worker_id
+                forward_channels[owner][kind].sendmsg([struct.pack('!4sH', socket.inet_aton(address[0]), address[1]), msg])
+                if not pool.queue:
+                    break
+                msg, address = pool.queue.popleft()
+
+
+#function to receive a datagram in a worker process from its channel with the timeout of the protocol
+def worker_recv(channel, pool, timeout):
+    sync_control_plane()
+    data, _ = pool.recvfrom(channel, timeout)
+    ip, port = struct.unpack_from('!4sH', data)
+    return data[6:], (socket.inet_ntoa(ip), port)
+
+
+#function to get a printable name of a daemon address
+def peer_name(address):
+    return '@' + address[2] if len(address) == 3 else address[0]
+
+
+#function to tell the hub which username is served by this daemon (or that it is not served anymore)
+def register_with_hub(username, operation=RelayOperation.REGISTER):
+    envelope = b''.join([DatagramType.RELAY.to_bytes(), operation.to_bytes(), encode_username(username)])
+    daemon_socket.sendto(envelope, hub_address)
+
+
+#function that renews the route of the connected client at the hub, so that routes survive lost datagrams and hub restarts
+def keep_registered():
+    while True:
+        time.sleep(RELAY_REGISTER_INTERVAL)
+        if clients:
+            register_with_hub(clients[0][0])
+
+
+#function to get the daemon that owns a username in a cluster, None if it is this daemon (or there is no cluster)
+def cluster_owner(username):
+    if cluster is None:
+        return None
+    owner = cluster.owner(username)
+    return None if owner == cluster.address else owner
+
+
+#function to tell a client to connect to the daemon that owns its username, the client leaves this daemon with a DISCONNECTION
+def redirect_client(owner, address):
+    client_socket.sendto(b''.join([MessageType.REDIRECT.to_bytes(), owner.encode('ascii')]), address)
+
+
+#function to move the client to the daemon that owns its username after the ring changed. only a client at the menu is moved,
+#a client in a chat, a handshake or waiting for a request is moved at its next command (see client_commands)
+def rebalance():
+    if not clients or not disconnected or waiting_for_peer or handshake_peers:
+        return
+    owner = cluster_owner(clients[0][0])
+    if owner is not None:
+        print(f"{server_name}: {clients[0][0]} belongs to {owner} now, redirecting the client")
+        redirect_client(owner, clients[0][1])
+
+
+#function to compute the MAC of an announcement of the cluster, it covers the address of the sender so it can not be sent as another member
+def cluster_mac(msg, sender):
+    return hmac.digest(mac_secret, b''.join([b'SIMP CLUSTER', socket.inet_aton(sender), msg]), 'sha256')[:MAC_SIZE]
+
+
+#function to send an announcement to a daemon of the cluster, a JOIN names the members this daemon knows so that they find each other.
+#with a MAC key the announcement gets a MAC
+def send_cluster(operation, address):
+    members = ','.join(cluster.members()) if operation == ClusterOperation.JOIN else ''
+    msg = b''.join([operation.to_bytes(), members.encode('ascii')])
+    if mac_secret is not None:
+        msg += cluster_mac(msg, cluster.address)
+    try:
+        cluster_socket.sendto(msg, (address, CLUSTER_PORT))
+    except OSError as e:
+        print("ERROR", e, f"while announcing to {address} has occured")
+
+
+#function to probe a daemon named in the JOIN of a member with a JOIN, it joins the ring only once it answers with its own JOIN.
+#a daemon is probed at most once per CLUSTER_TIMEOUT, the probes that were not answered within it are forgotten.
+#at most MAX_CLUSTER_PROBES daemons are probed per CLUSTER_TIMEOUT, so a forged JOIN can not make the daemon a reflector
+def probe_cluster(address, now):
+    try:
+        ipaddress.IPv4Address(address)
+    except ValueError:
+        return
+    if address == cluster.address or address in cluster.seen or address in cluster_targets:
+        return
+    for expired in [probed for probed, since in cluster_probes.items() if now - since >= CLUSTER_TIMEOUT]:
+        del cluster_probes[expired]
+    if address in cluster_probes or len(cluster_probes) >= MAX_CLUSTER_PROBES:
+        return
+    cluster_probes[address] = now
+    send_cluster(ClusterOperation.JOIN, address)
+
+
+#function that runs as the cluster thread, it receives the announcements of the other daemons and updates the ring.
+#with a MAC key the announcements without a valid MAC are dropped
+def serve_cluster():
+    while True:
+        try:
+            msg, address = cluster_socket.recvfrom(RECV_BUFFER_SIZE)
+        except OSError as e:
+            print("ERROR", e, "while receiving a cluster announcement has occured")
+            continue
+        if not msg or msg[0] not in (1, 2) or (daemon_admission is not None and not daemon_admission.admit(address[0])):
+            continue
+        member = address[0]
+        if mac_secret is not None:
+            if len(msg) < 1 + MAC_SIZE or not hmac.compare_digest(cluster_mac(msg[:-MAC_SIZE], member), msg[-MAC_SIZE:]):
+                continue
+            msg = msg[:-MAC_SIZE]
+        if msg[0] == ClusterOperation.JOIN.value:
+            now = time.monotonic()
+            if cluster.join(member, now):
+                cluster_probes.pop(member, None)
+                print(f"{server_name}: {member} joined the cluster, members {', '.join(cluster.members())}")
+                send_cluster(ClusterOperation.JOIN, member)
+                rebalance()
+            #the daemons named in the JOIN of a member that are not known yet get a JOIN, they join once they answer with theirs
+            for other in str(msg[1:], 'ascii', errors='replace').split(','):
+                if other:
+                    probe_cluster(other, now)
+        elif cluster.leave(member):
+            print(f"{server_name}: {member} left the cluster, members {', '.join(cluster.members())}")
+            rebalance()
+
+
+#function that runs as the announcement thread of the cluster. every CLUSTER_ANNOUNCE_INTERVAL the daemon announces itself to the seeds
+#and the members, the members that did not announce themselves within CLUSTER_TIMEOUT are taken off the ring
+def announce_cluster():
+    while True:
+        for address in sorted(cluster_targets | set(cluster.seen)):
+            send_cluster(ClusterOperation.JOIN, address)
+        time.sleep(CLUSTER_ANNOUNCE_INTERVAL)
+        gone = cluster.expire(time.monotonic() - CLUSTER_TIMEOUT)
+        if gone:
+            print(f"{server_name}: {', '.join(gone)} did not announce itself, members {', '.join(cluster.members())}")
+            rebalance()
+
+
+#function to tell the members that this daemon leaves the cluster, their users move at once instead of after CLUSTER_TIMEOUT
+def leave_cluster():
+    for address in cluster.members():
+        if address != cluster.address:
+            send_cluster(ClusterOperation.LEAVE, address)
+
+
+#function to join the cluster, the daemon announces itself to the seeds and listens for the announcements of the others
+def start_cluster(address, seeds):
+    global cluster, cluster_socket
+    cluster = HashRing(socket.gethostbyname(address))
+    cluster_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    cluster_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    cluster_socket.bind((address, CLUSTER_PORT))
+    for seed in seeds:
+        try:
+            seed = socket.gethostbyname(seed)
+        except OSError:
+            print(f"{server_name}: cluster member {seed} is not a valid address")
+            continue
+        if seed != cluster.address:
+            cluster_targets.add(seed)
+    threading.Thread(target=serve_cluster, daemon=True).start()
+    threading.Thread(target=announce_cluster, daemon=True).start()
+    atexit.register(leave_cluster)
+    print(f"{server_name}: Joining the cluster of {', '.join(sorted(cluster_targets)) or 'this daemon only'}")
+
+
+#function to get the addresses of the daemons in the chat, one for a normal chat and one per member for a group chat
+def peer_addresses():
+    return [address for _, address in clients[1:]]
+
+
+#function to remove a daemon from the chat
+def remove_peer(address):
+    with flow_changed:
+        sessions.pop(address, None)
+        receive_windows.pop(address, None)
+        flow_changed.notify_all()
+    session_keys.pop(address, None)
+    for i in range(len(clients) - 1, 0, -1):
+        if clients[i][1] == address:
+            return clients.pop(i)
+    return None
 
 
 #function that handles reciving of chat messages from another daemon
 def receive_chat_message():
-    global clients, daemon_socket, client_socket, messages, t1, ack_received, disconnected
-    
+    global clients, daemon_socket, client_socket, messages, t1, disconnected, linger_stopped
+    linger_stopped = False
+
     while True:
         if disconnected:
             print(f"{server_name}: Connection is disconnected. No further messages will be received.")
-            clients.pop(1)
-            
+            del clients[1:]
+            linger()
             return  # Exit if the connection is disconnected
     
+        #the socket timeout doubles as the retransmission timer of the sent chat datagrams
+        timeout = check_timers()
         try:
-            daemon_socket.settimeout(5)
-            msg, sender_addr = daemon_socket.recvfrom(1024)
-            header = build_header(msg)
+            set_daemon_timeout(5 if timeout is None else min(max(timeout, 0.01), 5))
+            msg, sender_addr = recv_from_daemon()
         except socket.timeout:
-            print("log listening for client")
+            if timeout is None:
+                print("log listening for client")
             continue
         except ConnectionResetError:
             print("Lost connection with companion. type something to go back to menu")
             disconnected = True
-            clients.pop(1)
+            del clients[1:]
             msg_type = MessageType.ERROR.to_bytes()
             msg = "Lost connection with companion's server type something to go back to menu".encode('ascii')
             client_socket.sendto(b''.join([msg_type, msg]), clients[0][1])
             return False
+        if not handle_peer_datagram(msg, sender_addr):
+            linger()
+            return
+
+
+#function that goes on answering the repeated FINs of the companions that left after the chat ended, their FIN+ACK can be lost.
+#it runs in the receive thread until the FIN+ACKs expire or the main thread needs the daemon socket (stop_lingering),
+#the other datagrams it gets are kept for the main thread
+def linger():
+    global lingering
+    lingering = True
+    while not linger_stopped and any(expiry > time.monotonic() for expiry, _, _ in closed_chats.values()):
+        set_daemon_timeout(LINGER_INTERVAL)
         try:
-            if header.type == DatagramType.CONTROL and header.operation == OperationType.SYN:
-                username = encode_username(header.username)
-                msg_type = MessageType.ERROR.to_bytes()
-                response_msg = b''.join([msg_type, username])
-                daemon_socket.sendto(response_msg, sender_addr)
-                print(f"{server_name}: Rejected connection for {username}. Already connected.")
+            msg, address = recv_from_daemon()
+        except socket.timeout:
+            continue
+        except OSError:
+            break
+        if len(lingered) < MAX_PENDING_REQUESTS:
+            lingered.append((bytes(msg), address))
+    lingering = False
 
-            elif header.type == DatagramType.CHAT and header.operation == OperationType.MESSAGE:
-                if not disconnected:  # Prevent sending chat messages if disconnected
-                    message = get_msg_payload(msg)
-                    print(f"{server_name}: Received message from {sender_addr}: {message.decode('ascii')}")
-                    msg_type = MessageType.CHAT.to_bytes()
-                    username = encode_username(header.username)
-                    msg = b''.join([msg_type, username, message])
-                    client_socket.sendto(msg, clients[0][1])
-
-                    seq = header.seq.to_bytes(1, byteorder='big')
-                    dtype1 = DatagramType.CONTROL.to_bytes()
-                    operation1 = OperationType.ACK.to_bytes()
-                    ack_msg = b''.join([dtype1, operation1, seq, username])
-                    # Sends ACK
-                    daemon_socket.sendto(ack_msg, sender_addr)
-                    print(f"Sending acknowledgement for message with seq {seq}")
-
-            elif header.type == DatagramType.CONTROL and header.operation == OperationType.ACK:
-                seq = header.seq
-                with ack_lock:
-                    ack_received[seq] = True
-                print(f"ACK received for seq {seq} from {sender_addr}")
-
-            elif header.type == DatagramType.CONTROL and header.operation == (
-                    OperationType.FIN.value | OperationType.ACK.value):
+
+#function to end the lingering of the receive thread before the main thread receives from the daemon socket
+def stop_lingering():
+    global linger_stopped
+    linger_stopped = True
+    if t1 is not None and t1.is_alive():
+        t1.join()
+
+
+#function to wait until the receive thread is done with the chat, it can linger on
+def wait_for_receiver():
+    while t1.is_alive() and not lingering:
+        t1.join(LINGER_INTERVAL)
+
+
+#function that receives the group chat messages sent to the multicast group, they are handled like the ones received on the daemon socket
+def receive_multicast():
+    while True:
+        try:
+            msg, sender_addr = multicast_pool.recvfrom(multicast_socket)
+        except OSError as e:
+            print("ERROR", e, "while receiving a multicast datagram has occured")
+            return
+        #the datagrams of daemons that are not in the chat (including the own ones) are ignored
+        if disconnected or sender_addr not in peer_addresses():
+            continue
+        handle_peer_datagram(msg, sender_addr)
+
+
+#function that handles a datagram of another daemon during the chat, returns False when the chat is over
+def handle_peer_datagram(msg, sender_addr):
+    global clients, disconnected, mac_rejected
+    received = time.perf_counter_ns()
+    #the MAC is checked before anything else is parsed, forged and stray datagrams cost one hash
+    keys = session_keys.get(sender_addr)
+    if keys is not None:
+        verified = verify_mac(msg, keys[1])
+        if verified is not None:
+            msg = verified
+        #a retransmitted SYN+ACK (the final ACK was lost) was sent before the chat had keys, it is only answered with the ACK again
+        elif msg[:2] != bytes([1, OperationType.SYN.value | OperationType.ACK.value]):
+            mac_rejected += 1
+            return True
+    header = build_header(msg)
+    if spans is not None:
+        spans.record('parse', received)
+    peers = peer_addresses()
+    try:
+        #retransmitted SYN of the companion, the handshake is already complete
+        if header.type == DatagramType.CONTROL and header.operation == OperationType.SYN and sender_addr in peers:
+            return True
+
+        #retransmitted SYN+ACK of the companion, the final ACK was lost
+        elif header.type == DatagramType.CONTROL and header.operation == (
+                OperationType.SYN.value | OperationType.ACK.value):
+            if sender_addr in peers:
+                send_control(build_ack_message(0), sender_addr, received)
+
+        elif header.type == DatagramType.CONTROL and header.operation == OperationType.SYN:
+            username = encode_username(header.username)
+            msg_type = MessageType.ERROR.to_bytes()
+            response_msg = b''.join([msg_type, username])
+            if error_reply_allowed(sender_addr):
+                send_control(response_msg, sender_addr, received)
+            print(f"{server_name}: Rejected connection for {header.username}. Already connected.")
+
+        #a companion gets the errors of a datagram that passed the admission control but not the parse, as a binary error code
+        elif not header.is_ok and sender_addr in peers:
+            if error_reply_allowed(sender_addr):
+                send_control(build_reply(msg), sender_addr, received)
+            if debug:
+                print(f"{server_name}: Errors in a datagram of {sender_addr}:\n{build_error_message(header)}")
+
+        elif header.type == DatagramType.CHAT and header.operation == OperationType.MESSAGE:
+            if not disconnected and sender_addr in peers:  # Prevent sending chat messages if disconnected
+                message = get_msg_payload(msg)
+                window = receive_windows.get(sender_addr)
+                if window is None:
+                    window = receive_windows[sender_addr] = ReceiveWindow()
+                delivered = window.receive(header.seq, header.username, message, time.monotonic())
+                if delivered is None:
+                    print(f"{server_name}: Datagram with seq {header.seq} from {sender_addr} is outside of the receive window")
+                    return True
+
+                # Sends ACK with the receive window
+                send_control(build_window_ack(header.seq, header.username, window.advertised()), sender_addr, received)
+                if debug:
+                    print(f"Sending acknowledgement for message with seq {header.seq}")
+                deliver_messages(delivered, sender_addr, received)
+
+        elif header.type == DatagramType.CONTROL and header.operation == OperationType.ACK:
+            #only the ACKs of chat datagrams carry a receive window, a repeated ACK of the handshake is not counted
+            payload = get_msg_payload(msg)
+            rwnd = int.from_bytes(payload[:2], byteorder='big') if len(payload) >= 2 else None
+            with flow_changed:
+                session = sessions.get(sender_addr)
+                if session is not None and rwnd is not None:
+                    entry = session.in_flight.get(header.seq)
+                    if spans is not None and entry is not None:
+                        spans.add('ack_retransmitted' if entry[3] else 'ack', int((time.monotonic() - entry[1]) * 1e9))
+                    for seq in session.on_ack(header.seq, rwnd, time.monotonic()):
+                        print(f"Datagram with seq {seq} to {sender_addr} is lost, retransmitting")
+                        retransmit(session, seq, sender_addr)
+                    flow_changed.notify_all()
+            if debug:
+                print(f"ACK received for seq {header.seq} from {sender_addr}")
+
+        #error reply of a companion to a malformed datagram, a binary error code is turned into the names of the errors
+        elif header.type == DatagramType.CONTROL and header.operation == OperationType.MESSAGE and sender_addr in peers:
+            errors = parse_error_reply(get_msg_payload(msg))
+            print(f"{server_name}: {sender_addr} found errors in a datagram: {errors}")
+
+        elif header.type == DatagramType.CONTROL and header.operation == (
+                OperationType.FIN.value | OperationType.ACK.value):
+            remove_peer(sender_addr)
+            #the chat is over when every member confirmed the FIN
+            if len(clients) < 2:
                 disconnected = True
-                return
-            
-            elif header.type == DatagramType.CONTROL and header.operation == OperationType.FIN:
-                print(f"{server_name}: Received FIN request, closing the connection.")
-                clients.pop(1)  # Clean up clients list (remove client info)
+                return False
+        
+        #FIN of a daemon that is not the companion, e.g. a withdrawn request
+        elif header.type == DatagramType.CONTROL and header.operation == OperationType.FIN and sender_addr not in peers:
+            return True
 
-                # Send a DISCONNECT_REQUEST to notify client about disconnection
-                msg_type = MessageType.DISCONNECT_REQUEST.to_bytes()
+        elif header.type == DatagramType.CONTROL and header.operation == OperationType.FIN:
+            print(f"{server_name}: Received FIN request from {header.username}.")
+
+            #the FIN+ACK is sent before the companion is removed, with the MAC of the chat
+            seq = header.seq.to_bytes(1, byteorder='big')
+            dtype1 = DatagramType.CONTROL.to_bytes()
+            operation1 = (OperationType.FIN.value | OperationType.ACK.value).to_bytes(1, byteorder='big')
+            ack_msg = b''.join([dtype1, operation1, seq, encode_username(header.username)])
+            send_control(ack_msg, sender_addr, received)
+            remember_closed_chat(sender_addr, ack_msg)
+            print(f"Sending acknowledgement for FIN request with seq {seq}")
+            remove_peer(sender_addr)  # Clean up clients list (remove client info)
+
+            #in a group chat the other members stay, the client is told who left
+            if len(clients) > 1:
+                msg_type = MessageType.CHAT.to_bytes()
                 username = encode_username(header.username)
-                client_socket.sendto(b''.join([msg_type, username]), clients[0][1])
-                seq = header.seq.to_bytes(1, byteorder='big')
-                dtype1 = DatagramType.CONTROL.to_bytes()
-                operation1 = (OperationType.FIN.value | OperationType.ACK.value).to_bytes(1, byteorder='big')
-                ack_msg = b''.join([dtype1, operation1, seq, encode_username(header.username)])
-                daemon_socket.sendto(ack_msg, sender_addr)
-                print(f"Sending acknowledgement for FIN request with seq {seq}")
-
-                # Set disconnection flag to True and exit loop
-                disconnected = True
-                print(f"{server_name}: Daemon is disconnected and stopping communication.")
-                return
-        except Exception as e:
-            print("ERROR",e,"while receiving a messages has occured")
-            
-            return
+                client_socket.sendto(b''.join([msg_type, username, b'\x00', b'left the chat']), clients[0][1])
+                return True
+
+            # Send a DISCONNECT_REQUEST to notify client about disconnection
+            msg_type = MessageType.DISCONNECT_REQUEST.to_bytes()
+            username = encode_username(header.username)
+            client_socket.sendto(b''.join([msg_type, username]), clients[0][1])
+
+            # Set disconnection flag to True and exit loop
+            disconnected = True
+            print(f"{server_name}: Daemon is disconnected and stopping communication.")
+            return False
+        return True
+    except Exception as e:
+        print("ERROR",e,"while receiving a messages has occured")
         
+        return False
+
+
+#function to pass the messages of a companion that are now in order on to the client, in a group chat they also go to the other members.
+#received is the perf_counter_ns of the datagram that made them deliverable, for the deliver span (0 if not measured)
+def deliver_messages(delivered, sender_addr, received=0):
+    for username, message in delivered:
+        print(f"{server_name}: Received message from {sender_addr}: {str(message, 'ascii')}")
+        msg_type = MessageType.CHAT.to_bytes()
+        client_socket.sendto(b''.join([msg_type, encode_username(username), message]), clients[0][1])
+        record_history(username, message[1:])
+
+        #in a group chat the message is passed on to the other members, it is kept longer than the receive buffer and is copied
+        if len(clients) > 2:
+            if queue_message(bytes(message), username, exclude=sender_addr):
+                print(f"Message of {username} queued for the group.")
+            else:
+                print(f"Outbound queue is full, message of {username} is not forwarded to the group.")
+        if received and spans is not None:
+            spans.record('deliver', received)
+
+
+#function to send one encoded datagram to several daemons in one round, through the multicast group if it is enabled
+def send_to_members(datagram, addresses, multicast=False):
+    if multicast and multicast_group is not None and len(addresses) > 1:
+        try:
+            daemon_socket.sendto(datagram, (multicast_group, 7777))
+            return
+        except OSError as e:
+            print("ERROR", e, "while sending to the multicast group, sending to every member")
+    for address in addresses:
+        send_to_daemon(datagram, address)
+
 
 #function that handles sending of chat messages
 def send_chat_message(message='', type=True, seq=0):
@@ -442,19 +2105,10 @@ def send_chat_message(message='', type=True, seq=0):
         try:
             if type:
                 message = build_chat_message(message, seq)
-                daemon_socket.sendto(message, clients[1][1])
-                print(f"Sending message to {clients[1][1]}: {message}")
+                send_to_members(message, peer_addresses())
+                print(f"Sending message to {peer_addresses()}: {message}")
             else:
-                message = build_fin_message(0)
-                
-                tries = 3
-                while tries > 0:
-
-                    daemon_socket.settimeout(3)
-                    daemon_socket.sendto(message, clients[1][1])
-                    return
-                
-                print(f"Sent FIN message to {clients[1][1]}: {message}")
+                send_fin()
                 return False
 
         except ConnectionResetError:
@@ -462,72 +2116,280 @@ def send_chat_message(message='', type=True, seq=0):
             msg_type = MessageType.ERROR.to_bytes()
             payload = "Lost connection with receipient".encode('ascii')
             client_socket.sendto(b''.join([msg_type, payload]), clients[0][1])
-            clients.pop()
+            del clients[1:]
             return False
     else:
         print("Cannot reach another client, discarding message")
         return False
 
 
-#function to request connection to another daemon using tree-way handshake
-def request_connection(host, port):
+#function to end the chat with a FIN. it is retransmitted on the RTO of the chat to the companions that did not confirm it yet,
+#until the receiving thread saw the FIN+ACK (or a FIN) of every companion or FIN_TIMEOUT passed. then the chat is left anyway
+def send_fin():
+    global disconnected
+    message = build_fin_message(0)
+    deadline = time.monotonic() + FIN_TIMEOUT
+    targets = peer_addresses()
+    rto = max([sessions[address].rto for address in targets if address in sessions], default=INITIAL_RTO)
+    while True:
+        send_to_members(message, targets)
+        print(f"Sent FIN message to {targets}: {message}")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        t1.join(min(rto, remaining))
+        targets = peer_addresses()
+        if not t1.is_alive() or not targets:
+            return
+        rto = min(rto * 2, MAX_RTO)
+    print(f"{server_name}: No FIN+ACK from {', '.join(peer_name(address) for address in peer_addresses())}, leaving the chat")
+    disconnected = True
+
+
+#function to remember the FIN+ACK sent to a companion that left the chat, for its repeated FINs when the FIN+ACK is lost
+def remember_closed_chat(address, ack_msg):
+    now = time.monotonic()
+    for closed in [closed for closed, (expiry, _, _) in closed_chats.items() if expiry <= now]:
+        del closed_chats[closed]
+    closed_chats[address] = (now + FIN_TIMEOUT, ack_msg, session_keys.get(address, ()))
+
+
+#function to answer a repeated FIN of a daemon that left the chat with the FIN+ACK again, returns False if it is not such a FIN
+def answer_closed_chat(address):
+    entry = closed_chats.get(address)
+    if entry is None or address in peer_addresses():
+        return False
+    expiry, ack_msg, keys = entry
+    if time.monotonic() >= expiry:
+        del closed_chats[address]
+        return False
+    print(f"{server_name}: Repeated FIN from {peer_name(address)}, sending the FIN+ACK again")
+    send_to_daemon(ack_msg, address, keys)
+    return True
+
+
+#function to look a host up in the negative reachability cache, expired entries are dropped and a hit becomes the most recently used
+def cached_unreachable(host):
+    entry = unreachable.pop(host, None)
+    if entry is None:
+        return None
+    expiry, reason = entry
+    if time.monotonic() >= expiry:
+        return None
+    unreachable[host] = entry
+    return reason
+
+
+#function to remember a daemon that did not answer or refused the connection, the least recently used hosts make room
+def mark_unreachable(host, reason, ttl=UNREACHABLE_TTL):
+    unreachable.pop(host, None)
+    unreachable[host] = (time.monotonic() + ttl, reason)
+    evict_entries(unreachable, len(unreachable) - MAX_UNREACHABLE)
+    print(f"{server_name}: {host} cached as {reason} for {ttl} seconds")
+
+
+#function to evict the first count entries of a table, the oldest or the least recently used ones when lookups move entries to the end.
+#returns the number of evicted entries
+def evict_entries(table, count):
+    keys = list(table)[:max(count, 0)]
+    for key in keys:
+        table.pop(key, None)
+    return len(keys)
+
+
+#function to remember the SYN of a daemon until the next client decides, the oldest requests make room for new ones
+def add_pending(header, address, syn):
+    #retransmitted SYNs of the same daemon are not new requests
+    if any(pending[1] == address for pending in pending_requests):
+        return
+    pending_requests.append((header, address, time.monotonic()))
+    pending_syns[address] = syn
+    evict_pending(len(pending_requests) - MAX_PENDING_REQUESTS)
+
+
+#function to drop the count oldest pending requests, returns the number of dropped requests
+def evict_pending(count):
+    count = max(min(count, len(pending_requests)), 0)
+    for _, address, _ in pending_requests[:count]:
+        pending_syns.pop(address, None)
+    del pending_requests[:count]
+    return count
+
+
+#function to drop the pending requests the requesting daemon gave up on (after SYN_TIMEOUT), they can not be accepted anymore
+def expire_pending():
+    now = time.monotonic()
+    evict_pending(sum(1 for _, _, received in pending_requests if now - received >= SYN_TIMEOUT))
+
+
+#function to send a SYN to one or several daemons and wait for the first one to accept,
+#SYNs are retransmitted on an exponential schedule to every daemon that has not answered yet until the overall deadline expires.
+#if an ack is given every accepting daemon gets it right away and all of them are collected instead of only the first one.
+#returns the list of (header, address) of the accepting daemons and the list of (header, address) of the refusing ones
+def send_syn(msg, addresses, ack=None):
+    deadline = time.monotonic() + SYN_TIMEOUT
+    rto = SYN_RETRANSMIT_INITIAL
+    waiting = set(addresses)
+    accepted = []
+    refusals = []
+    handshake_peers.update(addresses)
+    try:
+        next_send = time.monotonic()
+        attempt = 0
+        while waiting:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if now >= next_send:
+                attempt += 1
+                if attempt > 1:
+                    print(f"{server_name}: No reply from {', '.join(peer_name(address) for address in waiting)}, retransmitting SYN")
+                for address in waiting:
+                    send_to_daemon(msg, address)
+                next_send = min(now + rto, deadline)
+                rto = min(rto * 2, SYN_RETRANSMIT_MAX)
+                continue
+            set_daemon_timeout(next_send - now)
+            try:
+                response, server_address = recv_from_daemon()
+            except socket.timeout:
+                continue
+            #datagrams from other daemons are not an answer to this SYN
+            if server_address not in waiting:
+                continue
+            header = build_header(response)
+            waiting.discard(server_address)
+            if header.type == DatagramType.CONTROL and header.operation == (OperationType.SYN.value | OperationType.ACK.value):
+                if not remember_handshake(server_address, msg, response, requester=True):
+                    refuse_handshake(server_address)
+                    refusals.append((header, server_address))
+                    continue
+                accepted.append((header, server_address))
+                if ack is None:
+                    break
+                send_to_daemon(ack, server_address)
+            else:
+                refusals.append((header, server_address))
+    finally:
+        handshake_peers.difference_update(addresses)
+    return accepted, refusals
+
+
+#function to request connection to one or several daemons using tree-way handshake,
+#when several hosts are given the SYNs are sent to all of them at once, the first one to accept gets the final ACK and the rest get a FIN.
+#for a group chat every daemon that accepts becomes a member of the chat
+def request_connection(hosts, port, group=False):
     global clients, daemon_socket, client_socket, t1, disconnected
     client_name = clients[0][0]
     client_addr = clients[0][1]
 
-    daemon_socket.settimeout(30)
     dtype = DatagramType.CONTROL.to_bytes()
     operation = OperationType.SYN.to_bytes()
     seq = int(0).to_bytes(1, byteorder='big')
     username = encode_username(client_name)
-    msg = b''.join([dtype, operation, seq, username])
-    #Sends SYN
-    print(f"{server_name}: Sending SYN to {host}:{port}.")
-    try:
-        daemon_socket.sendto(msg, (host, port))
+    msg = b''.join([dtype, operation, seq, username, handshake_payload()])
+    ack_msg = b''.join([dtype, OperationType.ACK.to_bytes(), seq, username])
+
+    addresses = {}
+    for host in hosts:
+        #skip the daemons that recently did not answer or refused
+        reason = cached_unreachable(host)
+        if reason is not None:
+            print(f"{server_name}: {host} is {reason}, not sending SYN")
+            continue
+        #@username is a user whose daemon is reached through the relay hub
+        if host.startswith('@') and hub_address is not None:
+            addresses[(hub_address[0], hub_address[1], host[1:])] = host
+            continue
+        #in a cluster @username is a user of the daemon that owns it on the ring
+        if host.startswith('@') and cluster is not None:
+            addresses[(cluster.owner(host[1:]), port)] = host
+            continue
+        try:
+            addresses[(socket.gethostbyname(host), port)] = host
+        except OSError:
+            print('INVALID IP address', host)
+            mark_unreachable(host, 'unreachable')
 
-        response, server_address = daemon_socket.recvfrom(1024)
-        print(f"{server_name}: Received response from {server_address}")
-        header = build_header(response)
-        #checks if datagram type is CONTROL and operation type is a combination of SYN + ACK
-        if header.type == DatagramType.CONTROL and header.operation == (OperationType.SYN.value | OperationType.ACK.value):
+    if not addresses:
+        msg_type = MessageType.ERROR.to_bytes()
+        client_socket.sendto(msg_type, client_addr)
+        return False
 
-            print(f"{server_name}: SYN+ACK received. Sending final ACK")
-            dtype1 = DatagramType.CONTROL.to_bytes()
-            operation1 = OperationType.ACK.to_bytes()
-            ack_msg = b''.join([dtype1, operation1, seq, username])
-            #Sends ACK
-            daemon_socket.sendto(ack_msg, (host, port))
+    #Sends SYN
+    print(f"{server_name}: Sending SYN to {', '.join(addresses.values())}.")
+    stop_lingering()
+    try:
+        accepted, refusals = send_syn(msg, addresses, ack_msg if group else None)
+
+        for refusal, address in refusals:
+            #if received operation type is FIN connection is declined, otherwise the user is already in another chat
+            if refusal.type == DatagramType.CONTROL and refusal.operation == OperationType.FIN:
+                mark_unreachable(addresses[address], 'refusing', REFUSED_TTL)
+            #a SYN+ACK without MACs was refused by this daemon
+            elif refusal.type == DatagramType.CONTROL and refusal.operation == (OperationType.SYN.value | OperationType.ACK.value):
+                mark_unreachable(addresses[address], 'unauthenticated', REFUSED_TTL)
+            else:
+                mark_unreachable(addresses[address], 'busy', REFUSED_TTL)
+
+        #checks if any daemon answered with SYN + ACK
+        if accepted:
+            if not group:
+                header, server_address = accepted[0]
+                print(f"{server_name}: SYN+ACK received from {server_address}. Sending final ACK")
+                #Sends ACK
+                send_to_daemon(ack_msg, server_address)
+
+                #the other daemons lost the race, tell them the request is withdrawn
+                fin_msg = b''.join([dtype, OperationType.FIN.to_bytes(), seq, username])
+                refused = {address for _, address in refusals}
+                for address in addresses:
+                    if address != server_address and address not in refused:
+                        send_to_daemon(fin_msg, address)
 
             msg_type = MessageType.ACCEPT.to_bytes()
-            username = encode_username(header.username)
+            username = encode_username(', '.join(header.username for header, _ in accepted))
             client_socket.sendto(b''.join([msg_type, username]), client_addr)
             
-            clients.append((header.username, server_address))
+            clients.extend((header.username, server_address) for header, server_address in accepted)
             #Start receiving chat messages from another daemon
             print(f"{server_name}: Connection established")
             disconnected = False
+            reset_flow()
             t1 = threading.Thread(target=receive_chat_message, daemon=True)
             t1.start()
 
             #Start chat with client
             chat_with_client()
             return True
-       
-        #if received operation type is FIN connection is declined
-        elif header.type == DatagramType.CONTROL and header.operation == OperationType.FIN:
-            username = encode_username(header.username)
+
+        #the daemons that did not answer at all are unreachable
+        answered = {address for _, address in refusals}
+        for address, host in addresses.items():
+            if address not in answered:
+                print(f"{server_name}: No reply from {host} within {SYN_TIMEOUT} seconds")
+                mark_unreachable(host, 'unreachable')
+
+        declines = [refusal for refusal, _ in refusals if refusal.operation == OperationType.FIN]
+        if declines:
+            username = encode_username(declines[0].username)
             msg_type = MessageType.DECLINE.to_bytes()
             client_socket.sendto(b''.join([msg_type, username]), client_addr)
             print(f"{server_name}: FIN received. Connection declined")
-            return
-        #if other we count that user is already in
-        else:
+        elif refusals:
             msg_type = MessageType.ERROR.to_bytes()
-            username = encode_username(header.username)
+            username = encode_username(refusals[0][0].username)
             client_socket.sendto(b''.join([msg_type, username]), client_addr)
             print(f"{server_name}: Rejected connection. User is already connected.")
-            return
+        else:
+            msg_type = MessageType.ERROR.to_bytes()
+            client_socket.sendto(msg_type, client_addr)
+        return False
+
+    except ConnectionResetError:
+        print("Lost connection with client. going back to wait for clients state")
+        clients = []
+        return False
 
     except OSError:
         print('INVALID IP address')
@@ -536,11 +2398,6 @@ def request_connection(host, port):
         client_commands()
         return False
     
-    except ConnectionResetError:
-        print("Lost connection with client. going back to wait for clients state")
-        clients = []
-        return False
-    
     except Exception as e:
         print("Error",e,"while requesting a connection has occured")
         return False
@@ -551,33 +2408,57 @@ def check_pending():
     global clients, client_socket, daemon_socket, t1
 
     print(f"{server_name}: Check for pending requests")
-    daemon_socket.settimeout(1)
+    stop_lingering()
+    set_daemon_timeout(1)
     try:
-        response, server_address = daemon_socket.recvfrom(1024)
+        response, server_address = recv_from_daemon()
         header = build_header(response)
         print(header.username)
         #if there is a request append pending_requests
         if header.type == DatagramType.CONTROL and header.operation == OperationType.SYN and len(clients) != 2:
-            pending_requests.append((header, server_address))
+            add_pending(header, server_address, bytes(response))
     except socket.timeout:
         print("No requests came, going back to client commands")
 
 
+#function to wait for the final ACK of the handshake, retransmitted SYNs of the requesting daemon are answered with the SYN+ACK again
+def wait_for_final_ack(synack, server_address):
+    handshake_peers.add(server_address)
+    try:
+        while True:
+            final_ack, address = recv_from_daemon()
+            ack_header = build_header(final_ack)
+            if address == server_address and ack_header.type == DatagramType.CONTROL and ack_header.operation == OperationType.SYN:
+                send_to_daemon(synack, server_address)
+                continue
+            #the final ACK was lost and the requesting daemon already sends chat datagrams, the handshake is complete.
+            #the chat datagram is not acknowledged here, so it is retransmitted
+            if address == server_address and ack_header.type == DatagramType.CHAT:
+                ack_header.type = DatagramType.CONTROL
+                ack_header.operation = OperationType.ACK
+            return ack_header, address
+    finally:
+        handshake_peers.discard(server_address)
+
+
 #function to handle pending requests
 def handle_pending(header, server_address):
     global clients, client_socket, daemon_socket, t1,disconnected
     client_name = clients[0][0]
     client_addr = clients[0][1]
     msg_type = MessageType.REQUEST.to_bytes()
+    #the request is answered now, the next client does not get it again
+    pending_requests[:] = [pending for pending in pending_requests if pending[1] != server_address]
+    syn = pending_syns.pop(server_address, b'')
 
     username_end = encode_username(header.username)
     orig_endname = header.username
     msg = b''.join([msg_type, username_end])
 
     client_socket.sendto(msg, client_addr)
-    daemon_socket.settimeout(60)
-    user_respond, _ = client_socket.recvfrom(1024)
-    print(f'{server_name}: received decision,{user_respond}')
+    set_daemon_timeout(60)
+    user_respond, _ = recv_from_client()
+    print(f'{server_name}: received decision,{bytes(user_respond)}')
 
     header = build_client_header(user_respond)
     print(header.type)
@@ -587,16 +2468,21 @@ def handle_pending(header, server_address):
         operation = (OperationType.SYN.value | OperationType.ACK.value).to_bytes(1, byteorder='big')
         seq = int(0).to_bytes(1, byteorder='big')
         username = encode_username(client_name)
-        msg = b''.join([dtype, operation, seq, username])
-        daemon_socket.sendto(msg, server_address)
+        msg = b''.join([dtype, operation, seq, username, handshake_payload()])
+        if not remember_handshake(server_address, syn, msg, requester=False):
+            refuse_handshake(server_address)
+            client_socket.sendto(MessageType.ERROR.to_bytes(), client_addr)
+            client_commands()
+            return
+        send_to_daemon(msg, server_address)
 
-        final_ack, server_address = daemon_socket.recvfrom(1024)
-        ack_header = build_header(final_ack)
+        ack_header, server_address = wait_for_final_ack(msg, server_address)
         #if the ACK is received start receiving chat messages from another daemon and start chat with client
         if ack_header.type == DatagramType.CONTROL and ack_header.operation == OperationType.ACK:
             print(f"{server_name}: Final ACK received. Connection established")
             disconnected = False
             clients.append((orig_endname, server_address))
+            reset_flow()
             t1 = threading.Thread(target=receive_chat_message, daemon=True)
             t1.start()
 
@@ -615,7 +2501,7 @@ def handle_pending(header, server_address):
         seq = int(0).to_bytes(1, byteorder='big')
         username = encode_username(client_name)
         msg = b''.join([dtype, op, seq, username])
-        daemon_socket.sendto(msg, server_address)
+        send_to_daemon(msg, server_address)
         client_commands()
 
 
@@ -627,24 +2513,37 @@ def wait_for_connection(accepted = False):
     client_addr = clients[0][1]
 
     print(f"{server_name}: Waiting for connections for 60 seconds")
+    stop_lingering()
     #set timout to 1 minute
-    daemon_socket.settimeout(60)
-    response, server_address = daemon_socket.recvfrom(1024)
+    deadline = time.monotonic() + 60
+    set_daemon_timeout(60)
+    response, server_address = recv_from_daemon()
     header = build_header(response)
+    #stray datagrams that are not a SYN (e.g. the last ACKs of an earlier chat) do not end the wait
+    while not (header.type == DatagramType.CONTROL and header.operation == OperationType.SYN) and len(clients) != 2:
+        print(f"{server_name}: Ignored a datagram from {server_address} that is not a SYN")
+        set_daemon_timeout(max(deadline - time.monotonic(), 0.001))
+        try:
+            response, server_address = recv_from_daemon()
+        except socket.timeout:
+            print("No requests came, going back to client commands")
+            return
+        header = build_header(response)
     try:
         #if the response is received and operation type is SYN sends REQUEST and waits for decision
         if header.type == DatagramType.CONTROL and header.operation == OperationType.SYN and len(clients) != 2:
             print(f"{server_name}: SYN received from {server_address}. Need client's decision.")
+            syn = bytes(response)
             msg_type = MessageType.REQUEST.to_bytes()
             username_end = encode_username(header.username)
             orig_endname = header.username
             msg = b''.join([msg_type, username_end])
 
             client_socket.sendto(msg, client_addr)
-            daemon_socket.settimeout(60)
+            set_daemon_timeout(60)
 
-            user_respond, _ = client_socket.recvfrom(1024)
-            print(f'{server_name}: received decision,{user_respond}')
+            user_respond, _ = recv_from_client()
+            print(f'{server_name}: received decision,{bytes(user_respond)}')
             header = build_client_header(user_respond)
 
                 # if the message type is ACCEPT, sends SYN + ACK
@@ -653,15 +2552,19 @@ def wait_for_connection(accepted = False):
                 operation = (OperationType.SYN.value | OperationType.ACK.value).to_bytes(1, byteorder='big')
                 seq = int(0).to_bytes(1, byteorder='big')
                 username = encode_username(client_name)
-                msg = b''.join([dtype, operation, seq, username])
-                daemon_socket.sendto(msg, server_address)
-                final_ack, server_address = daemon_socket.recvfrom(1024)
-                ack_header = build_header(final_ack)
+                msg = b''.join([dtype, operation, seq, username, handshake_payload()])
+                if not remember_handshake(server_address, syn, msg, requester=False):
+                    refuse_handshake(server_address)
+                    client_socket.sendto(MessageType.ERROR.to_bytes(), client_addr)
+                    return
+                send_to_daemon(msg, server_address)
+                ack_header, server_address = wait_for_final_ack(msg, server_address)
                 # if the ACK is received start receiving chat messages from another daemon and start chat with client
                 if ack_header.type == DatagramType.CONTROL and ack_header.operation == OperationType.ACK:
                     print(f"{server_name}: Final ACK received. Connection established")
                     disconnected = False
                     clients.append((orig_endname, server_address))
+                    reset_flow()
                     t1 = threading.Thread(target=receive_chat_message, daemon=True)
                     t1.start()
                     chat_with_client()
@@ -679,7 +2582,7 @@ def wait_for_connection(accepted = False):
                 seq = int(0).to_bytes(1, byteorder='big')
                 username = encode_username(client_name)
                 msg = b''.join([dtype, op, seq, username])
-                daemon_socket.sendto(msg, server_address)
+                send_to_daemon(msg, server_address)
                 return
         else:
             #if response is not SYN send error message
@@ -708,7 +2611,8 @@ def decline_connection():
     global clients, daemon_socket, client_socket
     client_name = clients[0][0]
 
-    response, server_address = daemon_socket.recvfrom(1024)
+    stop_lingering()
+    response, server_address = recv_from_daemon()
     header = build_header(response)
     # if the response is received and operation type is SYN sends FIN
     if header.type == DatagramType.CONTROL and header.operation == OperationType.SYN:
@@ -719,9 +2623,9 @@ def decline_connection():
         username = client_name
         msg = b''.join([dtype, operation, seq, username])
         print(msg)
-        daemon_socket.sendto(msg, server_address)
+        send_to_daemon(msg, server_address)
 
-        final_ack, _ = daemon_socket.recvfrom(1024)
+        final_ack, _ = recv_from_daemon()
         ack_header = build_header(final_ack)
         #receive final ACK
         if ack_header.type == DatagramType.CONTROL and ack_header.operation == OperationType.ACK:
@@ -738,16 +2642,26 @@ def wait_for_client():
     print(f"{server_name}: Daemon is waiting for client connections...")
     while True:
         try:
-            msg, addr = client_socket.recvfrom(1024)
+            msg, addr = recv_from_client()
             header = build_client_header(msg)
             if len(clients) == 0:
                 #if message type is CONNECTION, check for pending requests
                 if header.type == MessageType.CONNECTION:
 
-                    username = msg[1:].decode('ascii').rstrip('\x00')
+                    username = str(msg[1:], 'ascii').rstrip('\x00')
+                    #in a cluster the user is sent to the daemon that owns it
+                    owner = cluster_owner(username)
+                    if owner is not None:
+                        print(f"{server_name}: {username} belongs to {owner}, redirecting the client")
+                        if error_reply_allowed(addr):
+                            redirect_client(owner, addr)
+                        continue
                     clients.append((username, addr))
+                    if hub_address is not None:
+                        register_with_hub(username)
 
                     check_pending()
+                    expire_pending()
                     #if there is no pending requests wait for client commands
                     if len(pending_requests) == 0:
                         msg_type = MessageType.CONNECTION.to_bytes()
@@ -768,7 +2682,8 @@ def wait_for_client():
                 print(f"THE DAEMON IS ALREADY OCCUPIED BY {clients[0][0]} {addr}, rejecting the conncetion")
                 msg_type = MessageType.ERROR.to_bytes()
                 payload = "This daemon is already occupied".encode('ascii')
-                client_socket.sendto(b''.join([msg_type, payload]), addr)
+                if error_reply_allowed(addr):
+                    client_socket.sendto(b''.join([msg_type, payload]), addr)
                 continue
         
         except ConnectionResetError:
@@ -781,9 +2696,44 @@ def wait_for_client():
             continue          
 
 
+#function to split the hosts of a request separated by commas, first-last stands for every IPv4 address of the range
+#(e.g. 127.1.0.1-127.1.3.232 for the peers of the load generator). raises ValueError for more than MAX_REQUEST_HOSTS hosts
+def parse_hosts(text):
+    hosts = []
+    for host in text.split(','):
+        host = host.strip()
+        first, separator, last = host.partition('-')
+        if separator:
+            try:
+                first, last = ipaddress.IPv4Address(first.strip()), ipaddress.IPv4Address(last.strip())
+            except ValueError:
+                pass  # a hostname with a dash
+            else:
+                size = int(last) - int(first) + 1
+                if len(hosts) + size > MAX_REQUEST_HOSTS:
+                    raise ValueError(f"A request can name at most {MAX_REQUEST_HOSTS} hosts")
+                hosts.extend(str(first + i) for i in range(size))
+                continue
+        if host:
+            if len(hosts) >= MAX_REQUEST_HOSTS:
+                raise ValueError(f"A request can name at most {MAX_REQUEST_HOSTS} hosts")
+            hosts.append(host)
+    return hosts
+
+
+#function to split the hosts of a request of the client, answers the client with ERROR and returns None if there are too many
+def parse_request_hosts(msg, client_addr):
+    try:
+        return parse_hosts(str(msg[1:], 'ascii'))
+    except ValueError as e:
+        print(f"{server_name}: Rejecting the request of the client: {e}")
+        client_socket.sendto(b''.join([MessageType.ERROR.to_bytes(), str(e).encode('ascii')]), client_addr)
+        return None
+
+
 #function to handle client command
 def client_commands():
-    global clients, client_socket, server_name,disconnected
+    global clients, client_socket, server_name,disconnected, waiting_for_peer
 
     client_name = clients[0][0]
     client_addr = clients[0][1]
@@ -791,29 +2741,59 @@ def client_commands():
         if disconnected:
             try:
                 print(f"{server_name}: Daemon is waiting for client commands...")
-                msg, addr = client_socket.recvfrom(1024)
+                msg, addr = recv_from_client()
                 header = build_client_header(msg)
                 #if the client send DISCONNECTION message, daemon returns to wait for client state
                 if header.type == MessageType.DISCONNECTION:
                     msg_type = MessageType.DISCONNECTION.to_bytes()
                     print(f"{server_name}: Received termination request from {client_name}")
                     client_socket.sendto(msg_type, client_addr)
+                    if hub_address is not None:
+                        register_with_hub(client_name, RelayOperation.UNREGISTER)
                     clients = []
                     
                     wait_for_client()
                     
 
 
-                #if the client sends REQUEST for chat, daemon requests connection with provided ip address
+                #in a cluster a user that belongs to another daemon after a ring change is sent there instead of running its command,
+                #the client connects to the owner and sends the command again
+                owner = cluster_owner(client_name)
+                if owner is not None and header.type in (MessageType.REQUEST, MessageType.GROUP, MessageType.WAIT):
+                    print(f"{server_name}: {client_name} belongs to {owner} now, redirecting the client")
+                    redirect_client(owner, client_addr)
+                    clients = []
+                    wait_for_client()
+                    continue
+
+                #if the client sends REQUEST for chat, daemon requests connection with provided ip addresses (separated by commas)
                 if header.type == MessageType.REQUEST:
-                    ip = msg[1:].decode()
-                    print(f"{server_name}: Starting connection handshake with {ip}")
-                    request_connection(ip, 7777)
+                    ips = parse_request_hosts(msg, client_addr)
+                    if ips is None:
+                        continue
+                    print(f"{server_name}: Starting connection handshake with {', '.join(ips)}")
+                    request_connection(ips, 7777)
+
+                #if the client sends GROUP, daemon starts a group chat with every provided ip address that accepts
+                elif header.type == MessageType.GROUP:
+                    ips = parse_request_hosts(msg, client_addr)
+                    if ips is None:
+                        continue
+                    print(f"{server_name}: Starting group chat with {', '.join(ips)}")
+                    request_connection(ips, 7777, group=True)
                     
                 #if the client sends WAIT message, daemon starts waiting for the connections
                 elif header.type == MessageType.WAIT:
                     print(f'{server_name}: Received wait request from client')
-                    wait_for_connection()
+                    waiting_for_peer = True
+                    try:
+                        wait_for_connection()
+                    finally:
+                        waiting_for_peer = False
+
+                #if the client sends SEARCH, daemon answers with the newest messages of the history that match the query
+                elif header.type == MessageType.SEARCH:
+                    search_history(str(msg[1:], 'ascii'), client_addr)
             except socket.timeout:
                 continue
             except ConnectionResetError:
@@ -826,63 +2806,289 @@ def client_commands():
             return
 
 
-#function that simulates stop and wait strategy
-def stop_and_wait_send(message, seq, type=True):
-    global ack_received, disconnected
-    try:
-        if disconnected:
-            print("Connection is disconnected. No further messages will be sent.")
-            
-            return False  # Early return if disconnected
-
-        retries = 3
-
-        with ack_lock:
-            ack_received[seq] = False  # Reset ACK status for the given seq
-
-        for attempt in range(retries):
-            print(f"Attempt {attempt + 1}/{retries}: Sending message with seq {seq}")
-
-            # Send message
-            send_chat_message(message=message, seq=seq, type=type)
-
-            # Wait for acknowledgment
-            start_time = time.time()
-            while time.time() - start_time < 5:
-                with ack_lock:
-                    if ack_received.get(seq, False):
-                        print(f"ACK received for seq {seq}.")
-                        print(ack_received)
-                        del ack_received[seq]  # Remove ACK entry after processing
-                        print(ack_received)
-                        return True  # Successfully acknowledged
-                time.sleep(0.1)
-
-            print(f"No ACK received for seq {seq} within timeout. Retrying...")
+#function that queues a chat message for the companion(s), the sender thread sends it when their windows allow it.
+#returns False if the queue of a companion is full, the daemon is under memory pressure (or the chat is over),
+#then the message is not queued for anyone
+def queue_message(message, username=None, exclude=None):
+    if disconnected:
+        print("Connection is disconnected. No further messages will be sent.")
+        return False
+    username = clients[0][0] if username is None else username
+    with flow_changed:
+        targets = [address for address in peer_addresses() if address != exclude]
+        for address in targets:
+            if address not in sessions:
+                sessions[address] = new_session(address)
+        full = memory_budget is not None and memory_budget.pressure
+        if full or not targets or any(sessions[address].queued() >= OUTBOUND_QUEUE_SIZE for address in targets):
+            for address in targets:
+                sessions[address].dropped += 1
+            return False
+        item = (message, username, time.perf_counter_ns())
+        for address in targets:
+            sessions[address].enqueue(item)
+        flow_changed.notify_all()
+    return True
 
-        print(f"Failed to receive ACK for seq {seq} after {retries} retries.")
-        return False  # If all retries fail
-    except ConnectionResetError:
-        print("Lost connection with client at stop and wait.")
-        print("Sending fin message to the daemon")
-        message = build_fin_message(0)
-        daemon_socket.sendto(message, clients[1][1])
-        print(f"Sending FIN message to {clients[1][1]}: {message}")
-        send_chat_message(type = False)
-        clients = []
-        wait_for_client()
 
-    except Exception as e:
-        print("Error",e,"during stop and wait has occured")
-        return False
+#function that runs as the sender thread of the daemon. every round it sends one queued message per companion whose window is open,
+#so a busy session does not hold back the others. the datagrams are sent outside of the lock
+def send_queued():
+    global client_paused
+    while True:
+        with flow_changed:
+            batch, wait = take_sendable(time.monotonic())
+            #the client is resumed even when nothing is left to send, it may have been paused after the queues drained
+            resume = client_paused and clients and all(session.queued() <= RESUME_LEVEL for session in sessions.values()) and not (
+                memory_budget is not None and memory_budget.pressure)
+            if resume:
+                client_paused = False
+            elif not batch:
+                flow_changed.wait(wait)
+                continue
+        try:
+            for datagram, addresses, multicast in batch:
+                send_to_members(datagram, addresses, multicast)
+            if resume:
+                client_socket.sendto(MessageType.RESUME.to_bytes(), clients[0][1])
+                print(f"{server_name}: Outbound queues drained, client resumed")
+        except (OSError, IndexError) as e:
+            print("ERROR", e, "while sending queued messages has occured")
+
+
+#function to take the queued messages the open windows allow, called with flow_changed held. every round a session can send
+#SEND_QUANTUM bytes times its weight (deficit round robin), so sessions with long messages do not crowd out the others.
+#the interactive messages of all sessions are taken before the bulk ones and go out first.
+#returns the datagrams to send and the time until a paced window opens (None if nothing is waiting for time)
+def take_sendable(now):
+    batch = []
+    wait = None
+    ready = []
+    for address, session in sessions.items():
+        if not session.queued():
+            session.deficit = 0
+            continue
+        delay = session.send_delay(now)
+        if delay == 0:
+            ready.append((address, session))
+        elif delay is not None:
+            wait = delay if wait is None else min(wait, delay)
+
+    #a group message that heads every queue goes once through the multicast group if the members' sequence numbers are in step
+    if multicast_group is not None and not session_keys and len(ready) > 1 and len(ready) == len(sessions):
+        heads = {id(session.head()) for _, session in ready}
+        if len(heads) == 1 and len({session.next_seq for _, session in ready}) == 1:
+            message, username, queued = ready[0][1].head()
+            send_class = SendClass.of(message)
+            datagram = build_chat_message(message, ready[0][1].next_seq, username)
+            for _, session in ready:
+                session.queues[send_class].popleft()
+                session.on_send(datagram, now)
+            record_send_wait(send_class, queued)
+            return [(datagram, [address for address, _ in ready], True)], wait
+
+    for _, session in ready:
+        session.deficit += SEND_QUANTUM * session.weight
+    for send_class in (SendClass.INTERACTIVE, SendClass.BULK):
+        for address, session in ready:
+            queue = session.queues[send_class]
+            while queue and len(queue[0][0]) <= session.deficit and session.send_delay(now) == 0:
+                message, username, queued = queue.popleft()
+                session.deficit -= len(message)
+                datagram = build_chat_message(message, session.next_seq, username)
+                session.on_send(datagram, now)
+                record_send_wait(send_class, queued)
+                batch.append((datagram, [address], False))
+    #a session that could not use its quantum (its window closed) keeps at most one quantum for the next round
+    for _, session in ready:
+        session.deficit = min(session.deficit, SEND_QUANTUM * session.weight) if session.queued() else 0
+    return batch, wait
+
+
+#function to record how long a datagram of the send class waited until it was sent, since is in perf_counter_ns
+def record_send_wait(send_class, since):
+    if send_class_waits is not None:
+        send_class_waits.record(send_class.name.lower(), since)
+    if spans is not None and send_class != SendClass.CONTROL:
+        spans.record('queue_wait', since)
+
+
+#function to send a control datagram of the chat (ACK, FIN+ACK, error reply) at once, control datagrams are never queued
+#behind chat messages. since is when the datagram it answers was received (perf_counter_ns)
+def send_control(datagram, address, since):
+    send_to_daemon(datagram, address)
+    record_send_wait(SendClass.CONTROL, since)
+
+
+#function to create the send window of a companion, with the weight given to it on the command line
+def new_session(address):
+    return CongestionControl(pacing, peer_weights.get(peer_name(address), 1))
+
+
+#function to get the messages queued per send class over all sessions, called with flow_changed held
+def send_class_depths():
+    return {send_class.name.lower(): sum(len(session.queues[send_class]) for session in sessions.values())
+            for send_class in (SendClass.INTERACTIVE, SendClass.BULK)}
+
+
+#function to wait until the queued and unacknowledged messages of the chat are sent, before the chat is closed
+def flush_queues(timeout=FLUSH_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    with flow_changed:
+        while any(session.queued() or session.in_flight for session in sessions.values()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or disconnected:
+                print("Queued messages could not be sent before closing the chat")
+                return False
+            flow_changed.wait(min(remaining, 0.5))
+    return True
+
+
+#function to send a datagram in flight again, called with flow_changed held
+def retransmit(session, seq, address):
+    entry = session.in_flight[seq]
+    entry[2] = time.monotonic()
+    entry[3] += 1
+    entry[4] = 0
+    session.sends += 1
+    entry[5] = session.sends
+    session.retransmitted += 1
+    send_to_daemon(entry[0], address)
+
+
+#function that retransmits the chat datagrams whose timeout expired and delivers the messages after a gap that was not filled in time,
+#returns the time until the next timer expires (None if there is nothing to wait for)
+def check_timers():
+    now = time.monotonic()
+    next_timeout = None
+    with flow_changed:
+        changed = False
+        for address, session in list(sessions.items()):
+            expired = session.expired(now)
+            if expired:
+                session.on_loss(now, timeout=True)
+                changed = True
+            for seq in expired:
+                if session.in_flight[seq][3] >= MAX_RETRANSMISSIONS:
+                    del session.in_flight[seq]
+                    session.lost += 1
+                    print(f"Failed to deliver message with seq {seq} to {address} after {MAX_RETRANSMISSIONS} retransmissions.")
+                else:
+                    print(f"No ACK received for seq {seq} from {address} within {session.rto:.2f} s. Retransmitting...")
+                    retransmit(session, seq, address)
+            timeout = session.next_timeout(now)
+            if timeout is not None and (next_timeout is None or timeout < next_timeout):
+                next_timeout = timeout
+        if changed:
+            flow_changed.notify_all()
+
+    for address, window in list(receive_windows.items()):
+        deliver_messages(window.expire(now), address)
+        if window.buffer:
+            next_timeout = 1 if next_timeout is None else min(next_timeout, 1)
+    return next_timeout
+
+
+#function to forget the windows and the keys of the last chat, called when a new chat starts. the companions get the keys of their handshake
+def reset_flow():
+    with flow_changed:
+        sessions.clear()
+        receive_windows.clear()
+    session_keys.clear()
+    for _, address in clients[1:]:
+        closed_chats.pop(address, None)
+        keys = handshake_keys.pop(address, None)
+        if keys is not None:
+            session_keys[address] = keys
+    handshake_keys.clear()
+
+
+#function to collect the window state of the chat sessions
+def collect_metrics():
+    with ack_lock:
+        return {
+            'sessions': {peer_name(address): session.metrics() for address, session in sessions.items()},
+            'receive_windows': {peer_name(address): {'expected': window.expected, 'buffered': len(window.buffer), 'advertised': window.advertised()}
+                                for address, window in receive_windows.items()},
+            'send_classes': {'depth': send_class_depths(), 'wait': {} if send_class_waits is None else send_class_waits.summaries()},
+            'memory': None if memory_budget is None else memory_budget.stats(),
+            'admission': {name: limiter.stats() for name, limiter in (('daemon', daemon_admission), ('client', client_admission),
+                                                                    ('error_replies', error_replies)) if limiter is not None},
+            'cluster': None if cluster is None else cluster.members(),
+            'history': None if history is None else history.stats(),
+        }
+
+
+#function that prints the metrics of the daemon every interval seconds
+def report_metrics(interval):
+    while True:
+        time.sleep(interval)
+        metrics = collect_metrics()
+        for name, session in metrics['sessions'].items():
+            print(f"{server_name}: send window to {name}: {session}")
+        for name, window in metrics['receive_windows'].items():
+            print(f"{server_name}: receive window from {name}: {window}")
+        for name, summary in metrics['send_classes']['wait'].items():
+            print(f"{server_name}: send class {name}: queued {metrics['send_classes']['depth'].get(name, 0)}, wait {summary}")
+        if spans is not None:
+            for stage, summary in spans.summaries().items():
+                print(f"{server_name}: span {stage}: {summary}")
+        if checkpointer is not None:
+            print(f"{server_name}: checkpoints: {checkpointer.metrics()}")
+        if metrics['memory'] is not None:
+            print(f"{server_name}: memory: {metrics['memory']}")
+        for name, admission in metrics['admission'].items():
+            print(f"{server_name}: admission {name}: {admission}")
+        if metrics['cluster'] is not None:
+            print(f"{server_name}: cluster members: {', '.join(metrics['cluster'])}")
+        if metrics['history'] is not None:
+            print(f"{server_name}: history: {metrics['history']}")
+        if mac_secret is not None:
+            print(f"{server_name}: datagrams dropped because of their MAC: {mac_rejected}")
+
+
+#function that creates the memory budget of the daemon and registers its structures, the caches first as they are trimmed in that order
+def start_memory_budget():
+    global memory_budget
+    memory_budget = MemoryBudget(memory_limit)
+    memory_budget.register('unreachable', lambda: len(unreachable) * ENTRY_OVERHEAD,
+                           lambda excess: evict_entries(unreachable, -(-excess // ENTRY_OVERHEAD)))
+    memory_budget.register('pending_requests', lambda: sum(len(syn) + ENTRY_OVERHEAD for syn in list(pending_syns.values())),
+                           lambda excess: evict_pending(-(-excess // (MAX_HEADER_SIZE + ENTRY_OVERHEAD))))
+    for name, limiter in (('daemon_sources', daemon_admission), ('client_sources', client_admission), ('error_reply_sources', error_replies)):
+        if limiter is not None:
+            memory_budget.register(name, limiter.memory, limiter.trim)
+    if history is not None:
+        memory_budget.register('history', history.memory, history.trim)
+        memory_budget.register('history_queue', lambda: sum(len(record[2]) + ENTRY_OVERHEAD for record in list(history_queue)))
+    memory_budget.register('sessions', lambda: sum(session.memory() for session in list(sessions.values())))
+    memory_budget.register('receive_windows', lambda: sum(window.memory() for window in list(receive_windows.values())))
+    memory_budget.register('receive_pools', lambda: sum(len(pool.views) * RECV_BUFFER_SIZE for pool in (daemon_pool, client_pool, multicast_pool)
+                                                        if pool is not None))
+    threading.Thread(target=watch_memory, daemon=True).start()
+
+
+#function that runs as the memory thread, it checks the budget every MEMORY_CHECK_INTERVAL.
+#the sender thread is woken up when the memory pressure ends, a paused client can be resumed then
+def watch_memory():
+    while True:
+        time.sleep(MEMORY_CHECK_INTERVAL)
+        try:
+            with flow_changed:
+                changed = memory_budget.check()
+                if changed:
+                    flow_changed.notify_all()
+            if changed:
+                print(f"{server_name}: Memory pressure {'started' if memory_budget.pressure else 'ended'}: {memory_budget.stats()}")
+        except Exception as e:
+            print("ERROR", e, "while checking the memory budget has occured")
 
 
 def chat_with_client():
-    global clients, client_socket, server_name, daemon_socket, messages, t1, t2, ack_received, disconnected
+    global clients, client_socket, server_name, daemon_socket, messages, t1, t2, disconnected, client_paused, deferred_client_message
 
     print('Started receiving messages from client')
-
-    seq = 0  # Initialize sequence number, can only be 0 or 1
+    client_paused = False
 
     while True:
         try:
@@ -892,27 +3098,41 @@ def chat_with_client():
             
             print('listening to client messages')
 
-            msg, _ = client_socket.recvfrom(1024)
+            msg, addr = recv_from_client()
+            received = time.perf_counter_ns() if spans is not None else 0
             header = build_client_header(msg)
 
+            #the chat ended on the other side while waiting for the client, its message is a command for the menu
+            if disconnected:
+                if header.type not in (MessageType.CHAT, MessageType.DISCONNECT_REQUEST):
+                    deferred_client_message = (bytes(msg), addr)
+                print(f"{server_name}: Connection is disconnected. No further messages will be sent.")
+                return
+
             if header.type == MessageType.CHAT:
                 if not disconnected:  # Prevent sending chat messages if disconnected
-                    print('Received message from client:', msg[1:])
-                    if stop_and_wait_send(message=msg, seq=seq):
-                        print(f"Message with seq {seq} successfully sent and acknowledged.")
+                    print('Received message from client:', bytes(msg[1:]))
+                    #the message is queued and the next one is read right away, a full queue pauses the client.
+                    #while the client is paused everything it sends is returned, so the order is kept when it sends again
+                    if client_paused or not queue_message(bytes(msg)):
+                        #the sender thread checks if the client can be resumed right away
+                        with flow_changed:
+                            client_paused = True
+                            flow_changed.notify_all()
+                        client_socket.sendto(b''.join([MessageType.BACKPRESSURE.to_bytes(), msg[1:]]), clients[0][1])
+                        print("Outbound queue is full, client paused")
                     else:
-                        print(f"Failed to deliver message with seq {seq} after retries.")
-                    seq = 1 - seq
+                        record_history(clients[0][0], msg[1:])
+                        if spans is not None:
+                            spans.record('client_recv', received)
                     continue
             
             elif header.type == MessageType.DISCONNECT_REQUEST:
+                flush_queues()
                 send_chat_message(type = False)
+                wait_for_receiver()
 
-                seq = 1 - seq
-                if t1.is_alive():
-                    t1.join()
-
-                clients.pop(1)
+                del clients[1:]
                 disconnected = True  # Set disconnected flag to stop further communication
                 print(f"{server_name}: Daemon is disconnected and waiting for new commands.")
                 return
@@ -932,23 +3152,889 @@ def chat_with_client():
             continue
 
 
-#function that starts the server and calls function to wait for the client
-def start_server(address):
-    global server_name, daemon_socket, client_socket
-    server_name = "Server" + str(time.time())[-1]
-    daemon_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    daemon_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    daemon_socket.bind((address, 7777))
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    client_socket.bind((address, 7778))
-    wait_for_client()
+#function to split a search query into the terms of the history index, the words are lowercased and @name matches the messages of that user
+def query_terms(query):
+    terms = set()
+    for word in query.lower().split():
+        if word.startswith('@') and len(word) > 1:
+            terms.add(word.encode('ascii'))
+        else:
+            terms.update(HISTORY_TERM.findall(word.encode('ascii')))
+    return terms
 
 
-if __name__ == "__main__":
+#function to check if an ascending posting list contains a message number
+def contains(postings, number):
+    i = bisect.bisect_left(postings, number)
+    return i < len(postings) and postings[i] == number
+
+
+#function to pass a delivered chat message on to the history thread, the chat threads do not wait for the file or the index
+def record_history(username, message):
+    if history is None:
+        return
+    with history_ready:
+        history_queue.append((time.time(), username, bytes(message)))
+        history_ready.notify()
+
+
+#function that runs as the history thread, it indexes the messages already in the file and then writes and indexes the delivered ones
+#until it is stopped
+def write_history(load=True):
+    if load:
+        try:
+            started = time.perf_counter()
+            count = history.load()
+            print(f"{server_name}: Indexed {count} messages of the history {history.path} in {time.perf_counter() - started:.1f} s")
+        except OSError as e:
+            print("ERROR", e, "while indexing the chat history has occured")
+    while True:
+        with history_ready:
+            while not history_queue and not history_stopped:
+                history_ready.wait()
+            if history_stopped:
+                return
+            records = list(history_queue)
+            history_queue.clear()
+        try:
+            history.add(records)
+        except (OSError, ValueError) as e:
+            print("ERROR", e, "while writing the chat history has occured")
+
+
+#function to start the history thread, load is False when it is started again after a failed handoff
+def start_history_thread(load=True):
+    global history_thread, history_stopped
+    history_stopped = False
+    history_thread = threading.Thread(target=write_history, args=(load,), daemon=True)
+    history_thread.start()
+
+
+#function to stop the history thread before a handoff, so that only this thread writes the file until the process exits
+def stop_history():
+    global history_stopped
+    with history_ready:
+        history_stopped = True
+        history_ready.notify()
+    history_thread.join()
+
+
+#function to write the messages the history thread has not written yet
+def flush_history():
+    with history_ready:
+        records = list(history_queue)
+        history_queue.clear()
+    try:
+        history.add(records)
+    except (OSError, ValueError) as e:
+        print("ERROR", e, "while writing the chat history has occured")
+
 
-    if len(sys.argv) != 2:
-        print("Usage: python daemon.py <server_ip>")
+#function to write the messages the history thread has not written yet and to close the history file, called at exit and before a handoff
+def close_history():
+    flush_history()
+    history.close()
+
+
+#function to answer a SEARCH of the client: a SEARCH per matching message (username, time in ms and the message), the newest first,
+#and a SEARCH with the number of matches (2 bytes) and 1 if there are older ones (1 byte) at the end
+def search_history(query, address):
+    if history is None:
+        client_socket.sendto(b''.join([MessageType.ERROR.to_bytes(), b'The daemon keeps no chat history']), address)
+        return
+    started = time.perf_counter()
+    matches, more = history.search(query)
+    msg_type = MessageType.SEARCH.to_bytes()
+    for timestamp, username, message in matches:
+        client_socket.sendto(b''.join([msg_type, encode_username(username), timestamp.to_bytes(8, byteorder='big'), message]), address)
+    client_socket.sendto(b''.join([msg_type, len(matches).to_bytes(2, byteorder='big'), int(more).to_bytes(1, byteorder='big')]), address)
+    print(f"{server_name}: Search for {query!r} found {len(matches)}{' and more' if more else ''} messages "
+          f"in {(time.perf_counter() - started) * 1000:.2f} ms")
+
+
+#function that opens the history file and starts the history thread
+def start_history():
+    global history, history_ready
+    path = history_path if worker_id is None else f"{history_path}.{worker_id}"
+    try:
+        history = HistoryIndex(path)
+    except (OSError, ValueError) as e:
+        print("ERROR", e, "while opening the chat history has occured")
+        return
+    history_ready = threading.Condition()
+    atexit.register(close_history)
+    start_history_thread()
+    print(f"{server_name}: Keeping the chat history in {path}")
+
+
+#function to join the multicast group used for group chats on the local segment
+def join_multicast(address, group):
+    global multicast_socket, multicast_group, multicast_pool
+    multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    multicast_pool = BufferPool()
+    multicast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        multicast_socket.bind((group, 7777))
+    except OSError:
+        multicast_socket.bind(('', 7777))  # binding to a multicast address is not supported everywhere (Windows)
+    membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(address))
+    multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    if trace_writer is not None:
+        multicast_socket = TracedSocket(multicast_socket, trace_writer, 0)
+    #the group datagrams are sent from the daemon socket and stay on the local segment
+    daemon_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+    daemon_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    multicast_group = group
+    threading.Thread(target=receive_multicast, daemon=True).start()
+    print(f"{server_name}: Joined multicast group {group}")
+
+
+#function that runs the daemon as a relay hub, daemons register the username of their client and the hub forwards
+#the datagrams between them by username. only the relay envelope is looked at, the original datagram is passed on as it is
+def run_relay(address, report_interval=RELAY_REPORT_INTERVAL):
+    relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    relay_socket.bind((address, 7777))
+    print(f"Relay hub is listening on {address}:7777")
+
+    forward = b''.join([DatagramType.RELAY.to_bytes(), RelayOperation.FORWARD.to_bytes()])
+    routes = {}  # username field (32 bytes) -> daemon address
+    names = {}  # daemon address -> username field
+    stats = {}  # username field -> [datagrams, bytes, datagrams at the last report, bytes at the last report]
+    unroutable = 0
+    buffer = bytearray(65535)
+    last_report = time.monotonic()
+
+    while True:
+        now = time.monotonic()
+        if now - last_report >= report_interval:
+            report_routes(routes, stats, unroutable, now - last_report)
+            last_report = now
+        relay_socket.settimeout(report_interval - (now - last_report))
+        try:
+            size, sender = relay_socket.recvfrom_into(buffer)
+        except socket.timeout:
+            continue
+        except ConnectionResetError:
+            continue
+        if size < RELAY_HEADER_SIZE or buffer[0] != 3:
+            unroutable += 1
+            continue
+        operation = buffer[1]
+        name = bytes(buffer[2:RELAY_HEADER_SIZE])
+
+        if operation == RelayOperation.FORWARD.value:
+            destination = routes.get(name)
+            source = names.get(sender)
+            if destination is None or source is None:
+                unroutable += 1
+                continue
+            #the original datagram is not copied or parsed, only the envelope is rewritten to name the source
+            relay_socket.sendto(b''.join([forward, source, memoryview(buffer)[RELAY_HEADER_SIZE:size]]), destination)
+            route = stats.get(name)
+            if route is None:
+                route = stats[name] = [0, 0, 0, 0]
+            route[0] += 1
+            route[1] += size - RELAY_HEADER_SIZE
+
+        elif operation == RelayOperation.REGISTER.value:
+            #a user that moved to another daemon or a daemon that serves another user replaces the old route
+            old_address = routes.get(name)
+            if old_address is not None and old_address != sender:
+                names.pop(old_address, None)
+            old_name = names.get(sender)
+            if old_name is not None and old_name != name:
+                routes.pop(old_name, None)
+            routes[name] = sender
+            names[sender] = name
+
+        elif operation == RelayOperation.UNREGISTER.value:
+            if routes.get(name) == sender:
+                del routes[name]
+                names.pop(sender, None)
+                stats.pop(name, None)
+
+
+#function to print the number of routes of the hub and the throughput of the busiest ones since the last report
+def report_routes(routes, stats, unroutable, interval):
+    print(f"Relay hub: {len(routes)} routes, {unroutable} unroutable datagrams")
+    busiest = sorted(stats.items(), key=lambda item: item[1][1] - item[1][3], reverse=True)[:10]
+    for name, route in busiest:
+        datagrams = route[0] - route[2]
+        size = route[1] - route[3]
+        if datagrams == 0:
+            break
+        username = name.decode('ascii', errors='replace').rstrip('\x00')
+        print(f"  -> {username}: {datagrams / interval:.1f} datagrams/s, {size / interval:.1f} bytes/s ({route[0]} datagrams total)")
+    for route in stats.values():
+        route[2] = route[0]
+        route[3] = route[1]
+
+
+#function that forks the worker processes, all of them bind 7777 and 7778 with SO_REUSEPORT and serve a client each.
+#the kernel spreads the datagrams over the workers by address hash, the control plane tells them which worker owns a datagram
+def start_workers(address, multicast, workers):
+    global control_plane, worker_id, daemon_channel, client_channel, forward_channels
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+        print("Worker processes need SO_REUSEPORT and fork (Linux, BSD, macOS)")
         sys.exit(1)
+    control_plane = ControlPlane(workers)
+    channels = [(socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM), socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM))
+                for _ in range(workers)]
+    forward_channels = [(daemon_pair[0], client_pair[0]) for daemon_pair, client_pair in channels]
+
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            worker_id = i
+            daemon_channel = channels[i][0][1]
+            client_channel = channels[i][1][1]
+            try:
+                start_server(address, multicast)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    print(f"Started {workers} workers on {address}: {children}")
+    #the workers are stopped together with the parent process
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except (KeyboardInterrupt, SystemExit):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+    finally:
+        control_plane.close()
+
+
+#function to record every datagram of the daemon and client sockets in the trace file, every worker process writes its own file
+def start_trace(address):
+    global trace_writer, daemon_socket, client_socket
+    path = trace_path if worker_id is None else f"{trace_path}.{worker_id}"
+    trace_writer = TraceWriter(path, address)
+    atexit.register(trace_writer.close)
+    daemon_socket = TracedSocket(daemon_socket, trace_writer, 0)
+    client_socket = TracedSocket(client_socket, trace_writer, TRACE_CLIENT)
+    print(f"{server_name}: Recording the datagrams in {path}")
+
+
+#function that writes the span histograms to the file every interval seconds, and once more when the daemon exits
+def start_spans():
+    global spans
+    path = span_path if worker_id is None else f"{span_path}.{worker_id}"
+    spans = SpanRecorder()
+    atexit.register(spans.export, path)
+
+    def export_spans():
+        while True:
+            time.sleep(SPAN_EXPORT_INTERVAL)
+            try:
+                spans.export(path)
+            except OSError as e:
+                print("ERROR", e, "while writing the span histograms has occured")
+    threading.Thread(target=export_spans, daemon=True).start()
+    print(f"{server_name}: Recording the latency spans in {path}")
+
+
+#function to install the SIGUSR2 handler that starts and stops the sampling profiler, every worker process writes its own file
+def install_profiler():
+    if not hasattr(signal, 'SIGUSR2'):
+        print(f"{server_name}: The sampling profiler needs SIGUSR2, it is not available on this platform")
+        return
+    path = profile_path if worker_id is None else f"{profile_path}.{worker_id}"
+    profiler = SamplingProfiler(path)
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
+    print(f"{server_name}: kill -USR2 {os.getpid()} starts and stops the sampling profiler")
+
+
+#functions to keep bytes in the JSON snapshot of a handoff
+def encode_bytes(data):
+    return str(base64.b64encode(data), 'ascii')
+
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+
+#function to turn an address of the snapshot (a JSON list) back into the tuple the daemon uses
+def decode_address(address):
+    return tuple(address)
+
+
+#function to get the state a new daemon process needs to go on with the client and the chat, called with flow_changed held
+def snapshot_state():
+    now = time.monotonic()
+    return {
+        'clients': [[username, address] for username, address in clients],
+        'disconnected': disconnected,
+        'client_paused': client_paused,
+        'waiting_for_peer': waiting_for_peer,
+        'pending_requests': [[header.username, address] for header, address, _ in pending_requests],
+        'unreachable': [[host, expiry - now, reason] for host, (expiry, reason) in unreachable.items()],
+        'sessions': [[address, session.snapshot(now)] for address, session in sessions.items()],
+        'receive_windows': [[address, window.snapshot(now)] for address, window in receive_windows.items()],
+        'session_keys': [[address, encode_bytes(send_key), encode_bytes(receive_key)] for address, (send_key, receive_key) in session_keys.items()],
+        #datagrams that were received but not handled yet
+        'daemon_datagrams': [[encode_bytes(msg), address] for msg, address in daemon_pool.queue],
+        'client_datagrams': [[encode_bytes(msg), address] for msg, address in client_pool.queue],
+    }
+
+
+#function to take the state of the old daemon process over
+def restore_state(state):
+    global clients, disconnected, client_paused, waiting_for_peer
+    now = time.monotonic()
+    clients = [(username, decode_address(address)) for username, address in state['clients']]
+    disconnected = state['disconnected']
+    client_paused = state['client_paused']
+    waiting_for_peer = state['waiting_for_peer']
+    for username, address in state['pending_requests']:
+        header = HeaderInfo()
+        header.type = DatagramType.CONTROL
+        header.operation = OperationType.SYN
+        header.seq = 0
+        header.username = username
+        pending_requests.append((header, decode_address(address), time.monotonic()))
+    for host, remaining, reason in state['unreachable']:
+        unreachable[host] = (now + remaining, reason)
+    for address, session_state in state['sessions']:
+        address = decode_address(address)
+        session = sessions[address] = new_session(address)
+        session.restore(session_state, now)
+    for address, window_state in state['receive_windows']:
+        window = receive_windows[decode_address(address)] = ReceiveWindow()
+        window.restore(window_state, now)
+    for address, send_key, receive_key in state['session_keys']:
+        session_keys[decode_address(address)] = (decode_bytes(send_key), decode_bytes(receive_key))
+    daemon_pool.queue.extend((decode_bytes(msg), decode_address(address)) for msg, address in state['daemon_datagrams'])
+    client_pool.queue.extend((decode_bytes(msg), decode_address(address)) for msg, address in state['client_datagrams'])
+
+
+#function to go on where the old daemon process was: in the chat, at the menu of the client or waiting for a client
+def resume_state():
+    global t1
+    if not clients:
+        wait_for_client()
+    elif not disconnected and len(clients) > 1:
+        print(f"{server_name}: Resuming the chat with {', '.join(username for username, _ in clients[1:])}")
+        t1 = threading.Thread(target=receive_chat_message, daemon=True)
+        t1.start()
+        with flow_changed:
+            flow_changed.notify_all()  # the restored queues are sent
+        chat_with_client()
+        client_commands()
+    else:
+        print(f"{server_name}: Resuming the session of {clients[0][0]}")
+        if waiting_for_peer:
+            wait_for_connection()
+        client_commands()
+
+
+#function to take the sockets and the state over from the daemon process listening on the handoff socket.
+#returns (daemon socket, client socket, state), None if no daemon is listening there
+def take_over(path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    with conn:
+        #the old daemon waits for a handshake in progress to finish
+        conn.settimeout(SYN_TIMEOUT + HANDOFF_TIMEOUT)
+        data, fds, _, _ = socket.recv_fds(conn, len(HANDOFF_MAGIC) + 4, 2)
+        while 0 < len(data) < len(HANDOFF_MAGIC) + 4:
+            data += conn.recv(len(HANDOFF_MAGIC) + 4 - len(data))
+        if not data.startswith(HANDOFF_MAGIC) or len(fds) != 2:
+            for fd in fds:
+                os.close(fd)
+            raise OSError(f"{path} did not hand the daemon over")
+        length = int.from_bytes(data[len(HANDOFF_MAGIC):], byteorder='big')
+        snapshot = bytearray()
+        while len(snapshot) < length:
+            chunk = conn.recv(min(length - len(snapshot), 65536))
+            if not chunk:
+                raise OSError(f"{path} closed the handoff")
+            snapshot += chunk
+        state = json.loads(snapshot)
+        daemon_sock, client_sock = (socket.socket(fileno=fd) for fd in fds)
+        conn.sendall(b'OK')
+        #the sockets are used once the old daemon exited (the connection is closed), it still receives on them until then
+        conn.settimeout(HANDOFF_TIMEOUT)
+        try:
+            conn.recv(1)
+        except socket.timeout:
+            print(f"The daemon at {path} did not exit after the handoff")
+    for sock in (daemon_sock, client_sock):
+        sock.settimeout(None)
+    return daemon_sock, client_sock, state
+
 
-    start_server(sys.argv[1],)
+#function that runs as the handoff thread: a new daemon process that connects to the unix socket gets the sockets and the state,
+#then this process exits. the sender thread stays stopped from the snapshot on, so nothing is sent twice
+def serve_handoff(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    print(f"{server_name}: A new daemon started with --handoff {path} takes over")
+    while True:
+        conn, _ = listener.accept()
+        with conn:
+            try:
+                deadline = time.monotonic() + SYN_TIMEOUT
+                while handshake_peers and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                #the new daemon indexes the history file once this process exited, the history thread must not write it anymore
+                if history is not None:
+                    stop_history()
+                    flush_history()
+                with flow_changed:
+                    started = time.perf_counter()
+                    snapshot = json.dumps(snapshot_state()).encode('ascii')
+                    fds = [getattr(sock, 'sock', sock).fileno() for sock in (daemon_socket, client_socket)]
+                    socket.send_fds(conn, [HANDOFF_MAGIC + len(snapshot).to_bytes(4, byteorder='big')], fds)
+                    conn.sendall(snapshot)
+                    conn.settimeout(HANDOFF_TIMEOUT)
+                    if conn.recv(2) != b'OK':
+                        raise OSError("the new daemon did not confirm the handoff")
+                    print(f"{server_name}: Handed over to the new daemon in {(time.perf_counter() - started) * 1000:.1f} ms "
+                          f"({len(snapshot)} bytes of state), exiting")
+                    if trace_writer is not None:
+                        trace_writer.close()
+                    #os._exit skips the atexit functions, the messages delivered since the snapshot are written here
+                    if history is not None:
+                        close_history()
+                    os._exit(0)
+            except OSError as e:
+                print("ERROR", e, "while handing over to a new daemon has occured, going on")
+                if history is not None and history_stopped:
+                    start_history_thread(load=False)
+
+
+#functions to pack the fields of the checkpoint records: a string is its length (1 byte) and the ascii bytes, an address is the ip (4 bytes),
+#the port (2 bytes) and the username of a daemon behind the relay hub (a string, empty for the other addresses)
+def pack_string(text):
+    data = text.encode('ascii', errors='replace')[:255]
+    return bytes([len(data)]) + data
+
+
+def unpack_string(data, offset):
+    length = data[offset]
+    return str(data[offset + 1:offset + 1 + length], 'ascii'), offset + 1 + length
+
+
+def pack_address(address):
+    return b''.join([socket.inet_aton(address[0]), address[1].to_bytes(2, byteorder='big'), pack_string(address[2] if len(address) == 3 else '')])
+
+
+def unpack_address(data, offset):
+    ip = socket.inet_ntoa(data[offset:offset + 4])
+    port = int.from_bytes(data[offset + 4:offset + 6], byteorder='big')
+    username, offset = unpack_string(data, offset + 6)
+    return ((ip, port, username) if username else (ip, port)), offset
+
+
+#function to pack the client and the companions, the first entry is the client. a companion is followed by its MAC keys (1 byte - count of
+#the keys, then the send and the receive key)
+def pack_clients():
+    parts = [bytes([disconnected, len(clients)])]
+    for username, address in clients:
+        parts.append(pack_string(username))
+        parts.append(pack_address(address))
+        keys = session_keys.get(address, ())
+        parts.append(bytes([len(keys)]))
+        parts.extend(keys)
+    return b''.join(parts)
+
+
+#function to unpack the client and the companions, returns them, the disconnected flag and the MAC keys of the companions
+def unpack_clients(data):
+    offset = 2
+    members = []
+    keys = []
+    for _ in range(data[1]):
+        username, offset = unpack_string(data, offset)
+        address, offset = unpack_address(data, offset)
+        members.append([username, address])
+        if data[offset] == 2:
+            send_key = data[offset + 1:offset + 1 + MAC_KEY_SIZE]
+            receive_key = data[offset + 1 + MAC_KEY_SIZE:offset + 1 + 2 * MAC_KEY_SIZE]
+            keys.append([address, encode_bytes(send_key), encode_bytes(receive_key)])
+        offset += 1 + MAC_KEY_SIZE * data[offset]
+    return members, bool(data[0]), keys
+
+
+#function to pack the send window of a companion with its unacknowledged datagrams and queued messages, the times are kept as ages
+def pack_session(address, session, now):
+    parts = [pack_address(address), CHECKPOINT_SESSION.pack(
+        session.next_seq, session.cwnd, session.ssthresh, session.rwnd, -1 if session.srtt is None else session.srtt,
+        -1 if session.rttvar is None else session.rttvar, session.rto, session.sends, session.dropped, session.sent,
+        session.retransmitted, session.lost, session.acked, len(session.in_flight), session.queued())]
+    for seq, entry in session.in_flight.items():
+        parts.append(CHECKPOINT_IN_FLIGHT.pack(seq, now - entry[1], now - entry[2], entry[3], min(entry[4], 255), entry[5], len(entry[0])))
+        parts.append(entry[0])
+    for message, username, _ in session.queued_messages():
+        parts.append(pack_string(username))
+        parts.append(len(message).to_bytes(2, byteorder='big'))
+        parts.append(message)
+    return b''.join(parts)
+
+
+#function to unpack a send window, returns the address and the state in the snapshot format of a handoff
+def unpack_session(data):
+    address, offset = unpack_address(data, 0)
+    next_seq, cwnd, ssthresh, rwnd, srtt, rttvar, rto, sends, *counters, in_flight_count, queued = CHECKPOINT_SESSION.unpack_from(data, offset)
+    offset += CHECKPOINT_SESSION.size
+    in_flight = []
+    for _ in range(in_flight_count):
+        seq, first, last, retransmissions, later, order, length = CHECKPOINT_IN_FLIGHT.unpack_from(data, offset)
+        offset += CHECKPOINT_IN_FLIGHT.size
+        in_flight.append([seq, encode_bytes(data[offset:offset + length]), first, last, retransmissions, later, order])
+        offset += length
+    queue = []
+    for _ in range(queued):
+        username, offset = unpack_string(data, offset)
+        length = int.from_bytes(data[offset:offset + 2], byteorder='big')
+        queue.append([encode_bytes(data[offset + 2:offset + 2 + length]), username])
+        offset += 2 + length
+    return address, {'next_seq': next_seq, 'cwnd': cwnd, 'ssthresh': ssthresh, 'rwnd': rwnd, 'srtt': None if srtt < 0 else srtt,
+                     'rttvar': None if rttvar < 0 else rttvar, 'rto': rto, 'sends': sends, 'counters': counters,
+                     'in_flight': in_flight, 'queue': queue}
+
+
+#function to pack the receive window of a companion with the datagrams that arrived early
+def pack_window(address, window, now):
+    parts = [pack_address(address), CHECKPOINT_WINDOW.pack(window.expected, len(window.buffer))]
+    for seq, (username, payload, arrival) in window.buffer.items():
+        parts.append(CHECKPOINT_BUFFERED.pack(seq, now - arrival, len(payload)))
+        parts.append(pack_string(username))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def unpack_window(data):
+    address, offset = unpack_address(data, 0)
+    expected, count = CHECKPOINT_WINDOW.unpack_from(data, offset)
+    offset += CHECKPOINT_WINDOW.size
+    buffer = []
+    for _ in range(count):
+        seq, age, length = CHECKPOINT_BUFFERED.unpack_from(data, offset)
+        username, offset = unpack_string(data, offset + CHECKPOINT_BUFFERED.size)
+        buffer.append([seq, username, encode_bytes(data[offset:offset + length]), age])
+        offset += length
+    return address, {'expected': expected, 'buffer': buffer}
+
+
+def pack_record(record_type, record):
+    return CHECKPOINT_RECORD.pack(record_type, len(record), zlib.crc32(record)) + record
+
+
+# checkpointer class, writes the state of the chat to the checkpoint file, so a daemon restarted after a crash resumes the sessions.
+# every interval only the records of what changed since the last checkpoint are appended, with one fsync for all of them.
+# when the file gets bigger than CHECKPOINT_COMPACT_SIZE it is rewritten with the current state
+class Checkpointer:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.fingerprints = {}  # record key -> fingerprint of the state last written
+        self.records = 0
+        self.bytes = 0
+        self.fsyncs = 0
+        self.stall = StageHistogram()  # time the chat threads wait while the changes are collected
+        self.sync = StageHistogram()  # time of the write and the fsync
+
+    # function to get the records of the state that changed (all of them if full), called with flow_changed held
+    def collect(self, full=False):
+        now = time.monotonic()
+        records = []
+        seen = set()
+
+        def add(key, fingerprint, record_type, pack):
+            seen.add(key)
+            if full or self.fingerprints.get(key) != fingerprint:
+                self.fingerprints[key] = fingerprint
+                records.append((record_type, pack()))
+
+        add('clients', (tuple(clients), disconnected, tuple(session_keys)), CHECKPOINT_CLIENTS, pack_clients)
+        for address, session in sessions.items():
+            add(('session', address), (session.sends, session.acked, session.lost, session.dropped, session.queued(), session.rwnd),
+                CHECKPOINT_SESSION_STATE, lambda: pack_session(address, session, now))
+        for address, window in receive_windows.items():
+            add(('window', address), (window.expected, tuple(window.buffer)), CHECKPOINT_WINDOW_STATE, lambda: pack_window(address, window, now))
+        for key in [key for key in self.fingerprints if key not in seen]:
+            del self.fingerprints[key]
+            records.append((CHECKPOINT_SESSION_GONE if key[0] == 'session' else CHECKPOINT_WINDOW_GONE, pack_address(key[1])))
+        return records
+
+    # function to append the changes to the file, called every interval by the checkpoint thread
+    def checkpoint(self):
+        with flow_changed:
+            started = time.perf_counter_ns()
+            records = self.collect()
+            stall = time.perf_counter_ns() - started
+        self.stall.add(stall)
+        if spans is not None:
+            spans.add('checkpoint_stall', stall)
+        if not records:
+            return
+        data = b''.join(pack_record(record_type, record) for record_type, record in records)
+        started = time.perf_counter_ns()
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.sync.add(time.perf_counter_ns() - started)
+        self.records += len(records)
+        self.bytes += len(data)
+        self.fsyncs += 1
+        if self.file.tell() > CHECKPOINT_COMPACT_SIZE:
+            self.compact()
+
+    # function to rewrite the file with the current state, the new file replaces the old one when it is on the disk
+    def compact(self):
+        with flow_changed:
+            self.fingerprints = {}
+            records = self.collect(full=True)
+        temporary = self.path + '.tmp'
+        #the checkpoint holds the MAC keys of the chats, only the owner can read it
+        with open(temporary, 'wb', opener=lambda path, flags: os.open(path, flags, 0o600)) as f:
+            f.write(CHECKPOINT_MAGIC + b''.join(pack_record(record_type, record) for record_type, record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        try:
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        except OSError:
+            pass  # directories can not be synced everywhere (Windows)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'ab')
+        self.fsyncs += 1
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.checkpoint()
+            except OSError as e:
+                print("ERROR", e, "while writing the checkpoint has occured")
+
+    # function to remove the checkpoint when the daemon is stopped, there is nothing to resume then
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def metrics(self):
+        return {'records': self.records, 'bytes': self.bytes, 'fsyncs': self.fsyncs,
+                'stall_p99_us': round(self.stall.percentile(99) / 1000, 1), 'stall_max_us': round(self.stall.max / 1000, 1),
+                'fsync_p99_us': round(self.sync.percentile(99) / 1000, 1), 'fsync_max_us': round(self.sync.max / 1000, 1)}
+
+
+#function to read a checkpoint, returns the state in the snapshot format of a handoff or None if there is no checkpoint.
+#records cut off or damaged by the crash end the checkpoint
+def read_checkpoint(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if not data.startswith(CHECKPOINT_MAGIC):
+        print(f"{path} is not a SIMP checkpoint, it is not restored")
+        return None
+    members, is_disconnected, keys = [], True, []
+    session_states = {}
+    window_states = {}
+    offset = len(CHECKPOINT_MAGIC)
+    while offset + CHECKPOINT_RECORD.size <= len(data):
+        record_type, length, crc = CHECKPOINT_RECORD.unpack_from(data, offset)
+        offset += CHECKPOINT_RECORD.size
+        record = data[offset:offset + length]
+        if len(record) < length or zlib.crc32(record) != crc:
+            break
+        offset += length
+        if record_type == CHECKPOINT_CLIENTS:
+            members, is_disconnected, keys = unpack_clients(record)
+        elif record_type == CHECKPOINT_SESSION_STATE:
+            address, session_state = unpack_session(record)
+            session_states[address] = session_state
+        elif record_type == CHECKPOINT_SESSION_GONE:
+            session_states.pop(unpack_address(record, 0)[0], None)
+        elif record_type == CHECKPOINT_WINDOW_STATE:
+            address, window_state = unpack_window(record)
+            window_states[address] = window_state
+        elif record_type == CHECKPOINT_WINDOW_GONE:
+            window_states.pop(unpack_address(record, 0)[0], None)
+    return {'clients': members, 'disconnected': is_disconnected,
+            #a client that was paused gets RESUME, one that was not ignores it
+            'client_paused': not is_disconnected, 'waiting_for_peer': False, 'pending_requests': [], 'unreachable': [],
+            'sessions': list(session_states.items()), 'receive_windows': list(window_states.items()), 'session_keys': keys,
+            'daemon_datagrams': [], 'client_datagrams': []}
+
+
+#function to start the checkpoint thread, the file starts with the current (e.g. restored) state
+def start_checkpoints():
+    global checkpointer
+    path = checkpoint_path if worker_id is None else f"{checkpoint_path}.{worker_id}"
+    checkpointer = Checkpointer(path)
+    checkpointer.compact()
+    atexit.register(checkpointer.close)
+    threading.Thread(target=checkpointer.run, args=(checkpoint_interval,), daemon=True).start()
+    print(f"{server_name}: Checkpointing the sessions to {path} every {checkpoint_interval:g} s")
+
+
+#function that starts the server and calls function to wait for the client
+def start_server(address, multicast=None, hub=None, workers=1):
+    global server_name, daemon_socket, client_socket, hub_address, daemon_pool, client_pool, send_class_waits
+    global daemon_admission, client_admission, error_replies
+    if workers > 1:
+        start_workers(address, multicast, workers)
+        return
+    send_class_waits = SpanRecorder()
+    daemon_admission = SourceLimiter(SOURCE_RATE, SOURCE_BURST)
+    client_admission = SourceLimiter(SOURCE_RATE, SOURCE_BURST)
+    error_replies = SourceLimiter(ERROR_REPLY_RATE, ERROR_REPLY_BURST, TokenBucket(ERROR_REPLY_LIMIT, ERROR_REPLY_LIMIT))
+    server_name = "Server" + str(time.time())[-1]
+    if worker_id is not None:
+        server_name += f"/worker{worker_id}"
+    #the sockets (and the chat) of a daemon listening on the handoff socket are taken over, they stay bound all the time
+    taken = take_over(handoff_path) if handoff_path is not None else None
+    state = None
+    if taken is not None:
+        daemon_socket, client_socket, state = taken
+        print(f"{server_name}: Took the sockets and {len(state['sessions'])} sessions over from the daemon at {handoff_path}")
+    else:
+        daemon_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        daemon_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if worker_id is not None:
+            daemon_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        daemon_socket.bind((address, 7777))
+        client_socket.bind((address, 7778))
+        #after a crash the sessions of the checkpoint are resumed
+        if checkpoint_path is not None:
+            path = checkpoint_path if worker_id is None else f"{checkpoint_path}.{worker_id}"
+            state = read_checkpoint(path)
+            if state is not None and not state['clients']:
+                state = None
+            if state is not None:
+                print(f"{server_name}: Restoring the session of {state['clients'][0][0]} and {len(state['sessions'])} chat sessions from {path}")
+    if trace_path is not None:
+        start_trace(address)
+    if span_path is not None:
+        start_spans()
+    if profile_path is not None:
+        install_profiler()
+    daemon_pool = BufferPool()
+    client_pool = BufferPool()
+    if state is not None:
+        restore_state(state)
+    if checkpoint_path is not None:
+        start_checkpoints()
+    if worker_id is not None:
+        threading.Thread(target=dispatch_datagrams, daemon=True).start()
+    threading.Thread(target=send_queued, daemon=True).start()
+    if history_path is not None:
+        start_history()
+    start_memory_budget()
+    if metrics_interval:
+        threading.Thread(target=report_metrics, args=(metrics_interval,), daemon=True).start()
+    if multicast is not None:
+        join_multicast(address, multicast)
+    if hub is not None:
+        hub_address = (socket.gethostbyname(hub), 7777)
+        threading.Thread(target=keep_registered, daemon=True).start()
+        print(f"{server_name}: Reaching other daemons through the relay hub {hub}")
+    if cluster_seeds is not None:
+        start_cluster(address, cluster_seeds)
+    if handoff_path is not None:
+        threading.Thread(target=serve_handoff, args=(handoff_path,), daemon=True).start()
+    if state is not None:
+        resume_state()
+    else:
+        wait_for_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP daemon")
+    parser.add_argument("server_ip", help="address the daemon listens on (port 7777 for daemons, 7778 for the client)")
+    parser.add_argument("--multicast", metavar="GROUP", help="IP multicast group used to send group chat messages once on the local segment")
+    parser.add_argument("--relay", action="store_true", help="run as a relay hub that forwards datagrams between registered daemons")
+    parser.add_argument("--hub", metavar="HUB_IP", help="reach other daemons through the relay hub, users are requested as @username")
+    parser.add_argument("--cluster", metavar="IPS", help="other daemons of a cluster separated by commas, the usernames are spread over "
+                                                         "the daemons by consistent hashing and clients are redirected to the daemon of their user")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes sharing the ports with SO_REUSEPORT, one client per worker")
+    parser.add_argument("--pacing", action="store_true", help="pace the chat datagrams over the round trip time instead of sending the window at once")
+    parser.add_argument("--weight", action="append", default=[], metavar="PEER=WEIGHT",
+                        help="share of the sender thread the chat with PEER (ip or @username) gets, 1 by default, can be repeated")
+    parser.add_argument("--memory-budget", type=float, default=MEMORY_BUDGET, metavar="MB",
+                        help=f"memory of the tables, buffers, caches and queues, the caches are trimmed above 90%% of it ({MEMORY_BUDGET} MB by default)")
+    parser.add_argument("--debug", action="store_true", help="print the header fields of every datagram")
+    parser.add_argument("--metrics-interval", type=float, metavar="SECONDS", help="print the send and receive windows of the chats periodically")
+    parser.add_argument("--trace", metavar="FILE", help="record every datagram of the daemon in a binary trace file (replay it with simp_trace.py)")
+    parser.add_argument("--handoff", metavar="SOCKET", help="unix socket for restarts: a daemon started with the same socket takes the sockets and the chat over")
+    parser.add_argument("--mac-key-file", metavar="FILE", help="file with a secret shared by the daemons, the chats between them get a MAC on every datagram")
+    parser.add_argument("--checkpoint", metavar="FILE", help="checkpoint the sessions to the file and resume them from it after a crash")
+    parser.add_argument("--checkpoint-interval", type=float, default=CHECKPOINT_INTERVAL, metavar="SECONDS",
+                        help="how often the changed sessions are written to the checkpoint")
+    parser.add_argument("--spans", metavar="FILE", help="record per-stage latency histograms of the messages and write them to a JSON file")
+    parser.add_argument("--history", metavar="FILE", help="append the delivered chat messages to the file and index them, the client searches them")
+    parser.add_argument("--profile", metavar="FILE", help="SIGUSR2 starts and stops a sampling profiler that writes collapsed stacks to the file")
+    args = parser.parse_args()
+    pacing = args.pacing
+    debug = args.debug
+    metrics_interval = args.metrics_interval
+    trace_path = args.trace
+    span_path = args.spans
+    handoff_path = args.handoff
+    checkpoint_path = args.checkpoint
+    history_path = args.history
+    if args.mac_key_file is not None:
+        try:
+            with open(args.mac_key_file, 'rb') as f:
+                mac_secret = f.read().strip()
+        except OSError as e:
+            parser.error(f"can not read the MAC key: {e}")
+        if not mac_secret:
+            parser.error(f"{args.mac_key_file} is empty")
+    checkpoint_interval = args.checkpoint_interval
+    #the receive pools alone take 0.5 MB
+    if args.memory_budget < 1:
+        parser.error("--memory-budget has to be at least 1 MB")
+    memory_limit = int(args.memory_budget * (1 << 20))
+    for weight in args.weight:
+        peer, _, share = weight.partition('=')
+        try:
+            peer_weights[peer] = int(share)
+        except ValueError:
+            parser.error(f"--weight {weight} is not PEER=WEIGHT")
+        if peer_weights[peer] < 1:
+            parser.error(f"the weight of {peer} has to be at least 1")
+    profile_path = args.profile
+
+    if args.workers > 1 and args.hub is not None:
+        parser.error("--workers can not be combined with --hub")
+    if args.workers > 1 and args.handoff is not None:
+        parser.error("--workers can not be combined with --handoff")
+    if args.cluster is not None and (args.workers > 1 or args.hub is not None):
+        parser.error("--cluster can not be combined with --workers or --hub")
+    if args.cluster is not None:
+        cluster_seeds = [host.strip() for host in args.cluster.split(',') if host.strip()]
+    if args.relay:
+        run_relay(args.server_ip)
+    else:
+        start_server(args.server_ip, multicast=args.multicast, hub=args.hub, workers=args.workers)
@@ -0,0 +1,304 @@
+import asyncio
+import random
+import socket
+import time
+import argparse
+import ipaddress
+from simp_daemon import (DatagramType, OperationType, ReceiveWindow, get_datagram_type, get_operation_type,
+                         get_sequence_number, get_username, build_chat_message, build_fin_message,
+                         build_control_message, build_window_ack, get_msg_payload,
+                         MAX_PAYLOAD_SIZE, MAX_REQUEST_HOSTS, SEQ_SPACE, RECV_WINDOW, SYN_TIMEOUT)
+from simp_client import SimpClient, SimpError
+
+DAEMON_PORT = 7777
+TICK = 0.005  # how often the peers check their send schedule and retransmission timers
+PEER_WINDOW = RECV_WINDOW // 2  # chat datagrams a peer has in flight, the rest wait in its backlog
+PEER_RTO = 1.0  # retransmission timeout of the peers
+PEER_RETRANSMISSIONS = 5
+DRAIN_TIMEOUT = 10  # how long the messages in flight are waited for after the run
+FIN_TIMEOUT = 5
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+#emulated daemon, answers the handshake of the target, sends chat datagrams at a fixed rate and acknowledges the ones it receives.
+#every chat payload carries the index of the peer, a message id and the send time, so the target's client can measure the latency
+class EmulatedPeer(asyncio.DatagramProtocol):
+    def __init__(self, generator, index, address):
+        self.generator = generator
+        self.index = index
+        self.address = address
+        self.username = f'peer{index}'
+        self.transport = None
+        self.target = None  # address of the target daemon, known from its SYN
+        self.established = False
+        self.next_seq = 0
+        self.next_id = 0
+        self.in_flight = {}  # seq -> [datagram, message id, first sent, last sent, retransmissions]
+        self.backlog = []  # datagrams waiting for the window
+        self.window = ReceiveWindow()  # chat datagrams the target forwards from the other peers
+        self.fin_acked = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def send(self, datagram):
+        self.transport.sendto(datagram, self.target)
+
+    #the fields are read without build_header, it prints every header and would slow the peers down
+    def datagram_received(self, data, addr):
+        dtype = get_datagram_type(data)
+        operation = get_operation_type(data)
+        seq = get_sequence_number(data)
+        now = time.perf_counter()
+        if dtype == DatagramType.CONTROL and operation == OperationType.SYN:
+            #the SYN+ACK is sent again for a retransmitted SYN
+            self.target = addr
+            self.send(build_control_message(OperationType.SYN.value | OperationType.ACK.value, 0, self.username))
+
+        elif dtype == DatagramType.CONTROL and operation == OperationType.ACK:
+            payload = get_msg_payload(data)
+            if not payload:
+                if not self.established:
+                    self.established = True
+                    self.generator.established += 1
+                return
+            entry = self.in_flight.pop(seq, None)
+            if entry is not None:
+                self.generator.acked += 1
+                #Karn's rule, the RTT of a retransmitted datagram is not sampled
+                if entry[4] == 0:
+                    self.generator.ack_latency.append(now - entry[2])
+                self.fill_window(now)
+
+        elif dtype == DatagramType.CHAT and operation == OperationType.MESSAGE:
+            username = get_username(data)
+            delivered = self.window.receive(seq, username, get_msg_payload(data), now)
+            if delivered is None:
+                return
+            self.send(build_window_ack(seq, username, self.window.advertised()))
+            for _, payload in delivered:
+                self.generator.record_forwarded(payload, now)
+
+        elif dtype == DatagramType.CONTROL and operation == (OperationType.FIN.value | OperationType.ACK.value):
+            self.fin_acked = True
+
+        elif dtype == DatagramType.CONTROL and operation == OperationType.FIN:
+            #the target ended the chat
+            self.send(build_control_message(OperationType.FIN.value | OperationType.ACK.value, seq, self.username))
+            self.established = False
+
+    #function to queue the next chat message of the peer
+    def send_message(self, size, now):
+        text = f'{self.index} {self.next_id} {time.perf_counter_ns()} '.encode('ascii')
+        payload = b''.join([b'\x00', text, b'x' * max(size - len(text) - 1, 0)])
+        self.next_id += 1
+        self.backlog.append(payload)
+        self.generator.sent += 1
+        self.fill_window(now)
+
+    def fill_window(self, now):
+        while self.backlog and len(self.in_flight) < PEER_WINDOW and self.established:
+            payload = self.backlog.pop(0)
+            seq = self.next_seq
+            self.next_seq = (self.next_seq + 1) % SEQ_SPACE
+            datagram = build_chat_message(payload, seq, self.username)
+            self.in_flight[seq] = [datagram, payload, now, now, 0]
+            self.send(datagram)
+
+    #function to retransmit the datagrams that were not acknowledged in time, they are given up after PEER_RETRANSMISSIONS
+    def check_timers(self, now):
+        for seq, entry in list(self.in_flight.items()):
+            if now - entry[3] < PEER_RTO:
+                continue
+            if entry[4] >= PEER_RETRANSMISSIONS:
+                del self.in_flight[seq]
+                self.generator.given_up += 1
+                continue
+            entry[3] = now
+            entry[4] += 1
+            self.generator.retransmitted += 1
+            self.send(entry[0])
+        self.fill_window(now)
+
+
+#load generator, emulates many daemons in one process against a target daemon. the client of the target (a SimpClient)
+#requests a group chat with all of them, every peer sends messages at the given rate and the target passes them to its client
+#and forwards them to the other peers
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.first_ip = ipaddress.IPv4Address(args.first_ip)
+        self.peers = []
+        self.established = 0
+        self.sent = 0
+        self.acked = 0
+        self.retransmitted = 0
+        self.given_up = 0
+        self.delivered = set()  # (peer, message id) received by the target's client
+        self.delivery_latency = []
+        self.ack_latency = []
+        self.forwarded = 0
+        self.forward_latency = []
+
+    #function to get the send time from a chat payload of a peer, None for other messages (e.g. 'left the chat')
+    def parse_payload(self, payload):
+        fields = bytes(payload).lstrip(b'\x00').split(b' ')
+        if len(fields) < 3 or not fields[0].isdigit():
+            return None
+        return int(fields[0]), int(fields[1]), int(fields[2])
+
+    #callback of the target's client
+    def record_delivered(self, username, text):
+        parsed = self.parse_payload(text.encode('ascii'))
+        if parsed is None:
+            return
+        key = parsed[:2]
+        if key not in self.delivered:
+            self.delivered.add(key)
+            self.delivery_latency.append((time.perf_counter_ns() - parsed[2]) / 1e9)
+
+    def record_forwarded(self, payload, now):
+        parsed = self.parse_payload(payload)
+        if parsed is None:
+            return
+        self.forwarded += 1
+        self.forward_latency.append((time.perf_counter_ns() - parsed[2]) / 1e9)
+
+    async def open_peers(self):
+        loop = asyncio.get_running_loop()
+        for index in range(self.args.peers):
+            address = (str(self.first_ip + index), DAEMON_PORT)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(address)
+            peer = EmulatedPeer(self, index, address)
+            await loop.create_datagram_endpoint(lambda: peer, sock=sock)
+            self.peers.append(peer)
+
+    def close_peers(self):
+        for peer in self.peers:
+            if peer.transport is not None:
+                peer.transport.close()
+
+    #function that sends the messages of the peers on their schedule, every peer starts at a random phase of its interval
+    async def generate(self, duration):
+        interval = 1 / self.args.rate
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        next_send = [start + random.uniform(0, interval) for _ in self.peers]
+        while loop.time() - start < duration:
+            now = loop.time()
+            perf_now = time.perf_counter()
+            for index, peer in enumerate(self.peers):
+                while next_send[index] <= now:
+                    peer.send_message(self.args.size, perf_now)
+                    next_send[index] += interval
+                peer.check_timers(perf_now)
+            await asyncio.sleep(TICK)
+
+    #function to wait until the messages in flight are acknowledged or given up
+    async def drain(self, timeout):
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline and any(peer.in_flight or peer.backlog for peer in self.peers):
+            now = time.perf_counter()
+            for peer in self.peers:
+                peer.check_timers(now)
+            await asyncio.sleep(TICK)
+
+    #function that ends the chat from the peers side, every peer sends a FIN until the target answers with FIN+ACK
+    async def leave(self, timeout):
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            leaving = [peer for peer in self.peers if peer.established and not peer.fin_acked]
+            if not leaving:
+                return
+            for peer in leaving:
+                peer.send(build_fin_message(peer.next_seq, peer.username))
+            await asyncio.sleep(0.5)
+
+    async def run(self):
+        args = self.args
+        await self.open_peers()
+        last_ip = self.first_ip + args.peers - 1
+        client = SimpClient(args.target, 'loadgen', on_message=self.record_delivered)
+        await client.open()
+        try:
+            await client.connect()
+            print(f"Requesting a group chat with {args.peers} peers ({self.first_ip}-{last_ip})")
+            started = time.perf_counter()
+            try:
+                await client.request(f'{self.first_ip}-{last_ip}', group=True, timeout=SYN_TIMEOUT + 5)
+            except (SimpError, asyncio.TimeoutError) as e:
+                print(f"Target refused the chat: {e}")
+                return
+            #the handshake ACKs of the last peers may still be on the way
+            await asyncio.sleep(0.5)
+            print(f"{self.established} peers connected in {time.perf_counter() - started:.2f} s")
+
+            print(f"Sending {args.rate:g} messages/s of {args.size} bytes per peer for {args.duration:g} s")
+            started = time.perf_counter()
+            await self.generate(args.duration)
+            elapsed = time.perf_counter() - started
+            await self.drain(DRAIN_TIMEOUT)
+            await asyncio.sleep(0.5)
+            self.report(elapsed)
+
+            await self.leave(FIN_TIMEOUT)
+            try:
+                await asyncio.wait_for(client.chat_ended.wait(), FIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                client.disconnect()
+            await client.quit()
+        finally:
+            client.close()
+            self.close_peers()
+
+    def report(self, elapsed):
+        delivered = len(self.delivered)
+        lost = self.sent - delivered
+        print(f"\nPeers: {self.established} of {self.args.peers} connected")
+        print(f"Sent: {self.sent} messages ({self.sent / elapsed:.1f}/s offered), {self.retransmitted} retransmitted, {self.given_up} given up")
+        print(f"Delivered to the target's client: {delivered} ({delivered / elapsed:.1f}/s), "
+              f"lost {lost} ({100 * lost / max(self.sent, 1):.2f}%)")
+        print_latency('Delivery latency', self.delivery_latency)
+        print_latency('ACK round trip', self.ack_latency)
+        if self.args.peers > 1:
+            expected = delivered * (self.established - 1)
+            print(f"Forwarded to the other peers: {self.forwarded} of {expected} ({self.forwarded / elapsed:.1f}/s)")
+            print_latency('Forwarding latency', self.forward_latency)
+
+
+#function to get a percentile of sorted values (nearest rank)
+def percentile(values, p):
+    rank = max(int(round(p / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def print_latency(name, samples):
+    if not samples:
+        print(f"{name}: no samples")
+        return
+    samples = sorted(samples)
+    values = ', '.join(f"p{p:g} {percentile(samples, p) * 1000:.1f} ms" for p in PERCENTILES)
+    print(f"{name}: {values}, max {samples[-1] * 1000:.1f} ms ({len(samples)} samples)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP load generator, emulates many daemons against one target daemon")
+    parser.add_argument("target", help="address of the target daemon, the load generator connects to it as its client")
+    parser.add_argument("--peers", type=int, default=100, help="number of emulated daemons")
+    parser.add_argument("--first-ip", default="127.1.0.1", help="address of the first emulated daemon, the others follow it")
+    parser.add_argument("--rate", type=float, default=0.2, help="messages per second sent by every peer")
+    parser.add_argument("--size", type=int, default=64, help="payload size of the chat messages")
+    parser.add_argument("--duration", type=float, default=10, help="how long the messages are sent, in seconds")
+    args = parser.parse_args()
+    if not 0 < args.size <= MAX_PAYLOAD_SIZE:
+        parser.error(f"--size has to be between 1 and {MAX_PAYLOAD_SIZE}")
+    if args.rate <= 0:
+        parser.error("--rate has to be positive")
+    if not 0 < args.peers <= MAX_REQUEST_HOSTS:
+        parser.error(f"--peers has to be between 1 and {MAX_REQUEST_HOSTS}")
+    try:
+        asyncio.run(LoadGenerator(args).run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,167 @@
+import heapq
+import random
+import select
+import socket
+import threading
+import time
+import argparse
+
+DAEMON_PORT = 7777
+RECV_BUFFER_SIZE = 4096
+POLL_INTERVAL = 0.5  # how often the proxy checks if it was stopped when nothing is scheduled
+REORDER_DELAY = 0.05  # how long a reordered datagram is held back, the datagrams after it overtake it
+
+
+#counters of one direction of the proxy
+class LinkStats:
+    def __init__(self):
+        self.received = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.sent = 0
+
+    def __str__(self):
+        return (f"received {self.received}, sent {self.sent}, dropped {self.dropped}, "
+                f"duplicated {self.duplicated}, reordered {self.reordered}")
+
+
+#impairment of one direction of the proxy. the random numbers are drawn in the same order for every datagram,
+#so the same seed and the same datagrams give the same drops, delays, duplicates and reorderings
+class Impairment:
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, duplicate=0.0, reorder=0.0, seed=None):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.stats = LinkStats()
+
+    #function that returns when the datagram received now is sent, an empty list if it is dropped and two times if it is duplicated
+    def schedule(self, now):
+        lost = self.random.random() < self.loss
+        jitter = self.random.uniform(-self.jitter, self.jitter)
+        duplicate_jitter = self.random.uniform(-self.jitter, self.jitter)
+        duplicated = self.random.random() < self.duplicate
+        reordered = self.random.random() < self.reorder
+        self.stats.received += 1
+        if lost:
+            self.stats.dropped += 1
+            return []
+        times = [now + max(self.delay + jitter, 0)]
+        if reordered:
+            self.stats.reordered += 1
+            times[0] += REORDER_DELAY
+        if duplicated:
+            self.stats.duplicated += 1
+            times.append(now + max(self.delay + duplicate_jitter, 0))
+        return times
+
+
+#userspace UDP proxy between two daemons, it injects loss, delay, jitter, duplication and reordering.
+#daemon A reaches daemon B through proxy_b and daemon B reaches daemon A through proxy_a: a datagram of A that arrives at proxy_b
+#is sent to B from proxy_a, so B answers to proxy_a and the answer goes back to A from proxy_b
+class ImpairmentProxy:
+    def __init__(self, daemon_a, daemon_b, proxy_a, proxy_b, impairment_ab, impairment_ba):
+        self.sock_a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # stands for daemon A
+        self.sock_a.bind((proxy_a, DAEMON_PORT))
+        self.sock_b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # stands for daemon B
+        self.sock_b.bind((proxy_b, DAEMON_PORT))
+        self.stats_ab = impairment_ab.stats
+        self.stats_ba = impairment_ba.stats
+        #socket a datagram arrives on -> (socket it leaves from, destination, impairment, direction)
+        self.routes = {
+            self.sock_b: (self.sock_a, (daemon_b, DAEMON_PORT), impairment_ab, 'a->b'),
+            self.sock_a: (self.sock_b, (daemon_a, DAEMON_PORT), impairment_ba, 'b->a'),
+        }
+        self.scheduled = []  # heap of (send time, order, socket, datagram, destination, stats)
+        self.order = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.on_drop = None  # called with the dropped datagram and the direction, e.g. to measure the recovery of a loss
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sock_a.close()
+        self.sock_b.close()
+
+    def run(self):
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            timeout = POLL_INTERVAL if not self.scheduled else max(self.scheduled[0][0] - now, 0)
+            readable, _, _ = select.select([self.sock_a, self.sock_b], [], [], timeout)
+            now = time.monotonic()
+            for sock in readable:
+                try:
+                    datagram, address = sock.recvfrom(RECV_BUFFER_SIZE)
+                except OSError:
+                    continue
+                self.impair(sock, datagram, now)
+            self.send_due(time.monotonic())
+
+    #function to schedule a received datagram according to the impairment of its direction
+    def impair(self, sock, datagram, now):
+        out, destination, impairment, direction = self.routes[sock]
+        times = impairment.schedule(now)
+        if not times and self.on_drop is not None:
+            self.on_drop(datagram, direction)
+        for send_time in times:
+            self.order += 1
+            heapq.heappush(self.scheduled, (send_time, self.order, out, datagram, destination, impairment.stats))
+
+    def send_due(self, now):
+        while self.scheduled and self.scheduled[0][0] <= now:
+            _, _, out, datagram, destination, stats = heapq.heappop(self.scheduled)
+            try:
+                out.sendto(datagram, destination)
+            except OSError as e:
+                print(f"Proxy: could not send to {destination}: {e}")
+                continue
+            stats.sent += 1
+
+
+#function to add the impairment arguments to an argument parser, used by the proxy and the benchmarks
+def add_impairment_arguments(parser):
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that a datagram is dropped")
+    parser.add_argument("--delay", type=float, default=0.0, help="one-way delay in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="the delay varies uniformly by up to that many milliseconds")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="probability that a datagram is sent twice")
+    parser.add_argument("--reorder", type=float, default=0.0,
+                        help=f"probability that a datagram is held back {REORDER_DELAY * 1000:g} ms, so the next ones overtake it")
+    parser.add_argument("--seed", type=int, help="seed of the impairments, the same seed gives the same impairments")
+
+
+#function to build the impairments of both directions from the parsed arguments, the directions get different seeds
+def impairments_from_args(args):
+    seeds = (None, None) if args.seed is None else (args.seed, args.seed + 1)
+    return [Impairment(args.loss, args.delay / 1000, args.jitter / 1000, args.duplicate, args.reorder, seed) for seed in seeds]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP impairment proxy between two daemons")
+    parser.add_argument("daemon_a", help="address of daemon A")
+    parser.add_argument("daemon_b", help="address of daemon B")
+    parser.add_argument("--proxy-a", required=True, help="address the proxy listens on for daemon B, B's client requests it")
+    parser.add_argument("--proxy-b", required=True, help="address the proxy listens on for daemon A, A's client requests it")
+    parser.add_argument("--stats-interval", type=float, default=10, help="print the counters every that many seconds")
+    add_impairment_arguments(parser)
+    args = parser.parse_args()
+
+    impairment_ab, impairment_ba = impairments_from_args(args)
+    proxy = ImpairmentProxy(args.daemon_a, args.daemon_b, args.proxy_a, args.proxy_b, impairment_ab, impairment_ba)
+    proxy.start()
+    print(f"Proxy: {args.daemon_a} reaches {args.daemon_b} as {args.proxy_b}, {args.daemon_b} reaches {args.daemon_a} as {args.proxy_a}")
+    try:
+        while True:
+            time.sleep(args.stats_interval)
+            print(f"Proxy: a->b {proxy.stats_ab}")
+            print(f"Proxy: b->a {proxy.stats_ba}")
+    except KeyboardInterrupt:
+        proxy.stop()
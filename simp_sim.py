@@ -0,0 +1,665 @@
+import os
+import sys
+import time
+import heapq
+import types
+import random
+import socket
+import argparse
+import threading
+import traceback
+from collections import deque
+from functools import partial
+from simp_client import MessageType
+from simp_proxy import Impairment, add_impairment_arguments
+from simp_daemon import SYN_TIMEOUT, FIN_TIMEOUT, RECV_BUFFER_SIZE
+
+DAEMON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simp_daemon.py')
+DAEMON_PORT = 7777
+CLIENT_PORT = 7778
+DAEMON_IPS = ('10.0.0.1', '10.0.0.2')  # addresses of the simulated daemons A and B
+CLIENT_IPS = ('10.0.1.1', '10.0.1.2')  # addresses of their clients
+SIM_EPOCH = 1700000000.0  # time.time() of the daemons at the start of every run
+SIM_DELAY = 10  # default one-way delay between the daemons in milliseconds
+LOCAL_DELAY = 0.0001  # delay between a daemon and its client, not impaired
+SOCKET_QUEUE = 256  # datagrams a simulated socket buffers, the later ones are dropped like in a full receive buffer
+SIM_LIMIT = 600  # virtual seconds a run may take, the clients that still wait then are stuck
+SETTLE_TIME = FIN_TIMEOUT + 10  # virtual seconds the daemons run on after the clients are done, e.g. for the retransmitted FINs
+REPLY_TIMEOUT = 70  # how long a client waits for an answer of its daemon (a daemon waits up to 60 s for a peer or a decision)
+POLL_INTERVAL = 0.01  # how often a client checks a condition of the run, e.g. that the other client is ready
+FAILURES_SHOWN = 5  # failed runs printed per scenario
+
+daemon_code = None  # simp_daemon.py is compiled once, every simulated daemon executes it in a module of its own
+
+
+#exception raised in the threads of a run that is over, it unwinds them. it is not an Exception, so the handlers of the daemon let it pass
+class SimExit(BaseException):
+    pass
+
+
+#function to create a lock that is already held, a thread waits on it until another one releases it (faster than a semaphore)
+def locked():
+    lock = threading.Lock()
+    lock.acquire()
+    return lock
+
+
+#function that stands for print in a daemon when the run is not verbose
+def quiet(*values, **kwargs):
+    pass
+
+
+#simulation class, a virtual clock with the timers of a run, the scheduler of its threads and the network between its sockets.
+#the threads of the daemons and the clients are real threads, but only one of them runs at a time: the running thread gives the
+#control back when it blocks (socket, condition, sleep, join) and the scheduler runs the woken threads in the order they were woken.
+#when none is left the clock jumps to the next timer. the impairments of the links are seeded, so a seed gives the same run every time
+class Simulation:
+    def __init__(self, seed, args):
+        self.now = 0.0
+        self.timers = []  # heap of (time, order, callback)
+        self.order = 0
+        self.ready = deque()  # threads that can run, in the order they were woken
+        self.threads = []
+        self.current = None
+        self.switched = locked()  # released by the running thread when it blocks or ends
+        self.stopping = False
+        self.seed = seed
+        self.random = random.Random(f'{seed} scenario')
+        self.args = args
+        self.sockets = {}  # (ip, port) -> SimSocket
+        self.links = {}  # (source ip, destination ip) -> Impairment
+        for i, (source, destination) in enumerate(((DAEMON_IPS[0], DAEMON_IPS[1]), (DAEMON_IPS[1], DAEMON_IPS[0]))):
+            self.links[(source, destination)] = Impairment(args.loss, args.delay / 1000, args.jitter / 1000, args.duplicate, args.reorder,
+                                                           f'{seed} link {i}')
+        self.switches = 0
+        self.datagrams = 0
+        self.overflows = 0  # datagrams dropped because the socket queue was full or nothing was bound to the address
+        self.errors = []
+
+    def call_at(self, when, callback):
+        self.order += 1
+        heapq.heappush(self.timers, (when, self.order, callback))
+
+    #function to start a thread of the run, it runs once the running thread blocks
+    def spawn(self, target, *args):
+        thread = SimThread(self, target, args)
+        thread.start()
+        return thread
+
+    #function that blocks the running thread until it is woken through waiters or timeout expires
+    def block(self, timeout=None, *waiters):
+        if self.stopping:
+            raise SimExit()
+        thread = self.current
+        self.order += 1
+        token = thread.blocked = self.order
+        for queue in waiters:
+            queue.append((thread, token))
+        if timeout is not None:
+            self.call_at(self.now + max(timeout, 0), partial(self.wake, thread, token))
+        self.switched.release()
+        thread.baton.acquire()
+        if self.stopping:
+            raise SimExit()
+
+    #function to wake a blocked thread, token tells which block it is woken from (a thread can be woken only once per block)
+    def wake(self, thread, token):
+        if thread.blocked == token:
+            thread.blocked = None
+            self.ready.append(thread)
+
+    def wake_all(self, waiters):
+        for thread, token in waiters:
+            self.wake(thread, token)
+        waiters.clear()
+
+    def sleep(self, seconds):
+        self.block(seconds)
+
+    #function to run the threads and the timers until done() is true or the clock reaches until,
+    #returns False if it stopped because of the clock or because every thread blocked with nothing left to wake it
+    def run(self, until, done=None):
+        while True:
+            while self.ready:
+                thread = self.ready.popleft()
+                self.current = thread
+                self.switches += 1
+                thread.baton.release()
+                self.switched.acquire()
+            self.current = None
+            if done is not None and done():
+                return True
+            if not self.timers or self.timers[0][0] > until:
+                self.now = max(self.now, until) if self.timers else self.now
+                return False
+            when, _, callback = heapq.heappop(self.timers)
+            self.now = max(self.now, when)
+            callback()
+
+    #function to end the run, the blocked threads are woken one after the other and unwound with SimExit
+    def stop(self):
+        self.stopping = True
+        for thread in list(self.threads):
+            if thread.alive:
+                self.current = thread
+                thread.baton.release()
+                self.switched.acquire()
+        self.current = None
+
+    #function to send a datagram, it arrives after the delay of the link (or not at all, twice or late if the link is impaired)
+    def send(self, data, source, destination):
+        self.datagrams += 1
+        impairment = self.links.get((source[0], destination[0]))
+        times = [self.now + LOCAL_DELAY] if impairment is None else impairment.schedule(self.now)
+        for when in times:
+            self.call_at(when, partial(self.deliver, data, source, destination))
+
+    def deliver(self, data, source, destination):
+        sock = self.sockets.get(destination)
+        if sock is None or len(sock.queue) >= SOCKET_QUEUE:
+            self.overflows += 1
+            return
+        sock.queue.append((data, source))
+        self.wake_all(sock.waiters)
+
+    def log(self, name, *values, **kwargs):
+        print(f"{self.now:10.4f} {name}:", *values, **kwargs)
+
+    #function to start a daemon on ip. simp_daemon.py runs unchanged in a module of its own, with the clock, the threads and
+    #the sockets of the run in place of the time, threading, socket and select modules
+    def start_daemon(self, ip, name):
+        global daemon_code
+        if daemon_code is None:
+            with open(DAEMON_PATH) as f:
+                daemon_code = compile(f.read(), DAEMON_PATH, 'exec')
+        daemon = types.ModuleType(f'simp_daemon_{name}')
+        daemon.__file__ = DAEMON_PATH
+        exec(daemon_code, daemon.__dict__)
+        daemon.time = SimTime(self)
+        daemon.threading = SimThreading(self)
+        daemon.socket = SimSocketApi(self)
+        daemon.select = SimSelect(self)
+        daemon.flow_changed = SimCondition(self, daemon.ack_lock)
+        daemon.print = partial(self.log, name) if self.args.verbose else quiet
+        daemon.pacing = self.args.pacing
+        self.spawn(daemon.start_server, ip)
+        return daemon
+
+
+#thread class of a run, a real thread that only runs when the scheduler passes it the baton
+class SimThread:
+    def __init__(self, sim, target, args=(), kwargs=None):
+        self.sim = sim
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.baton = locked()  # released by the scheduler when the thread runs
+        self.blocked = None  # token of the block the thread waits in
+        self.alive = False
+        self.joiners = []
+        self.name = getattr(target, '__name__', 'thread')
+
+    def start(self):
+        self.alive = True
+        self.sim.threads.append(self)
+        self.sim.ready.append(self)
+        threading.Thread(target=self.bootstrap, daemon=True).start()
+
+    def bootstrap(self):
+        self.baton.acquire()
+        try:
+            if not self.sim.stopping:
+                self.target(*self.args, **self.kwargs)
+        except SimExit:
+            pass
+        except Exception:
+            self.sim.errors.append(f"thread {self.name} raised {traceback.format_exc(limit=-3)}")
+        finally:
+            self.alive = False
+            self.sim.wake_all(self.joiners)
+            self.sim.switched.release()
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self, timeout=None):
+        if self.alive:
+            self.sim.block(timeout, self.joiners)
+
+
+#condition class of a run, waiting blocks the thread in the scheduler instead of the lock
+class SimCondition:
+    def __init__(self, sim, lock=None):
+        self.sim = sim
+        self.lock = threading.Lock() if lock is None else lock
+        self.waiters = []
+
+    def __enter__(self):
+        return self.lock.__enter__()
+
+    def __exit__(self, *exc):
+        return self.lock.__exit__(*exc)
+
+    def wait(self, timeout=None):
+        self.lock.release()
+        try:
+            self.sim.block(timeout, self.waiters)
+        finally:
+            self.lock.acquire()
+        return True
+
+    def notify(self, n=1):
+        woken, self.waiters[:] = self.waiters[:n], self.waiters[n:]
+        self.sim.wake_all(woken)
+
+    def notify_all(self):
+        self.sim.wake_all(self.waiters)
+
+
+#stands for the time module in a daemon, every clock is the virtual clock of the run
+class SimTime:
+    def __init__(self, sim):
+        self.sim = sim
+
+    def monotonic(self):
+        return self.sim.now
+
+    def monotonic_ns(self):
+        return int(self.sim.now * 1e9)
+
+    def perf_counter(self):
+        return self.sim.now
+
+    def perf_counter_ns(self):
+        return int(self.sim.now * 1e9)
+
+    def time(self):
+        return SIM_EPOCH + self.sim.now
+
+    def sleep(self, seconds):
+        self.sim.sleep(seconds)
+
+
+#stands for the threading module in a daemon, the locks are real (a thread never blocks while it holds one), the rest is simulated
+class SimThreading:
+    Lock = staticmethod(threading.Lock)
+    RLock = staticmethod(threading.RLock)
+    Event = staticmethod(threading.Event)
+    get_ident = staticmethod(threading.get_ident)
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def Thread(self, target=None, args=(), kwargs=None, daemon=None, name=None):
+        return SimThread(self.sim, target, args, kwargs)
+
+    def Condition(self, lock=None):
+        return SimCondition(self.sim, lock)
+
+    def active_count(self):
+        return sum(1 for thread in self.sim.threads if thread.alive)
+
+
+#stands for the socket module in a daemon, the sockets are simulated and the host names are the addresses of the run
+class SimSocketApi:
+    def __init__(self, sim):
+        self.sim = sim
+
+    def socket(self, family=socket.AF_INET, type=socket.SOCK_DGRAM, proto=0):
+        return SimSocket(self.sim)
+
+    def gethostbyname(self, host):
+        return host
+
+    def __getattr__(self, name):
+        return getattr(socket, name)
+
+
+#stands for the select module in a daemon, a socket is readable when a datagram waits in its queue
+class SimSelect:
+    def __init__(self, sim):
+        self.sim = sim
+
+    def select(self, rlist, wlist, xlist, timeout=None):
+        deadline = None if timeout is None else self.sim.now + timeout
+        while True:
+            ready = [sock for sock in rlist if sock.queue]
+            if ready or (deadline is not None and self.sim.now >= deadline):
+                return ready, [], []
+            self.sim.block(None if deadline is None else deadline - self.sim.now, *(sock.waiters for sock in rlist))
+
+
+#UDP socket of a run, the received datagrams wait in a queue of at most SOCKET_QUEUE datagrams
+class SimSocket:
+    def __init__(self, sim, address=None):
+        self.sim = sim
+        self.address = None
+        self.timeout = None
+        self.queue = deque()  # (datagram, source address)
+        self.waiters = []
+        if address is not None:
+            self.bind(address)
+
+    def bind(self, address):
+        if address in self.sim.sockets:
+            raise OSError(f"{address[0]}:{address[1]} is already in use")
+        self.address = address
+        self.sim.sockets[address] = self
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0.0
+
+    def sendto(self, data, address):
+        self.sim.send(bytes(data), self.address, address)
+        return len(data)
+
+    #function to take the next datagram, blocking with the timeout of the socket like a real one
+    def receive(self, flags=0):
+        if not self.queue:
+            if self.timeout == 0 or flags & getattr(socket, 'MSG_DONTWAIT', 0):
+                raise BlockingIOError("no datagram is waiting")
+            deadline = None if self.timeout is None else self.sim.now + self.timeout
+            while not self.queue:
+                if deadline is not None and self.sim.now >= deadline:
+                    raise socket.timeout("timed out")
+                self.sim.block(None if deadline is None else deadline - self.sim.now, self.waiters)
+        return self.queue.popleft()
+
+    def recvfrom(self, size):
+        data, address = self.receive()
+        return data[:size], address
+
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        data, address = self.receive(flags)
+        size = min(len(data), nbytes or len(buffer))
+        buffer[:size] = data[:size]
+        return size, address
+
+    def close(self):
+        if self.sim.sockets.get(self.address) is self:
+            del self.sim.sockets[self.address]
+
+
+#client of a run, it talks to its daemon through a simulated socket like simp_client.py does through a real one
+class SimClient:
+    def __init__(self, sim, ip, daemon_ip, username):
+        self.sim = sim
+        self.sock = SimSocket(sim, (ip, CLIENT_PORT))
+        self.daemon = (daemon_ip, CLIENT_PORT)
+        self.username = username
+        self.received = []  # chat messages as (username, text)
+        self.answers = []  # the other messages of the daemon as (message type, payload)
+
+    def send(self, message_type, payload=b''):
+        self.sock.sendto(message_type.to_bytes() + payload, self.daemon)
+
+    #function to wait for a message of the daemon, returns (None, b'') if none came within timeout (0 does not wait)
+    def receive(self, timeout=REPLY_TIMEOUT):
+        self.sock.settimeout(timeout)
+        try:
+            data, _ = self.sock.recvfrom(RECV_BUFFER_SIZE)
+        except (socket.timeout, BlockingIOError):
+            return None, b''
+        message_type = MessageType(data[0])
+        if message_type == MessageType.CHAT:
+            self.received.append((str(data[1:33], 'ascii').rstrip('\x00'), str(data[34:], 'ascii')))
+        else:
+            self.answers.append((message_type, data[1:]))
+        return message_type, data[1:]
+
+    #function to wait for a message of one of the types, the others are only recorded. returns (None, b'') after timeout
+    def expect(self, *message_types, timeout=REPLY_TIMEOUT):
+        deadline = self.sim.now + timeout
+        while True:
+            message_type, payload = self.receive(max(deadline - self.sim.now, 1e-9))
+            if message_type is None or message_type in message_types:
+                return message_type, payload
+
+    def connect(self):
+        self.send(MessageType.CONNECTION, self.username.encode('ascii').ljust(32, b'\x00'))
+        return self.expect(MessageType.CONNECTION, MessageType.WAIT, MessageType.ERROR)[0] == MessageType.CONNECTION
+
+    #function to send count chat messages "<number> xxx..." at rate, a message that comes back with BACKPRESSURE
+    #is sent again with the ones after it once the daemon sends RESUME. returns False if RESUME did not come
+    def send_messages(self, count, size, rate):
+        i = 0
+        while i < count:
+            text = f'{i} '.encode('ascii')
+            self.send(MessageType.CHAT, text + b'x' * max(size - len(text), 0))
+            i += 1
+            self.sim.sleep(1 / rate)
+            paused = None
+            while True:
+                message_type, payload = self.receive(0)
+                if message_type is None:
+                    break
+                if message_type == MessageType.BACKPRESSURE:
+                    index = int(payload.split(b' ', 1)[0])
+                    paused = index if paused is None else min(paused, index)
+            if paused is not None:
+                i = paused
+                if self.expect(MessageType.RESUME)[0] is None:
+                    return False
+        return True
+
+    def chat_numbers(self):
+        return [int(text.split(' ', 1)[0]) for _, text in self.received]
+
+
+#function to start the daemons A and B and their clients alice and bob
+def start_pair(sim):
+    daemons = [sim.start_daemon(ip, name) for ip, name in zip(DAEMON_IPS, ('A', 'B'))]
+    clients = [SimClient(sim, ip, daemon_ip, name) for ip, daemon_ip, name in zip(CLIENT_IPS, DAEMON_IPS, ('alice', 'bob'))]
+    return daemons, clients
+
+
+#function to run the client scripts until they are done, then the daemons a while longer. returns the problems of the run
+def run_scripts(sim, scripts):
+    threads = [sim.spawn(script) for script in scripts]
+    problems = []
+    if not sim.run(SIM_LIMIT, lambda: not any(thread.alive for thread in threads)):
+        problems.append(f"{', '.join(thread.name for thread in threads if thread.alive)} stuck at {sim.now:.1f} s")
+    sim.run(sim.now + SETTLE_TIME)
+    return problems
+
+
+#function to check that the daemons are back at the menu of their clients, without a companion or a receive thread
+#(apart from one that lingers to answer repeated FINs)
+def check_daemons(daemons):
+    problems = []
+    for daemon, ip in zip(daemons, DAEMON_IPS):
+        if not daemon.disconnected or len(daemon.clients) > 1:
+            problems.append(f"daemon {ip} is still in the chat with {', '.join(name for name, _ in daemon.clients[1:]) or 'nobody'}")
+        t1 = getattr(daemon, 't1', None)
+        if t1 is not None and t1.is_alive() and not daemon.lingering:
+            problems.append(f"the receive thread of daemon {ip} did not end")
+    return problems
+
+
+#function to check that the chat messages 0 .. count-1 arrived exactly once and in order
+def check_messages(client, count):
+    numbers = client.chat_numbers()
+    problems = []
+    missing = count - len(set(numbers))
+    if missing:
+        problems.append(f"{missing} of {count} messages did not reach {client.username}")
+    if len(numbers) != len(set(numbers)):
+        problems.append(f"{len(numbers) - len(set(numbers))} messages reached {client.username} twice")
+    if numbers != sorted(numbers):
+        problems.append(f"the messages reached {client.username} out of order")
+    return problems
+
+
+#function that lets bob wait for a request and accept it, returns False if no request came
+def accept_request(client):
+    client.send(MessageType.WAIT)
+    if client.expect(MessageType.REQUEST)[0] is None:
+        return False
+    client.send(MessageType.ACCEPT)
+    return True
+
+
+#scenario of a chat: bob waits, alice requests him, sends the messages and ends the chat
+def scenario_chat(sim, args):
+    daemons, (alice, bob) = start_pair(sim)
+    outcome = {}
+
+    def listener():
+        if not bob.connect() or not accept_request(bob):
+            return
+        bob.expect(MessageType.DISCONNECT_REQUEST, timeout=SIM_LIMIT)
+
+    def requester():
+        if not alice.connect():
+            return
+        sim.sleep(0.1)
+        started = sim.now
+        alice.send(MessageType.REQUEST, DAEMON_IPS[1].encode('ascii'))
+        outcome['answer'] = alice.expect(MessageType.ACCEPT, MessageType.DECLINE, MessageType.ERROR, timeout=SYN_TIMEOUT + 5)[0]
+        outcome['handshake'] = sim.now - started
+        if outcome['answer'] != MessageType.ACCEPT:
+            return
+        started = sim.now
+        if alice.send_messages(args.messages, args.payload, args.rate):
+            alice.send(MessageType.DISCONNECT_REQUEST)
+        outcome['chat'] = sim.now - started
+
+    problems = run_scripts(sim, [listener, requester])
+    if outcome.get('answer') != MessageType.ACCEPT:
+        return problems + [f"the handshake failed: {outcome.get('answer')}"]
+    return problems + check_messages(bob, args.messages) + check_daemons(daemons)
+
+
+#scenario of concurrent SYNs: alice and bob request each other at the same time, within a random part of the RTT.
+#each of them has to get an answer and the daemons have to agree whether the chat started
+def scenario_syn_race(sim, args):
+    daemons, clients = start_pair(sim)
+    answers = {}
+    offset = sim.random.uniform(0, 2 * args.delay / 1000)
+
+    def requester(client, peer, delay):
+        if not client.connect():
+            return
+        sim.sleep(0.1 + delay)
+        client.send(MessageType.REQUEST, peer.encode('ascii'))
+        answers[client.username] = client.expect(MessageType.ACCEPT, MessageType.DECLINE, MessageType.ERROR, timeout=SYN_TIMEOUT + 5)[0]
+        if answers[client.username] == MessageType.ACCEPT:
+            client.send(MessageType.DISCONNECT_REQUEST)
+
+    problems = run_scripts(sim, [partial(requester, clients[0], DAEMON_IPS[1], 0), partial(requester, clients[1], DAEMON_IPS[0], offset)])
+    for client in clients:
+        if answers.get(client.username) is None:
+            problems.append(f"{client.username} got no answer to the request")
+    if len({answers.get(client.username) == MessageType.ACCEPT for client in clients}) > 1:
+        problems.append(f"only one side started the chat: {', '.join(f'{name} {answer}' for name, answer in answers.items())}")
+    return problems + check_daemons(daemons)
+
+
+#scenario of a FIN race: after a chat alice and bob end it at the same time, within a random part of the RTT.
+#both daemons have to be back at the menu
+def scenario_fin_race(sim, args):
+    daemons, (alice, bob) = start_pair(sim)
+    race = {}
+    offset = sim.random.uniform(0, 2 * args.delay / 1000)
+
+    def listener():
+        if not bob.connect() or not accept_request(bob):
+            return
+        #the race starts when bob has the messages (or gave up on them)
+        deadline = sim.now + SIM_LIMIT / 2
+        while len(bob.received) < args.messages and sim.now < deadline:
+            bob.receive(deadline - sim.now)
+        race['at'] = sim.now + 1
+        sim.sleep(1 + offset)
+        bob.send(MessageType.DISCONNECT_REQUEST)
+
+    def requester():
+        if not alice.connect():
+            return
+        sim.sleep(0.1)
+        alice.send(MessageType.REQUEST, DAEMON_IPS[1].encode('ascii'))
+        race['answer'] = alice.expect(MessageType.ACCEPT, MessageType.DECLINE, MessageType.ERROR, timeout=SYN_TIMEOUT + 5)[0]
+        if race['answer'] != MessageType.ACCEPT:
+            return
+        alice.send_messages(args.messages, args.payload, args.rate)
+        while 'at' not in race:
+            sim.sleep(POLL_INTERVAL)
+        sim.sleep(max(race['at'] - sim.now, 0))
+        alice.send(MessageType.DISCONNECT_REQUEST)
+
+    problems = run_scripts(sim, [listener, requester])
+    if race.get('answer') != MessageType.ACCEPT:
+        return problems + [f"the handshake failed: {race.get('answer')}"]
+    return problems + check_messages(bob, args.messages) + check_daemons(daemons)
+
+
+SCENARIOS = {
+    'chat': scenario_chat,
+    'syn-race': scenario_syn_race,
+    'fin-race': scenario_fin_race,
+}
+
+
+#function to run one scenario with a seed, returns the simulation (for its counters) and the problems of the run
+def run_scenario(scenario, seed, args):
+    sim = Simulation(seed, args)
+    try:
+        problems = SCENARIOS[scenario](sim, args)
+    finally:
+        sim.stop()
+    return sim, problems + sim.errors
+
+
+#function to run a scenario with the seeds seed .. seed + runs - 1 and print how many runs failed and how fast the state machine ran,
+#returns the number of failed runs
+def run_scenarios(scenario, args):
+    failures = []
+    virtual = 0.0
+    datagrams = 0
+    switches = 0
+    started = time.perf_counter()
+    for seed in range(args.seed, args.seed + args.runs):
+        sim, problems = run_scenario(scenario, seed, args)
+        virtual += sim.now
+        datagrams += sim.datagrams
+        switches += sim.switches
+        if problems:
+            failures.append((seed, problems))
+    elapsed = time.perf_counter() - started
+    print(f"{scenario}: {args.runs} runs, {args.runs - len(failures)} passed, {len(failures)} failed, "
+          f"{virtual / args.runs:.1f} virtual s and {datagrams / args.runs:.0f} datagrams per run")
+    for seed, problems in failures[:FAILURES_SHOWN]:
+        print(f"  seed {seed}: {'; '.join(problems)}")
+    if failures:
+        print(f"  rerun one with: {scenario} --seed {failures[0][0]} --runs 1 --verbose (and the same impairments)")
+    print(f"  {elapsed:.2f} s wall time, {args.runs / elapsed:.1f} runs/s, {datagrams / elapsed:.0f} datagrams/s, "
+          f"{switches / elapsed:.0f} thread switches/s, {virtual / elapsed:.0f}x faster than real time")
+    return len(failures)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP simulation, runs two daemons and their clients in one process on a simulated network "
+                                                 "with a virtual clock, many seeded runs of a scenario in seconds")
+    parser.add_argument("scenario", choices=list(SCENARIOS) + ['all'], help="scenario to run")
+    parser.add_argument("--runs", type=int, default=100, help="number of runs, they use the seeds seed .. seed + runs - 1")
+    parser.add_argument("--messages", type=int, default=20, help="chat messages alice sends to bob")
+    parser.add_argument("--payload", type=int, default=64, help="size of the chat messages")
+    parser.add_argument("--rate", type=float, default=200, help="chat messages per second alice sends")
+    parser.add_argument("--pacing", action="store_true", help="the daemons pace the chat datagrams over the RTT")
+    parser.add_argument("--verbose", action="store_true", help="print the output of the daemons with the virtual time")
+    add_impairment_arguments(parser)
+    parser.set_defaults(delay=SIM_DELAY, seed=0)
+    args = parser.parse_args()
+    failed = 0
+    for scenario in (SCENARIOS if args.scenario == 'all' else [args.scenario]):
+        failed += run_scenarios(scenario, args)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,157 @@
+import select
+import socket
+import sys
+import time
+import argparse
+from simp_daemon import TRACE_MAGIC, TRACE_RECORD, TRACE_OUT, TRACE_CLIENT, RECV_BUFFER_SIZE
+
+DAEMON_PORT = 7777
+CLIENT_PORT = 7778
+REPLY_WAIT = 1  # how long the answers of the daemon are counted after the last replayed datagram
+
+
+#exception raised for a file that is not a trace or is cut off
+class TraceError(Exception):
+    pass
+
+
+#function to read a trace file, returns the address of the daemon that recorded it and the list of its records
+#(time in ns, flags, (ip, port), datagram). a record cut off at the end (the daemon was killed) is left out
+def read_trace(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(TRACE_MAGIC):
+        raise TraceError(f"{path} is not a SIMP trace")
+    offset = len(TRACE_MAGIC)
+    length = int.from_bytes(data[offset:offset + 2], byteorder='big')
+    address = str(data[offset + 2:offset + 2 + length], 'ascii')
+    offset += 2 + length
+
+    records = []
+    while offset + TRACE_RECORD.size <= len(data):
+        timestamp, flags, ip, port, size = TRACE_RECORD.unpack_from(data, offset)
+        offset += TRACE_RECORD.size
+        if offset + size > len(data):
+            break
+        records.append((timestamp, flags, (socket.inet_ntoa(ip), port), data[offset:offset + size]))
+        offset += size
+    return address, records
+
+
+#function to print a trace, one line per datagram
+def dump(path):
+    address, records = read_trace(path)
+    print(f"Trace of the daemon {address}, {len(records)} datagrams")
+    start = records[0][0] if records else 0
+    for timestamp, flags, peer, datagram in records:
+        direction = 'sent to' if flags & TRACE_OUT else 'received from'
+        sock = 'client' if flags & TRACE_CLIENT else 'daemon'
+        print(f"{(timestamp - start) / 1e9:12.6f} {sock} {direction} {peer[0]}:{peer[1]} {len(datagram)} bytes {datagram[:48]!r}")
+
+
+#class to replay the received datagrams of a trace into a daemon. every datagram is sent from its original address when
+#this machine has it (e.g. 127.x addresses), so the daemon sees the same clients and daemons, otherwise from a free address
+class Replayer:
+    def __init__(self, target):
+        self.target = target
+        self.sockets = {}  # original address -> socket
+        self.fallback = None
+        self.rebound = set()  # original addresses that could not be bound
+        self.replies = 0
+
+    def socket_for(self, address):
+        sock = self.sockets.get(address)
+        if sock is not None:
+            return sock
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(address)
+        except OSError:
+            sock.close()
+            self.rebound.add(address)
+            if self.fallback is None:
+                self.fallback = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.fallback.bind(('', 0))
+            sock = self.fallback
+        self.sockets[address] = sock
+        return sock
+
+    #function to count the answers of the daemon without blocking, they would fill the receive buffers otherwise
+    def drain_replies(self, timeout=0):
+        sockets = list(set(self.sockets.values()))
+        while sockets:
+            readable, _, _ = select.select(sockets, [], [], timeout)
+            if not readable:
+                return
+            for sock in readable:
+                try:
+                    sock.recvfrom(RECV_BUFFER_SIZE)
+                    self.replies += 1
+                except OSError:
+                    pass  # e.g. port unreachable of an earlier datagram
+            timeout = 0
+
+    #function to send the received datagrams of the trace to the daemon, at the recorded pace divided by speed
+    #or as fast as possible if speed is None. returns the number of datagrams sent and the time it took
+    def replay(self, records, speed=None):
+        inbound = [record for record in records if not record[1] & TRACE_OUT]
+        if not inbound:
+            return 0, 0.0
+        first = inbound[0][0]
+        started = time.perf_counter()
+        for timestamp, flags, address, datagram in inbound:
+            if speed is not None:
+                delay = started + (timestamp - first) / 1e9 / speed - time.perf_counter()
+                if delay > 0:
+                    self.drain_replies(delay)
+            port = CLIENT_PORT if flags & TRACE_CLIENT else DAEMON_PORT
+            try:
+                self.socket_for(address).sendto(datagram, (self.target, port))
+            except OSError as e:
+                print(f"Could not send to {self.target}:{port}: {e}")
+            if speed is None:
+                self.drain_replies()
+        elapsed = time.perf_counter() - started
+        self.drain_replies(REPLY_WAIT)
+        return len(inbound), elapsed
+
+    def close(self):
+        for sock in set(self.sockets.values()):
+            sock.close()
+
+
+def replay(args):
+    address, records = read_trace(args.trace)
+    target = args.target or address
+    speed = None if args.fast else args.speed
+    pace = 'as fast as possible' if speed is None else f'at {speed:g}x the recorded pace'
+    print(f"Replaying {args.trace} (recorded by {address}) into {target} {pace}")
+    replayer = Replayer(target)
+    try:
+        sent, elapsed = replayer.replay(records, speed)
+    finally:
+        replayer.close()
+    if replayer.rebound:
+        print(f"Sent from another address instead of {', '.join(f'{ip}:{port}' for ip, port in sorted(replayer.rebound))}")
+    print(f"Sent {sent} datagrams in {elapsed:.3f} s ({sent / max(elapsed, 1e-9):.0f} datagrams/s), {replayer.replies} answers")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP trace tool, prints or replays a trace recorded with simp_daemon.py --trace")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dump_parser = commands.add_parser("dump", help="print the datagrams of a trace")
+    dump_parser.add_argument("trace", help="trace file")
+    replay_parser = commands.add_parser("replay", help="send the received datagrams of a trace to a daemon")
+    replay_parser.add_argument("trace", help="trace file")
+    replay_parser.add_argument("--target", help="address of the daemon (the daemon that recorded the trace by default)")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="replay that many times faster than recorded")
+    replay_parser.add_argument("--fast", action="store_true", help="replay as fast as possible")
+    args = parser.parse_args()
+    try:
+        if args.command == "dump":
+            dump(args.trace)
+        else:
+            replay(args)
+    except (OSError, TraceError) as e:
+        print(e)
+        sys.exit(1)
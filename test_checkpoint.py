@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import simp_daemon
+from simp_daemon import (Checkpointer, CongestionControl, ReceiveWindow, CHECKPOINT_MAGIC, CHECKPOINT_RECORD, MAC_KEY_SIZE,
+                         encode_bytes, read_checkpoint)
+
+CLIENT = ('127.0.5.1', 7778)
+BOB = ('127.0.0.2', 7777)
+CAROL = ('10.0.0.3', 7777, 'carol')  # behind the relay hub
+
+
+# tests of the checkpoint file: the records written by Checkpointer are read back into the state, records cut off or damaged
+# by a crash end the checkpoint and the ones before them are kept
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'daemon.ckp')
+        now = time.monotonic()
+        bob = CongestionControl()
+        bob.sample_rtt(0.05)
+        for i in range(3):
+            bob.on_send(b'chat datagram %d' % i, now - 1)
+        bob.on_ack(1, 40, now)
+        bob.enqueue((b'queued message', 'alice', 0))
+        bob.enqueue((b'x' * 1000, 'alice', 0))
+        window = ReceiveWindow()
+        window.receive(2, 'bob', b'early', now - 2)
+        window.receive(0, 'bob', b'delivered', now)
+        state = {'clients': [('alice', CLIENT), ('bob', BOB), ('carol', CAROL)], 'disconnected': False,
+                 'session_keys': {BOB: (b's' * MAC_KEY_SIZE, b'r' * MAC_KEY_SIZE)},
+                 'sessions': {BOB: bob, CAROL: CongestionControl()}, 'receive_windows': {BOB: window, CAROL: ReceiveWindow()}}
+        patcher = mock.patch.multiple(simp_daemon, **state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.checkpointer = Checkpointer(self.path)
+
+    def tearDown(self):
+        self.checkpointer.close()
+        shutil.rmtree(self.directory)
+
+    #function to check that a state read from the checkpoint is the state of the daemon, the ages only roughly
+    def assert_state(self, state):
+        self.assertEqual(state['clients'], [[username, address] for username, address in simp_daemon.clients])
+        self.assertEqual(state['disconnected'], simp_daemon.disconnected)
+        self.assertEqual(state['session_keys'], [[address, encode_bytes(send_key), encode_bytes(receive_key)]
+                                                 for address, (send_key, receive_key) in simp_daemon.session_keys.items()])
+        now = time.monotonic()
+        self.assert_snapshots(state['sessions'], simp_daemon.sessions, now, 'in_flight', (2, 3))
+        self.assert_snapshots(state['receive_windows'], simp_daemon.receive_windows, now, 'buffer', (3,))
+
+    def assert_snapshots(self, read, current, now, entries, ages):
+        self.assertEqual([address for address, _ in read], list(current))
+        for address, state in read:
+            expected = current[address].snapshot(now)
+            for key in expected:
+                if key == entries:
+                    continue
+                if isinstance(expected[key], float):
+                    self.assertAlmostEqual(state[key], expected[key], msg=key)
+                else:
+                    self.assertEqual(state[key], expected[key], key)
+            self.assertEqual(len(state[entries]), len(expected[entries]))
+            for got, entry in zip(state[entries], expected[entries]):
+                self.assertEqual([value for i, value in enumerate(got) if i not in ages], [value for i, value in enumerate(entry) if i not in ages])
+                for i in ages:
+                    self.assertAlmostEqual(got[i], entry[i], delta=0.5)
+
+    #function to get the offsets of the records in the checkpoint file from offset on
+    def record_offsets(self, data, offset):
+        offsets = []
+        while offset < len(data):
+            offsets.append(offset)
+            offset += CHECKPOINT_RECORD.size + CHECKPOINT_RECORD.unpack_from(data, offset)[1]
+        return offsets
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    #function to change a send window and a receive window and to append the records of the changes, returns the offset they start at
+    def change(self):
+        compacted = os.path.getsize(self.path)
+        now = time.monotonic()
+        simp_daemon.sessions[BOB].on_ack(0, 30, now)
+        simp_daemon.receive_windows[BOB].receive(1, 'bob', b'late', now)
+        self.checkpointer.checkpoint()
+        return compacted
+
+    def test_compact_round_trip(self):
+        self.checkpointer.compact()
+        self.assertTrue(self.read().startswith(CHECKPOINT_MAGIC))
+        self.assert_state(read_checkpoint(self.path))
+
+    def test_checkpoint_round_trip(self):
+        self.checkpointer.compact()
+        self.change()
+        del simp_daemon.sessions[CAROL]
+        del simp_daemon.receive_windows[CAROL]
+        simp_daemon.clients.pop()
+        self.checkpointer.checkpoint()
+        self.assert_state(read_checkpoint(self.path))
+
+    def test_nothing_changed(self):
+        self.checkpointer.compact()
+        size = os.path.getsize(self.path)
+        self.checkpointer.checkpoint()
+        self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_truncated_record(self):
+        self.checkpointer.compact()
+        before = read_checkpoint(self.path)
+        compacted = self.change()
+        session, window = self.record_offsets(self.read(), compacted)
+        # the crash cut off the window record, the changed send window is kept
+        data = self.read()
+        self.write(data[:window + CHECKPOINT_RECORD.size + 3])
+        state = read_checkpoint(self.path)
+        self.assertEqual(state['receive_windows'], before['receive_windows'])
+        self.assertNotEqual(state['sessions'], before['sessions'])
+        self.assertEqual(dict(state['sessions'])[BOB]['next_seq'], 3)
+        self.assertEqual(len(dict(state['sessions'])[BOB]['in_flight']), 1)
+        # a header cut off
+        self.write(data[:session + 2])
+        self.assertEqual(read_checkpoint(self.path), before)
+
+    def test_damaged_record(self):
+        self.checkpointer.compact()
+        before = read_checkpoint(self.path)
+        compacted = self.change()
+        session, window = self.record_offsets(self.read(), compacted)
+        data = bytearray(self.read())
+        data[window + CHECKPOINT_RECORD.size + 1] ^= 0xff
+        self.write(data)
+        state = read_checkpoint(self.path)
+        self.assertEqual(state['receive_windows'], before['receive_windows'])
+        self.assertEqual(len(dict(state['sessions'])[BOB]['in_flight']), 1)
+        # a damaged record ends the checkpoint, the records after it are not read
+        data[session + CHECKPOINT_RECORD.size + 1] ^= 0xff
+        data[window + CHECKPOINT_RECORD.size + 1] ^= 0xff
+        self.write(data)
+        self.assertEqual(read_checkpoint(self.path), before)
+
+    def test_not_a_checkpoint(self):
+        self.write(b'something else')
+        with mock.patch('builtins.print'):
+            self.assertIsNone(read_checkpoint(self.path))
+        os.unlink(self.path)
+        self.assertIsNone(read_checkpoint(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
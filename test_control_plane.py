@@ -0,0 +1,74 @@
+import random
+import unittest
+
+from simp_daemon import ControlPlane, PEER_TABLE_SIZE, PEER_TABLE_TOMBSTONES
+
+
+# tests of the peer table of the control plane shared by the worker processes
+class ControlPlaneTest(unittest.TestCase):
+    def setUp(self):
+        self.plane = ControlPlane(2)
+
+    def tearDown(self):
+        self.plane.close()
+
+    def address(self, n):
+        return f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}", 7777
+
+    def empty_entries(self):
+        return sum(1 for index in range(PEER_TABLE_SIZE) if self.plane.entry(index)[0] == 0)
+
+    def test_claim_lookup_release(self):
+        self.plane.claim(self.address(1), 1)
+        self.assertEqual(self.plane.lookup(self.address(1)), 1)
+        self.assertIsNone(self.plane.lookup(self.address(2)))
+        # only the worker that claimed an address releases it
+        self.plane.release(self.address(1), 0)
+        self.assertEqual(self.plane.lookup(self.address(1)), 1)
+        self.plane.release(self.address(1), 1)
+        self.assertIsNone(self.plane.lookup(self.address(1)))
+        self.assertEqual(self.plane.counts(), (0, 1))
+
+    def test_claim_reuses_deleted_entry(self):
+        self.plane.claim(self.address(1), 0)
+        self.plane.release(self.address(1), 0)
+        self.plane.claim(self.address(1), 1)
+        self.assertEqual(self.plane.lookup(self.address(1)), 1)
+        self.assertEqual(self.plane.counts(), (1, 0))
+
+    def test_churn(self):
+        rng = random.Random(1)
+        claimed = {}
+        for n in range(PEER_TABLE_SIZE * 8):
+            address = self.address(n)
+            worker = rng.randrange(2)
+            self.plane.claim(address, worker)
+            claimed[address] = worker
+            if len(claimed) > PEER_TABLE_SIZE // 2 or rng.random() < 0.3:
+                old = rng.choice(list(claimed))
+                self.plane.release(old, claimed.pop(old))
+            used, deleted = self.plane.counts()
+            self.assertEqual(used, len(claimed))
+            self.assertLessEqual(deleted, PEER_TABLE_TOMBSTONES)
+        for address, worker in claimed.items():
+            self.assertEqual(self.plane.lookup(address), worker)
+        self.assertIsNone(self.plane.lookup(self.address(PEER_TABLE_SIZE * 8)))
+        self.assertGreater(self.empty_entries(), 0)
+
+    def test_full_table(self):
+        for n in range(PEER_TABLE_SIZE):
+            self.plane.claim(self.address(n), 0)
+        # one entry stays empty so that misses end
+        self.assertEqual(self.plane.counts(), (PEER_TABLE_SIZE - 1, 0))
+        self.assertEqual(self.empty_entries(), 1)
+        self.assertIsNone(self.plane.lookup(self.address(PEER_TABLE_SIZE - 1)))
+        self.assertEqual(self.plane.lookup(self.address(0)), 0)
+        # a full table with deleted entries takes new addresses again
+        self.plane.release(self.address(0), 0)
+        self.plane.claim(self.address(PEER_TABLE_SIZE), 1)
+        self.assertEqual(self.plane.lookup(self.address(PEER_TABLE_SIZE)), 1)
+        self.assertIsNone(self.plane.lookup(self.address(0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
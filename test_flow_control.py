@@ -0,0 +1,171 @@
+import types
+import unittest
+from unittest import mock
+
+import simp_daemon
+from simp_daemon import (CongestionControl, ReceiveWindow, FAST_LOSS_THRESHOLD, INITIAL_RTO, INITIAL_WINDOW, MAX_RTO, MAX_WINDOW,
+                         MIN_RTO, MIN_WINDOW, RECV_WINDOW, REORDER_TIMEOUT, SEQ_SPACE)
+
+
+# tests of the send window of a companion: sequence numbers, AIMD, the RTT estimation and the advertised window
+class CongestionControlTest(unittest.TestCase):
+    def setUp(self):
+        self.session = CongestionControl()
+
+    def send(self, count, now=0):
+        return [self.session.on_send(b'datagram', now) for _ in range(count)]
+
+    def test_sequence_wraps(self):
+        self.session.next_seq = SEQ_SPACE - 2
+        self.assertEqual(self.send(3), [SEQ_SPACE - 2, SEQ_SPACE - 1, 0])
+        self.assertEqual(self.session.next_seq, 1)
+        self.assertEqual(sorted(self.session.in_flight), [0, SEQ_SPACE - 2, SEQ_SPACE - 1])
+
+    def test_slow_start_and_congestion_avoidance(self):
+        self.session.ssthresh = INITIAL_WINDOW + 2
+        self.send(4)
+        # one datagram per acknowledgement below ssthresh, one per window above it
+        self.session.on_ack(0, None, 1)
+        self.session.on_ack(1, None, 1)
+        self.assertEqual(self.session.cwnd, INITIAL_WINDOW + 2)
+        self.session.on_ack(2, None, 1)
+        self.assertAlmostEqual(self.session.cwnd, INITIAL_WINDOW + 2 + 1 / (INITIAL_WINDOW + 2))
+
+    def test_window_is_capped(self):
+        self.session.cwnd = MAX_WINDOW
+        self.send(1)
+        self.session.on_ack(0, None, 1)
+        self.assertEqual(self.session.cwnd, MAX_WINDOW)
+
+    def test_duplicate_ack(self):
+        self.send(2)
+        self.assertEqual(self.session.on_ack(0, None, 1), [])
+        cwnd = self.session.cwnd
+        self.assertEqual(self.session.on_ack(0, None, 1), [])
+        self.assertEqual(self.session.cwnd, cwnd)
+        self.assertEqual(self.session.acked, 1)
+
+    def test_loss_halves_the_window(self):
+        self.send(FAST_LOSS_THRESHOLD + 1, now=10)
+        lost = []
+        for seq in range(1, FAST_LOSS_THRESHOLD + 1):
+            lost += self.session.on_ack(seq, None, 11)
+        self.assertEqual(lost, [0])
+        cwnd = INITIAL_WINDOW + FAST_LOSS_THRESHOLD
+        self.assertEqual(self.session.ssthresh, cwnd / 2)
+        self.assertEqual(self.session.cwnd, cwnd / 2)
+        # the window shrinks once per RTT
+        self.session.on_loss(11)
+        self.assertEqual(self.session.cwnd, cwnd / 2)
+
+    def test_ssthresh_floor(self):
+        self.session.cwnd = 2
+        self.session.on_loss(10)
+        self.assertEqual(self.session.ssthresh, 2)
+        self.assertEqual(self.session.cwnd, 2)
+
+    def test_timeout_loss(self):
+        self.session.cwnd = 10
+        self.session.on_loss(10, timeout=True)
+        self.assertEqual(self.session.ssthresh, 5)
+        self.assertEqual(self.session.cwnd, MIN_WINDOW)
+        self.assertEqual(self.session.rto, min(INITIAL_RTO * 2, MAX_RTO))
+
+    def test_rtt_estimation(self):
+        self.session.sample_rtt(0.4)
+        self.assertEqual(self.session.srtt, 0.4)
+        self.assertEqual(self.session.rttvar, 0.2)
+        self.assertAlmostEqual(self.session.rto, 1.2)
+        self.session.sample_rtt(0.8)
+        self.assertAlmostEqual(self.session.rttvar, 0.25)
+        self.assertAlmostEqual(self.session.srtt, 0.45)
+        self.assertAlmostEqual(self.session.rto, 1.45)
+        # the timeout stays between MIN_RTO and MAX_RTO
+        for _ in range(50):
+            self.session.sample_rtt(0.001)
+        self.assertEqual(self.session.rto, MIN_RTO)
+        self.session.sample_rtt(100)
+        self.assertEqual(self.session.rto, MAX_RTO)
+
+    def test_retransmitted_datagram_gives_no_sample(self):
+        self.send(1)
+        self.session.in_flight[0][3] = 1
+        self.session.on_ack(0, None, 3)
+        self.assertIsNone(self.session.srtt)
+        self.assertEqual(self.session.rto, INITIAL_RTO)
+
+    def test_receive_window_clamps(self):
+        self.session.cwnd = 10
+        self.send(1)
+        self.session.on_ack(0, 3, 1)
+        self.assertEqual(self.session.window(), 3)
+        self.send(3)
+        self.assertIsNone(self.session.send_delay(1))
+        # a closed window still lets one datagram out when nothing is in flight
+        self.session.rwnd = 0
+        self.assertEqual(self.session.window(), 0)
+        self.session.in_flight.clear()
+        self.assertEqual(self.session.window(), MIN_WINDOW)
+        self.assertEqual(self.session.send_delay(1), 0)
+
+
+# tests of the receive window of a companion: in order delivery modulo SEQ_SPACE, duplicates and the advertised window
+class ReceiveWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.window = ReceiveWindow()
+
+    def receive(self, seq, now=0):
+        return self.window.receive(seq, 'alice', b'%d' % seq, now)
+
+    def test_in_order(self):
+        self.assertEqual(self.receive(0), [('alice', b'0')])
+        self.assertEqual(self.receive(1), [('alice', b'1')])
+        self.assertEqual(self.window.expected, 2)
+
+    def test_out_of_order(self):
+        self.assertEqual(self.receive(2), [])
+        self.assertEqual(self.receive(1), [])
+        self.assertEqual(self.receive(0), [('alice', b'0'), ('alice', b'1'), ('alice', b'2')])
+        self.assertEqual(self.window.buffer, {})
+
+    def test_sequence_wraps(self):
+        self.window.expected = SEQ_SPACE - 1
+        self.assertEqual(self.receive(0), [])
+        self.assertEqual(self.receive(SEQ_SPACE - 1), [('alice', b'%d' % (SEQ_SPACE - 1)), ('alice', b'0')])
+        self.assertEqual(self.window.expected, 1)
+        # the datagrams before the wrap are duplicates now
+        self.assertEqual(self.receive(SEQ_SPACE - 1), [])
+
+    def test_duplicates(self):
+        self.receive(0)
+        self.assertEqual(self.receive(0), [])
+        self.receive(2)
+        self.assertEqual(self.receive(2), [])
+        self.assertEqual(len(self.window.buffer), 1)
+        self.assertEqual(self.receive(1), [('alice', b'1'), ('alice', b'2')])
+
+    def test_outside_of_window(self):
+        self.assertIsNone(self.receive(RECV_WINDOW))
+        self.assertEqual(self.receive(RECV_WINDOW - 1), [])
+
+    def test_expire_skips_the_gap(self):
+        self.receive(2, now=0)
+        self.receive(3, now=1)
+        self.assertEqual(self.window.expire(1), [])
+        self.assertEqual(self.window.expire(REORDER_TIMEOUT), [('alice', b'2'), ('alice', b'3')])
+        self.assertEqual(self.window.expected, 4)
+
+    def test_advertised(self):
+        self.assertEqual(self.window.advertised(), RECV_WINDOW)
+        self.receive(1)
+        self.receive(2)
+        self.assertEqual(self.window.advertised(), RECV_WINDOW - 2)
+        # under memory pressure only the datagram that fills the gap is taken
+        with mock.patch.object(simp_daemon, 'memory_budget', types.SimpleNamespace(pressure=True)):
+            self.assertEqual(self.window.advertised(), 0)
+            self.window.buffer.clear()
+            self.assertEqual(self.window.advertised(), MIN_WINDOW)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+from simp_daemon import HashRing
+
+SELF = '10.0.0.1'
+
+
+# tests of the hash ring that spreads the usernames over the daemons of a cluster
+class HashRingTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = HashRing(SELF)
+        self.usernames = [f'user{i}' for i in range(4000)]
+
+    def member(self, n):
+        return f'10.0.0.{n}'
+
+    def owners(self, ring=None):
+        ring = ring or self.ring
+        return {username: ring.owner(username) for username in self.usernames}
+
+    #function to get the share of the usernames whose owner changed
+    def moved(self, before, after):
+        return sum(1 for username in self.usernames if before[username] != after[username]) / len(self.usernames)
+
+    def test_alone(self):
+        self.assertEqual(self.ring.members(), [SELF])
+        self.assertEqual(set(self.owners().values()), {SELF})
+
+    def test_owner_is_stable(self):
+        for n in range(2, 5):
+            self.ring.join(self.member(n), 0)
+        owners = self.owners()
+        self.assertEqual(self.owners(), owners)
+        # another daemon with the same members agrees, whatever order they joined in
+        other = HashRing(self.member(4))
+        for n in range(3, 0, -1):
+            other.join(self.member(n), 0)
+        self.assertEqual(self.owners(other), owners)
+        self.assertEqual(set(owners.values()), set(self.ring.members()))
+
+    def test_join_moves_about_one_in_n(self):
+        for n in range(2, 5):
+            self.ring.join(self.member(n), 0)
+        before = self.owners()
+        self.assertTrue(self.ring.join(self.member(5), 0))
+        after = self.owners()
+        # only usernames taken over by the new member move
+        self.assertTrue(all(after[username] == self.member(5) for username in self.usernames if before[username] != after[username]))
+        self.assertAlmostEqual(self.moved(before, after), 1 / 5, delta=0.08)
+        self.assertFalse(self.ring.join(self.member(5), 1))
+
+    def test_leave_moves_about_one_in_n(self):
+        for n in range(2, 6):
+            self.ring.join(self.member(n), 0)
+        before = self.owners()
+        self.assertTrue(self.ring.leave(self.member(3)))
+        after = self.owners()
+        # only the usernames of the member that left move
+        self.assertTrue(all(before[username] == self.member(3) for username in self.usernames if before[username] != after[username]))
+        self.assertAlmostEqual(self.moved(before, after), 1 / 5, delta=0.08)
+        self.assertNotIn(self.member(3), after.values())
+        self.assertFalse(self.ring.leave(self.member(3)))
+
+    def test_join_and_leave_restore_the_owners(self):
+        self.ring.join(self.member(2), 0)
+        before = self.owners()
+        self.ring.join(self.member(3), 0)
+        self.ring.leave(self.member(3))
+        self.assertEqual(self.owners(), before)
+
+    def test_expire(self):
+        self.ring.join(self.member(2), 10)
+        self.ring.join(self.member(3), 20)
+        self.ring.join(self.member(2), 30)
+        self.assertEqual(self.ring.expire(25), [self.member(3)])
+        self.assertEqual(self.ring.members(), [SELF, self.member(2)])
+        self.assertEqual(self.ring.expire(25), [])
+        # the daemon itself never expires
+        self.assertEqual(self.ring.expire(100), [self.member(2)])
+        self.assertEqual(self.ring.members(), [SELF])
+        self.assertEqual(set(self.owners().values()), {SELF})
+
+    def test_self_does_not_join(self):
+        self.assertFalse(self.ring.join(SELF, 0))
+        self.assertEqual(self.ring.expire(100), [])
+        self.assertFalse(self.ring.leave(SELF))
+        self.assertEqual(self.ring.members(), [SELF])
+
+
+if __name__ == '__main__':
+    unittest.main()
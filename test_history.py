@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from simp_daemon import HistoryIndex, HISTORY_MAGIC, HISTORY_RECORD
+
+
+# tests of the chat history: the search over the inverted index, trimming the index and loading the file again
+class HistoryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'history')
+        self.history = self.open()
+
+    def open(self):
+        history = HistoryIndex(self.path)
+        self.addCleanup(history.close)
+        return history
+
+    def add(self, *messages):
+        self.history.add([(number, username, message) for number, (username, message) in enumerate(messages, len(self.history.offsets))])
+
+    def texts(self, query, limit=20):
+        matches, more = self.history.search(query, limit)
+        return [message for _, _, message in matches], more
+
+    def test_every_term_matches(self):
+        self.add(('alice', b'pizza tonight?'), ('bob', b'Pizza, sure'), ('alice', b'no pizza, pasta'), ('bob', b'pasta it is'))
+        self.assertEqual(self.texts('pizza'), ([b'no pizza, pasta', b'Pizza, sure', b'pizza tonight?'], False))
+        self.assertEqual(self.texts('PASTA pizza'), ([b'no pizza, pasta'], False))
+        self.assertEqual(self.texts('pizza @bob'), ([b'Pizza, sure'], False))
+        self.assertEqual(self.texts('@alice'), ([b'no pizza, pasta', b'pizza tonight?'], False))
+        self.assertEqual(self.texts('pizza burger'), ([], False))
+        self.assertEqual(self.texts('?!'), ([], False))
+
+    def test_matches_are_read_from_the_file(self):
+        self.add(('alice', b'hello'))
+        self.assertEqual(self.history.search('hello'), ([(0, 'alice', b'hello')], False))
+
+    def test_limit(self):
+        self.add(*[('alice', b'message %d' % i) for i in range(5)])
+        self.assertEqual(self.texts('message', 3), ([b'message 4', b'message 3', b'message 2'], True))
+        self.assertEqual(self.texts('message', 5), ([b'message %d' % i for i in range(4, -1, -1)], False))
+
+    def test_trim(self):
+        self.add(*[('alice', b'old %d' % i) for i in range(10)])
+        self.add(('bob', b'new 10 old'))
+        size = self.history.memory()
+        dropped = self.history.trim(size // 2)
+        self.assertGreater(dropped, 0)
+        self.assertLessEqual(self.history.memory(), size - size // 2)
+        self.assertEqual(self.history.first, dropped)
+        self.assertEqual(len(self.history.offsets), 11 - dropped)
+        self.assertEqual(self.texts('old')[0], [b'new 10 old'] + [b'old %d' % i for i in range(9, dropped - 1, -1)])
+        self.assertEqual(self.texts('@bob')[0], [b'new 10 old'])
+        # the trimmed messages stay in the file, new messages get the next numbers
+        self.assertEqual(self.texts('0')[0], [])
+        self.add(('alice', b'old 11'))
+        self.assertEqual(self.texts('11')[0], [b'old 11'])
+        self.assertEqual(self.open().load(), 12)
+
+    def test_load(self):
+        self.add(('alice', b'first pizza'), ('bob', b'second pizza'))
+        self.history.close()
+        self.history = self.open()
+        self.assertEqual(self.history.load(), 2)
+        self.assertEqual(self.texts('pizza @alice'), ([b'first pizza'], False))
+        self.add(('alice', b'third pizza'))
+        self.assertEqual(self.texts('pizza')[0], [b'third pizza', b'second pizza', b'first pizza'])
+
+    def test_load_cuts_off_a_truncated_record(self):
+        self.add(('alice', b'kept'), ('alice', b'cut off'))
+        end = self.history.end
+        self.history.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(end - 3)
+        self.history = self.open()
+        self.assertEqual(self.history.load(), 1)
+        self.assertEqual(os.path.getsize(self.path), len(HISTORY_MAGIC) + HISTORY_RECORD.size + len(b'alice') + len(b'kept'))
+        self.add(('bob', b'appended'))
+        self.history.close()
+        self.history = self.open()
+        self.assertEqual(self.history.load(), 2)
+        self.assertEqual(self.texts('appended')[0], [b'appended'])
+
+    def test_load_skips_a_username_that_is_not_ascii(self):
+        self.add(('alice', b'before pizza'))
+        self.history.close()
+        with open(self.path, 'ab') as f:
+            name = 'b\xf6b'.encode('latin-1')
+            f.write(HISTORY_RECORD.pack(1000, len(name), 5) + name + b'pizza')
+        self.history = self.open()
+        self.assertEqual(self.history.load(), 1)
+        self.assertEqual(self.history.end, os.path.getsize(self.path))
+        self.add(('carol', b'after pizza'))
+        self.assertEqual(self.texts('pizza')[0], [b'after pizza', b'before pizza'])
+
+    def test_not_a_history(self):
+        self.history.close()
+        with open(self.path, 'wb') as f:
+            f.write(b'something else')
+        with self.assertRaises(ValueError):
+            HistoryIndex(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()